@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Layer microbenchmarks: the CPU time of the forward, and of the forward and backward, of the model
+layers, metrics and losses, at representative batch, channel and patch sizes.
+
+    python -m benchmarks.layers run [--filter NAME] [--min-run-time S] [--json FILE]
+    python -m benchmarks.layers compare BASELINE.json CURRENT.json [--threshold 0.1]
+
+`compare` lists the cases that are slower than in the baseline by more than the threshold, and
+exits with status 1 if there are any.
+"""
+import argparse
+import json
+import platform
+import sys
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from torch.utils import benchmark as torch_benchmark
+
+from models.layers import ConvLayer, GatedConv2d, GatedConvTranspose2d
+from models.complex_layers import ComplexConv2d, ComplexBatchNorm2d
+from models.densenet import ResidualDenseBlock, RDDB
+from utils.metrics import SSIM, PSNR
+from optimisation.loss import EdgeAwareLoss
+
+# (batch size, channels, patch size) of the feature maps inside the models, and of the images
+FEATURE_SHAPES = ((16, 32, 64), (4, 64, 128))
+IMAGE_SHAPES = ((16, 3, 64), (4, 3, 256))
+
+
+class _Metric(nn.Module):
+    """A metric or loss of the images against a fixed target, as a layer of one input"""
+    def __init__(self, metric, target):
+        super().__init__()
+        self.metric = metric
+        self.register_buffer('target', target)
+
+    def forward(self, x):
+        return self.metric(x, self.target)
+
+
+def _complex_input(batch, channels, size):
+    return torch.randn(batch, channels, size, size, dtype=torch.cfloat)
+
+
+def _real_input(batch, channels, size):
+    return torch.randn(batch, channels, size, size)
+
+
+def _image_input(batch, channels, size):
+    return torch.rand(batch, channels, size, size)
+
+
+# name: (constructor of the layer for a number of channels and an input, input, shapes)
+LAYERS = {
+    'ConvLayer': (lambda channels, x: ConvLayer(channels, channels), _real_input, FEATURE_SHAPES),
+    'GatedConv2d': (lambda channels, x: GatedConv2d(channels, channels, local_condition=False),
+                    _real_input, FEATURE_SHAPES),
+    'GatedConvTranspose2d': (lambda channels, x: GatedConvTranspose2d(channels, channels, local_condition=False),
+                             _real_input, FEATURE_SHAPES),
+    'ComplexConv2d': (lambda channels, x: ComplexConv2d(channels, channels, 3, padding=1),
+                      _complex_input, FEATURE_SHAPES),
+    'ComplexBatchNorm2d': (lambda channels, x: ComplexBatchNorm2d(channels), _complex_input, FEATURE_SHAPES),
+    'ResidualDenseBlock': (lambda channels, x: ResidualDenseBlock(channels, local_condition=False),
+                           _real_input, FEATURE_SHAPES),
+    'RDDB': (lambda channels, x: RDDB(channels, local_condition=False), _real_input, FEATURE_SHAPES),
+    'SSIM': (lambda channels, x: _Metric(SSIM(data_range=1, channels=channels), torch.rand_like(x)),
+             _image_input, IMAGE_SHAPES),
+    'PSNR': (lambda channels, x: _Metric(PSNR(data_range=1), torch.rand_like(x)), _image_input, IMAGE_SHAPES),
+    'EdgeAwareLoss': (lambda channels, x: _Metric(EdgeAwareLoss(channels), torch.rand_like(x)),
+                      _image_input, IMAGE_SHAPES),
+}
+
+
+def _sum(out):
+    return torch.view_as_real(out).sum() if out.is_complex() else out.sum()
+
+
+def _forward_backward(layer, x):
+    _sum(layer(x)).backward()
+
+
+def time_layer(name, batch, channels, size, min_run_time=1.0):
+    """
+    Median time of the forward, in eval mode without gradients, and of the forward and backward,
+    in training mode, of the layer `name` of LAYERS, in milliseconds
+    """
+    constructor, make_input, _ = LAYERS[name]
+    torch.manual_seed(0)
+    x = make_input(batch, channels, size)
+    layer = constructor(channels, x)
+
+    layer.eval()
+    with torch.no_grad():
+        forward = torch_benchmark.Timer('layer(x)', globals={'layer': layer, 'x': x})
+        forward = forward.blocked_autorange(min_run_time=min_run_time)
+
+    layer.train()
+    x.requires_grad_()
+    forward_backward = torch_benchmark.Timer('forward_backward(layer, x)',
+                                             globals={'forward_backward': _forward_backward, 'layer': layer, 'x': x})
+    forward_backward = forward_backward.blocked_autorange(min_run_time=min_run_time)
+    return {'forward_ms': forward.median * 1e3, 'forward_backward_ms': forward_backward.median * 1e3}
+
+
+def environment():
+    """What the timings depend on besides the code"""
+    return {'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'threads': torch.get_num_threads()}
+
+
+def run(names=None, min_run_time=1.0):
+    """
+    Time the layers `names` (default: all), at each of their shapes
+
+    Returns:
+        the environment, and the timings by case, '<layer>/b<batch>-c<channels>-s<size>'
+    """
+    results = {}
+    for name in names or LAYERS:
+        for batch, channels, size in LAYERS[name][2]:
+            case = f'{name}/b{batch}-c{channels}-s{size}'
+            results[case] = time_layer(name, batch, channels, size, min_run_time)
+            print(f"{case:<40} forward {results[case]['forward_ms']:9.3f} ms   "
+                  f"forward+backward {results[case]['forward_backward_ms']:9.3f} ms", flush=True)
+    return {'environment': environment(), 'results': results}
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Regressions of `current` against `baseline`, both as returned by `run`
+
+    Returns:
+        (case, timing, baseline milliseconds, current milliseconds) of every timing that is slower
+        than in the baseline by more than the fraction `threshold`
+    """
+    regressions = []
+    for case, timings in current['results'].items():
+        for timing, milliseconds in timings.items():
+            reference = baseline['results'].get(case, {}).get(timing)
+            if reference is not None and milliseconds > reference * (1 + threshold):
+                regressions.append((case, timing, reference, milliseconds))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="time the layers")
+    run_parser.add_argument('--filter', nargs='*', choices=list(LAYERS), help="layers to time (default: all)")
+    run_parser.add_argument('--min-run-time', type=float, default=1.0, help="seconds to time each case for")
+    run_parser.add_argument('--json', help="file to write the results to, e.g. to use as a baseline")
+    compare_parser = commands.add_parser('compare', help="flag regressions against a baseline")
+    compare_parser.add_argument('baseline', help="results of `run` to compare against")
+    compare_parser.add_argument('current', help="results of `run` to compare")
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help="slowdown, as a fraction, from which a timing is a regression")
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run(args.filter, args.min_run_time)
+        if args.json:
+            Path(args.json).write_text(json.dumps(results, indent=2))
+        return 0
+
+    baseline, current = (json.loads(Path(path).read_text()) for path in (args.baseline, args.current))
+    if baseline['environment'] != current['environment']:
+        print("Warning: the results come from different environments:\n"
+              f"  baseline {baseline['environment']}\n  current  {current['environment']}")
+    regressions = compare(baseline, current, args.threshold)
+    for case, timing, reference, milliseconds in regressions:
+        print(f"{case:<40} {timing:<20} {reference:9.3f} ms -> {milliseconds:9.3f} ms "
+              f"({milliseconds / reference - 1:+.0%})")
+    missing = set(baseline['results']) ^ set(current['results'])
+    if missing:
+        print(f"Cases in only one of the results: {', '.join(sorted(missing))}")
+    print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
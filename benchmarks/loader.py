@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Data loader throughput benchmark: loads batches of `TransformedHuaweiDataset` and `CsvLoader`
+patches, and of `HuaweiDataset` images, without a model, over a sweep of the number of workers,
+pinned memory, prefetching, batch sizes and storage locations, and reports the samples and bytes
+per second and the CPU utilization of each worker. Saves the fastest settings for
+`TransformedHuaweiDataset`, which `main.py` trains on, as a profile for the `loader_profile` setting.
+
+    python -m benchmarks.loader [--workers N ...] [--prefetch-factors N ...] [--batch-sizes N ...]
+                                [--storage DIR ...] [--batches N] [--json FILE] [--profile FILE]
+
+The datasets are synthetic, created in a temporary directory in each --storage directory, e.g. a
+local disk, /dev/shm or a network mount, unless --data-dir and --raw-dir give existing ones.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+from torch.utils.data import DataLoader, Dataset, RandomSampler
+
+from benchmarks.synthetic import make_transformed_dataset, make_huawei_dataset
+from utils.loader import TransformedHuaweiDataset, HuaweiDataset, CsvLoader, transform_sample
+
+# Throughput within which a setting with fewer workers is recommended over the fastest one
+RECOMMENDATION_TOLERANCE = 0.05
+
+
+class _CpuTimedDataset(Dataset):
+    """
+    Records, after every sample, the CPU time the process that loads it has used since it started
+    loading, in `cpu_times`, a shared array of one entry per worker
+    """
+    def __init__(self, dataset, num_workers):
+        self.dataset = dataset
+        self.cpu_times = multiprocessing.Array('d', max(num_workers, 1), lock=False)
+        self.start = time.process_time()
+
+    @staticmethod
+    def worker_init_fn(worker_id):
+        info = torch.utils.data.get_worker_info()
+        info.dataset.start = time.process_time()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.dataset[idx]
+        info = torch.utils.data.get_worker_info()
+        self.cpu_times[0 if info is None else info.id] = time.process_time() - self.start
+        return sample
+
+
+def _batch_bytes(batch):
+    return sum(value.numel() * value.element_size() for value in batch.values() if isinstance(value, torch.Tensor))
+
+
+def _file_bytes(dataset):
+    """Mean size of the image files of a sample"""
+    root_dir = Path(getattr(dataset, 'root_dir', None) or dataset.root_path)
+    sizes = [path.stat().st_size for path in root_dir.rglob('*.png')]
+    return sum(sizes) / len(dataset)
+
+
+def time_loader(dataset, batch_size, num_workers, pin_memory=False, prefetch_factor=2, batches=20):
+    """
+    Load `batches` random batches of `dataset`, as in training, and time all but the first,
+    which includes starting the workers
+
+    Returns:
+        the samples and bytes (of the loaded tensors, and of the image files) per second, the
+        start up time, and the CPU utilization of each worker, or of this process without workers
+    """
+    timed_dataset = _CpuTimedDataset(dataset, num_workers)
+    loader = DataLoader(timed_dataset, batch_size=batch_size,
+                        sampler=RandomSampler(dataset, replacement=True, num_samples=batches * batch_size),
+                        num_workers=num_workers, pin_memory=pin_memory,
+                        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+                        worker_init_fn=_CpuTimedDataset.worker_init_fn)
+
+    start = time.perf_counter()
+    loading = iter(loader)
+    first = next(loading)
+    first_received = time.perf_counter()
+    cpu_start = list(timed_dataset.cpu_times)
+    samples = tensor_bytes = 0
+    for batch in loading:
+        samples += len(batch['noisy'])
+        tensor_bytes += _batch_bytes(batch)
+    elapsed = time.perf_counter() - first_received
+    utilization = [(end - begin) / elapsed for begin, end in zip(cpu_start, timed_dataset.cpu_times)]
+    del first, loading
+
+    return {
+        'samples_per_second': samples / elapsed,
+        'bytes_per_second': tensor_bytes / elapsed,
+        'file_bytes_per_second': _file_bytes(dataset) * samples / elapsed,
+        'startup_seconds': first_received - start,
+        'cpu_utilization': utilization,
+    }
+
+
+def _datasets(transformed_dir, raw_dir):
+    """The datasets to load, by name, with the batch sizes to load them in"""
+    datasets = {}
+    if transformed_dir is not None:
+        datasets['TransformedHuaweiDataset'] = TransformedHuaweiDataset(transformed_dir, transform=transform_sample)
+        if (Path(transformed_dir) / 'dataset.csv').is_file():
+            datasets['CsvLoader'] = CsvLoader(Path(transformed_dir) / 'dataset.csv')
+    if raw_dir is not None:
+        datasets['HuaweiDataset'] = HuaweiDataset(raw_dir, transform=transform_sample)
+    return datasets
+
+
+def sweep(datasets, storage, workers, pin_memory, prefetch_factors, batch_sizes, image_batch_sizes, batches=20):
+    """
+    Time every combination of the settings for each of `datasets`, the batch sizes being
+    `image_batch_sizes` for the full images of `HuaweiDataset`
+
+    Returns:
+        a list of the settings and results of each combination
+    """
+    results = []
+    for name, dataset in datasets.items():
+        sizes = image_batch_sizes if name == 'HuaweiDataset' else batch_sizes
+        for batch_size, num_workers, pin, prefetch_factor in itertools.product(sizes, workers, pin_memory,
+                                                                               prefetch_factors):
+            if num_workers == 0 and prefetch_factor != prefetch_factors[0]:
+                continue   # without workers there is no prefetching
+            settings = {'dataset': name, 'storage': storage, 'batch_size': batch_size, 'num_workers': num_workers,
+                        'pin_memory': pin, 'prefetch_factor': prefetch_factor if num_workers > 0 else None}
+            result = time_loader(dataset, batch_size, num_workers, pin, prefetch_factor, batches)
+            results.append({**settings, **result})
+            print("{dataset:<24} {storage:<16} batch {batch_size:>3}  workers {num_workers:>2}  pin {pin!s:<5}  "
+                  "prefetch {prefetch!s:<4}  {samples:9.1f} samples/s  {megabytes:8.1f} MB/s  CPU {cpu}".format(
+                      **settings, pin=pin, prefetch=settings['prefetch_factor'],
+                      samples=result['samples_per_second'], megabytes=result['bytes_per_second'] / 1e6,
+                      cpu=' '.join(f'{value:.0%}' for value in result['cpu_utilization'])), flush=True)
+    return results
+
+
+def recommend(results, dataset='TransformedHuaweiDataset'):
+    """
+    The loader settings for `dataset` with the fewest workers among those within
+    RECOMMENDATION_TOLERANCE of the highest throughput, as a profile for `loader_profile`
+    """
+    results = [result for result in results if result['dataset'] == dataset]
+    if not results:
+        raise ValueError(f"No results for {dataset}")
+    fastest = max(result['samples_per_second'] for result in results)
+    candidates = [result for result in results
+                  if result['samples_per_second'] >= (1 - RECOMMENDATION_TOLERANCE) * fastest]
+    best = min(candidates, key=lambda result: (result['num_workers'], -result['samples_per_second']))
+    return {
+        'num_workers': best['num_workers'],
+        'pin_memory': best['pin_memory'],
+        'prefetch_factor': best['prefetch_factor'],
+        # what the settings were measured with, for reference
+        'measured': {key: best[key] for key in ('dataset', 'storage', 'batch_size', 'samples_per_second')},
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    cpu_count = os.cpu_count()
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({0, 2, 4, cpu_count}),
+                        help="numbers of worker processes")
+    parser.add_argument('--pin-memory', type=int, nargs='+', choices=[0, 1],
+                        default=[0, 1] if torch.cuda.is_available() else [0],
+                        help="whether to pin memory (default: both with CUDA)")
+    parser.add_argument('--prefetch-factors', type=int, nargs='+', default=[2, 4], help="batches prefetched per worker")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 64], help="batch sizes of patches")
+    parser.add_argument('--image-batch-sizes', type=int, nargs='+', default=[1, 4],
+                        help="batch sizes of the full images of HuaweiDataset")
+    parser.add_argument('--batches', type=int, default=20, help="batches to load per setting")
+    parser.add_argument('--storage', nargs='+', default=[tempfile.gettempdir()],
+                        help="directories to create the synthetic datasets in")
+    parser.add_argument('--patches', type=int, default=512, help="patches of the synthetic transformed dataset")
+    parser.add_argument('--size', type=int, default=128, help="height and width of the synthetic patches")
+    parser.add_argument('--images', type=int, default=8, help="images of the synthetic original dataset")
+    parser.add_argument('--image-size', type=int, default=1024, help="height and width of the synthetic images")
+    parser.add_argument('--data-dir', help="existing transformed dataset to load, instead of synthetic ones")
+    parser.add_argument('--raw-dir', help="existing original dataset to load, with --data-dir")
+    parser.add_argument('--json', help="file to write the results to")
+    parser.add_argument('--profile', help="file to save the recommended settings to, for `loader_profile`")
+    options = parser.parse_args(argv)
+
+    sweep_settings = (options.workers, [bool(pin) for pin in options.pin_memory], options.prefetch_factors,
+                      options.batch_sizes, options.image_batch_sizes, options.batches)
+    results = []
+    if options.data_dir or options.raw_dir:
+        results += sweep(_datasets(options.data_dir, options.raw_dir), 'given', *sweep_settings)
+    else:
+        for storage in options.storage:
+            with tempfile.TemporaryDirectory(dir=storage) as temporary_dir:
+                print(f"==> Creating synthetic datasets in '{temporary_dir}'")
+                num_originals = max(1, options.patches // 16)
+                transformed_dir = make_transformed_dataset(Path(temporary_dir) / 'transformed', num_originals,
+                                                           16, options.size)
+                raw_dir = make_huawei_dataset(Path(temporary_dir) / 'original', options.images, options.image_size)
+                results += sweep(_datasets(transformed_dir, raw_dir), storage, *sweep_settings)
+
+    if options.json:
+        Path(options.json).write_text(json.dumps(results, indent=2))
+    if any(result['dataset'] == 'TransformedHuaweiDataset' for result in results):
+        profile = recommend(results)
+        print("Recommended: {num_workers} workers, pin_memory {pin_memory}, prefetch_factor {prefetch_factor}"
+              .format(**profile))
+        if options.profile:
+            Path(options.profile).write_text(json.dumps(profile, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Startup time benchmark: the time to import the entry points and packages, each in a fresh
+interpreter, and the heavy dependencies each of them loads.
+
+    python -m benchmarks.startup [--repeat N] [module ...]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# Imports that inference (`test_data_dir` mode) does not need. torchvision is not among them:
+# the data transforms use it.
+HEAVY_MODULES = ('torchnet', 'tensorboardX', 'torch.utils.tensorboard', 'torch.ao.quantization.quantize_fx',
+                 'onnxruntime', 'optimisation.training')
+
+# Modules imported on the way to inference, from the cheapest to the entry point
+DEFAULT_MODULES = ('torch', 'models', 'utils', 'optimisation.testing', 'main')
+
+_PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(repr((elapsed, [name for name in {heavy!r} if name in sys.modules])))
+"""
+
+
+def time_import(module, heavy_modules=HEAVY_MODULES):
+    """
+    Import `module` in a fresh interpreter, started in the repository root
+
+    Returns:
+        the import time, in seconds, and the heavy modules loaded by the import
+    """
+    result = subprocess.run([sys.executable, '-c', _PROBE.format(module=module, heavy=tuple(heavy_modules))],
+                            cwd=ROOT_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing '{module}' failed:\n{result.stderr}")
+    elapsed, loaded = eval(result.stdout.strip().splitlines()[-1])
+    return elapsed, loaded
+
+
+def benchmark(modules=DEFAULT_MODULES, repeat=5):
+    """Median import time, over `repeat` fresh interpreters, and the heavy modules loaded, per module"""
+    results = {}
+    for module in modules:
+        try:
+            runs = [time_import(module) for _ in range(repeat)]
+        except RuntimeError as error:
+            results[module] = {'error': str(error).splitlines()[-1]}
+            continue
+        results[module] = {'median_seconds': statistics.median(elapsed for elapsed, _ in runs),
+                           'min_seconds': min(elapsed for elapsed, _ in runs),
+                           'heavy_modules': runs[0][1]}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES, help="modules to import")
+    parser.add_argument('--repeat', type=int, default=5, help="fresh interpreters per module")
+    parser.add_argument('--json', help="file to write the results to")
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.modules, args.repeat)
+    for module, result in results.items():
+        if 'error' in result:
+            print(f"{module:<24} failed: {result['error']}")
+        else:
+            print(f"{module:<24} {result['median_seconds']:7.3f} s   heavy: {', '.join(result['heavy_modules']) or '-'}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
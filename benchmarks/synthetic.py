@@ -0,0 +1,69 @@
+"""Datasets of random images in the on-disk layouts of the Huawei datasets, of any size"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+# The classes, their directories in the original dataset, and the ISO range of the Huawei dataset
+CLASSES = ('building', 'foliage', 'text')
+CLASS_DIRS = {'building': 'Buildings', 'foliage': 'Foliage', 'text': 'Text'}
+ISO_RANGE = (100, 3200)
+
+
+def _save_random_image(rng, path, height, width):
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    Image.fromarray(image).save(path)
+
+
+def make_transformed_dataset(root_dir, num_originals=4, num_patches=3, size=32, seed=0):
+    """
+    Random images in the layout of the transformed dataset, `TransformedHuaweiDataset`:
+    `<original>/clean/<patch>.png`, `<original>/noisy/<patch>.png` and `Training_Info.csv`,
+    and the `dataset.csv` listing the patches for `CsvLoader`, like `utils/transform_data.py` writes
+
+    Args:
+        root_dir: directory to create the dataset in, which must not contain one already
+        num_originals: number of original images, of which the patches are crops
+        num_patches: number of patches per original image
+        size: height and width of the patches, or (height, width)
+    """
+    rng = np.random.default_rng(seed)
+    height, width = (size, size) if isinstance(size, int) else size
+    root_dir = Path(root_dir)
+    for original in range(num_originals):
+        for kind in ('clean', 'noisy'):
+            (root_dir / str(original) / kind).mkdir(parents=True)
+            for patch in range(num_patches):
+                _save_random_image(rng, root_dir / str(original) / kind / f'{patch}.png', height, width)
+    info = pd.DataFrame({'ISO_Info': rng.integers(*ISO_RANGE, num_originals),
+                         'Class_Info': [CLASSES[original % len(CLASSES)] for original in range(num_originals)]})
+    info.to_csv(root_dir / 'Training_Info.csv', index=False)
+    pd.DataFrame([(f'{original}/noisy/{patch}.png', f'{original}/clean/{patch}.png', row.ISO_Info, row.Class_Info)
+                  for original, row in enumerate(info.itertuples()) for patch in range(num_patches)],
+                 columns=['noisy_path', 'clean_path', 'iso', 'class']).to_csv(root_dir / 'dataset.csv', index=False)
+    return root_dir
+
+
+def make_huawei_dataset(root_dir, num_images=3, size=512, seed=0):
+    """
+    Random images in the layout of the original dataset, `HuaweiDataset`:
+    `<Class>/Clean/<name>`, `<Class>/Noisy/<name>` and `Training_Info.csv`
+
+    Args:
+        root_dir: directory to create the dataset in, which must not contain one already
+        num_images: number of image pairs
+        size: height and width of the images, or (height, width)
+    """
+    rng = np.random.default_rng(seed)
+    height, width = (size, size) if isinstance(size, int) else size
+    root_dir = Path(root_dir)
+    names, classes = [f'{image}.png' for image in range(num_images)], []
+    for image, name in enumerate(names):
+        classes.append(CLASSES[image % len(CLASSES)])
+        for kind in ('Clean', 'Noisy'):
+            (root_dir / CLASS_DIRS[classes[-1]] / kind).mkdir(parents=True, exist_ok=True)
+            _save_random_image(rng, root_dir / CLASS_DIRS[classes[-1]] / kind / name, height, width)
+    pd.DataFrame({'Name_Info': names, 'ISO_Info': rng.integers(*ISO_RANGE, num_images), 'Class_Info': classes}
+                 ).to_csv(root_dir / 'Training_Info.csv', index=False)
+    return root_dir
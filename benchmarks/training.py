@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Training throughput benchmark: runs a number of steps of `train`, or with --gan `train_gan`, for
+a run config, on a synthetic dataset in the layout of the transformed dataset, or on --data-dir,
+and reports the samples per second, the percentiles of the step time, and the fraction of it spent
+waiting for the data loader.
+
+    python -m benchmarks.training CONFIG [--gan] [--steps N] [--warmup N]
+                                  [--originals N] [--patches N] [--size S] [--data-dir DIR] [--json FILE]
+    python -m benchmarks.training --make-dataset DIR [--originals N] [--patches N] [--size S]
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from benchmarks.synthetic import make_transformed_dataset
+
+
+class TimedLoader:
+    """
+    The first `steps` batches of a data loader, recording for each the time spent waiting for it,
+    and the time from requesting it to requesting the next one, which is the time of the step
+    """
+    def __init__(self, loader, steps):
+        self.loader = loader
+        self.steps = steps
+        self.data_times = []
+        self.step_times = []
+        self.batch_sizes = []
+
+    def __len__(self):
+        return self.steps
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        requested = time.perf_counter()
+        for _ in range(self.steps):
+            try:
+                batch = next(batches)
+            except StopIteration:   # start another epoch
+                batches = iter(self.loader)
+                batch = next(batches)
+            received = time.perf_counter()
+            yield batch
+
+            if torch.cuda.is_initialized():   # wait for the step to finish on the GPU
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            self.data_times.append(received - requested)
+            self.step_times.append(end - requested)
+            self.batch_sizes.append(len(batch['noisy']))
+            requested = end
+
+
+def throughput(timed_loader, warmup=0):
+    """Samples per second, step time percentiles and data wait fraction of the steps after `warmup`"""
+    step_times = np.array(timed_loader.step_times[warmup:])
+    data_times = np.array(timed_loader.data_times[warmup:])
+    if len(step_times) == 0:
+        raise ValueError("No steps after the warmup")
+    return {
+        'steps': len(step_times),
+        'samples_per_second': sum(timed_loader.batch_sizes[warmup:]) / step_times.sum(),
+        **{f'step_ms_p{q}': float(np.percentile(step_times, q) * 1e3) for q in (50, 90, 99)},
+        'data_wait_fraction': float(data_times.sum() / step_times.sum()),
+    }
+
+
+def benchmark(args, steps=50, warmup=5, gan=False):
+    """
+    Train on `args.data_dir` for `warmup` + `steps` steps, set up like `main.py`, or like
+    `main_gan.py` with `gan`, without logging or checkpoints
+
+    Returns:
+        the throughput of the steps after the warmup, see `throughput`
+    """
+    import models
+    from optimisation import loss
+    from optimisation.training import train, train_gan
+    from utils import TransformedHuaweiDataset, transform_sample, loader_options
+    from utils.functions import apply_spectral_norm
+
+    torch.manual_seed(args.seed)
+    dataset = TransformedHuaweiDataset(root_dir=args.data_dir, transform=transform_sample)
+    # all the samples are trained on: the split does not change the throughput
+    loader = DataLoader(dataset, batch_size=args.train_batch_size, shuffle=True, **loader_options(args))
+    timed_loader = TimedLoader(loader, warmup + steps)
+
+    if not gan:
+        model = getattr(models, args.model)(args)
+        model = model.cuda() if args.cuda else model
+        optimizer = getattr(torch.optim, args.optim)(model.parameters(), lr=args.learning_rate)
+        criterion = getattr(loss, args.loss)(args) if args.args_to_loss else getattr(loss, args.loss)()
+        criterion = criterion.cuda() if args.cuda else criterion
+        train(args, timed_loader, model, criterion, optimizer, 0, None)
+    else:
+        generator = getattr(models, args.generator)(args)
+        discriminator = getattr(models, args.discriminator)(args)
+        apply_spectral_norm(generator)
+        apply_spectral_norm(discriminator)
+        generator = generator.cuda() if args.cuda else generator
+        discriminator = discriminator.cuda() if args.cuda else discriminator
+        gen_optimizer = torch.optim.Adam(generator.parameters(), lr=args.gen_learning_rate,
+                                         betas=(args.beta1, args.beta2))
+        disc_optimizer = torch.optim.Adam(discriminator.parameters(), lr=args.disc_learning_rate,
+                                          betas=(args.beta1, args.beta2))
+        content_criterion = getattr(loss, args.content_loss)(args) if args.args_to_loss \
+            else getattr(loss, args.content_loss)()
+        content_criterion = content_criterion.cuda() if args.cuda else content_criterion
+        adv_criterion = getattr(loss, args.adv_loss)()
+        train_gan(args, timed_loader, generator, discriminator, content_criterion, adv_criterion,
+                  gen_optimizer, disc_optimizer, 0, None)
+
+    return throughput(timed_loader, warmup)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', nargs='?', help="run config, e.g. run_configs/default.yaml")
+    parser.add_argument('--gan', action='store_true', help="train the generator and discriminator of the config")
+    parser.add_argument('--steps', type=int, default=50, help="steps to time")
+    parser.add_argument('--warmup', type=int, default=5, help="steps to run before timing")
+    parser.add_argument('--data-dir', help="transformed dataset to train on (default: a synthetic one)")
+    parser.add_argument('--make-dataset', metavar='DIR', help="only create a synthetic dataset in DIR")
+    parser.add_argument('--originals', type=int, default=16, help="original images of the synthetic dataset")
+    parser.add_argument('--patches', type=int, default=64, help="patches per original image")
+    parser.add_argument('--size', type=int, default=128, help="height and width of the patches")
+    parser.add_argument('--json', help="file to write the results to")
+    options = parser.parse_args(argv)
+
+    if options.make_dataset:
+        make_transformed_dataset(options.make_dataset, options.originals, options.patches, options.size)
+        return 0
+    if options.config is None:
+        parser.error("a config is required")
+
+    from utils import parse_arguments
+    args = parse_arguments(options.config)
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        if options.data_dir:
+            args.data_dir = Path(options.data_dir)
+        else:
+            print("==> Creating a synthetic dataset of {} x {} patches of {} pixels".format(
+                options.originals, options.patches, options.size))
+            args.data_dir = make_transformed_dataset(Path(temporary_dir) / 'transformed', options.originals,
+                                                     options.patches, options.size)
+        results = benchmark(args, options.steps, options.warmup, options.gan)
+
+    print("Samples per second: {:.1f}".format(results['samples_per_second']))
+    print("Step time: p50 {step_ms_p50:.1f} ms, p90 {step_ms_p90:.1f} ms, p99 {step_ms_p99:.1f} ms".format(**results))
+    print("Waiting for data: {:.1%} of the step time".format(results['data_wait_fraction']))
+    if options.json:
+        Path(options.json).write_text(json.dumps({'config': options.config, 'gan': options.gan, **results}, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 """Entry point"""
+from dataclasses import replace
 from sys import argv
 from pathlib import Path
 import random
@@ -8,12 +9,8 @@ import time
 import numpy as np
 import torch
 from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
 
-from optimisation.testing import test
-from optimisation.training import train, validate, evaluate
-from optimisation import loss
-from utils import TransformedHuaweiDataset, transform_sample, parse_arguments
+from utils import transform_sample, parse_arguments, loader_options
 import models
 
 
@@ -27,9 +24,32 @@ def main(args):
         torch.cuda.set_device(args.gpu_num)
 
     if args.test_data_dir:
+        from optimisation.testing import test
         test(args, transform_sample)
         return
 
+    # Training dependencies are only imported when training, so that inference starts quickly
+    from torch.utils.tensorboard import SummaryWriter
+    from optimisation.testing import quantize
+    from optimisation.training import train, validate, evaluate, evaluation_vgg_loss
+    from optimisation.distillation import Distiller, load_model
+    from optimisation import loss
+    from optimisation.summary import BackgroundSummaryWriter
+    from utils import TransformedHuaweiDataset
+
+    if args.prune_ratio > 0 and not args.resume:
+        raise ValueError("Pruning ranks the channels of a trained model: set `resume` to its checkpoint")
+
+    checkpoint = None
+    if args.resume:
+        print('==> Loading checkpoint')
+        checkpoint = torch.load(args.resume)
+        print('==> Checkpoint loaded')
+    # The settings of a pruned model being fine-tuned, which construct it and keep it from being pruned again
+    pruned_settings = checkpoint.get('pruned_settings') if checkpoint is not None else None
+    if pruned_settings is not None:
+        args = replace(args, **pruned_settings)
+
     # Create results path
     if args.save_dir:  # If specified
         save_path = Path(args.save_dir).resolve()
@@ -38,14 +58,14 @@ def main(args):
         save_path.parent.mkdir(exist_ok=True)
     save_path.mkdir()  # Will throw an exception if the path exists OR the parent path _doesn't_
 
-    kwargs = {'pin_memory': True} if args.cuda else {}
-
     print('\nMODEL SETTINGS: \n', args.asdict(), '\n')
     print("Random Seed: ", args.seed)
 
     # Save config
     torch.save(args, save_path / 'denoising.config')
     writer = SummaryWriter(str(save_path / 'summaries'))
+    if args.background_logging:
+        writer = BackgroundSummaryWriter(writer)
 
     # construct network from args
     model = getattr(models, args.model)(args)
@@ -60,28 +80,60 @@ def main(args):
     dataset = TransformedHuaweiDataset(root_dir=args.data_dir, transform=transform_sample)
     train_dataset, val_dataset = dataset.random_split(test_ratio=args.test_split,
                                                       data_subset=args.data_subset)
+    if isinstance(criterion, loss.VGGLoss) and args.cache_vgg_features:
+        criterion.cache_clean_features(len(dataset), args.vgg_feature_cache_file)
+    if isinstance(criterion, loss.EdgeAwareLoss) and args.cache_clean_edges:
+        criterion.cache_clean_edges(len(dataset))
 
     train_loader = DataLoader(train_dataset, batch_size=args.train_batch_size,
-                              shuffle=True, num_workers=args.workers, **kwargs)
+                              shuffle=True, **loader_options(args))
 
     val_loader = DataLoader(val_dataset, batch_size=args.test_batch_size,
-                            shuffle=False, num_workers=args.workers, **kwargs)
+                            shuffle=False, **loader_options(args))
 
     best_loss = np.inf
 
-    if args.resume:
-        print('==> Loading checkpoint')
-        checkpoint = torch.load(args.resume)
-        print('==> Checkpoint loaded')
-        if checkpoint is not None:
-            args.start_epoch = checkpoint['epoch'] + 1
-            best_loss = checkpoint['best_loss']
-            model.load_state_dict(checkpoint['model'])
-            optimizer.load_state_dict(checkpoint['optimizer'])
+    if checkpoint is not None:
+        args.start_epoch = checkpoint['epoch'] + 1
+        best_loss = checkpoint['best_loss']
+        model.load_state_dict(checkpoint['model'])
+
+    if args.prune_ratio > 0:
+        # Remove channels from the loaded model; the training below fine-tunes the pruned model
+        model, args = models.pruning.prune_channels(model, args, args.prune_ratio, args.prune_criterion,
+                                                    train_loader, args.prune_batches)
+        pruned_settings = {name: getattr(args, name) for name in models.pruning.PRUNED_SETTINGS}
+        args.start_epoch, best_loss = 0, np.inf
+        # The saved config constructs the pruned model
+        torch.save(args, save_path / 'denoising.config')
+        optimizer = getattr(torch.optim, args.optim)(model.parameters(), lr=args.learning_rate)
+        checkpoint = None   # the optimizer and distiller states belong to the unpruned model
+
+    distiller = None
+    if args.teacher:
+        print('==> Loading teacher')
+        teacher = load_model(args.teacher, args.cuda)
+        distiller = Distiller(teacher, model, criterion, args.distill_weight, args.distill_feature_weight,
+                              cache_size=len(dataset) if args.cache_teacher_outputs else 0)
+        distiller = distiller.cuda() if args.cuda else distiller
+        if distiller.adapter is not None:
+            optimizer.add_param_group({'params': distiller.adapter.parameters()})
+        if checkpoint is not None and 'distiller' in checkpoint:
+            distiller.load_state_dict(checkpoint['distiller'])
+
+    if checkpoint is not None:
+        # After the param group of the feature-matching adapter is added, which the state includes
+        optimizer.load_state_dict(checkpoint['optimizer'])
+
+    vgg_loss = evaluation_vgg_loss(args, criterion)
+
+    if args.quantize:
+        quantize(args, model, train_loader, val_loader, save_path, vgg_loss)
+        return
 
     if args.evaluate:
         # Evaluate model using PSNR and SSIM metrics
-        evaluate(args, model, val_loader)
+        evaluate(args, model, val_loader, vgg_loss)
         return
 
     for epoch in range(args.start_epoch, args.epochs):
@@ -89,7 +141,7 @@ def main(args):
 
         # Train
         print("===> Training on Epoch %d" % epoch)
-        train(args, train_loader, model, criterion, optimizer, epoch, writer)
+        train(args, train_loader, model, criterion, optimizer, epoch, writer, distiller)
 
         # Validate
         print("===> Validating on Epoch %d" % epoch)
@@ -106,10 +158,15 @@ def main(args):
             'optimizer': optimizer.state_dict(),
             'best_loss': best_loss
         }
+        if pruned_settings is not None:
+            checkpoint['pruned_settings'] = pruned_settings
+        if distiller is not None:
+            checkpoint['distiller'] = distiller.state_dict()
         save_checkpoint(checkpoint, model_filename, is_best, save_path)
+    writer.close()
 
     # Evaluate model using PSNR and SSIM metrics
-    evaluate(args, model, val_loader)
+    evaluate(args, model, val_loader, vgg_loss)
 
 
 def save_checkpoint(checkpoint, filename, is_best, save_path):
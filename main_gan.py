@@ -8,13 +8,8 @@ import time
 import numpy as np
 import torch
 from torch.utils.data import DataLoader
-from tensorboardX import SummaryWriter
 
-from optimisation.testing import test
-from optimisation.training import train, train_gan, validate, evaluate
-from optimisation import loss
-from utils import TransformedHuaweiDataset, transform_sample, parse_arguments
-from utils.functions import apply_spectral_norm
+from utils import transform_sample, parse_arguments, loader_options
 import models
 
 
@@ -28,9 +23,18 @@ def main(args):
         torch.cuda.set_device(args.gpu_num)
 
     if args.test_data_dir:
+        from optimisation.testing import test
         test(args, transform_sample)
         return
 
+    # Training dependencies are only imported when training, so that inference starts quickly
+    from tensorboardX import SummaryWriter
+    from optimisation.training import train, train_gan, validate, evaluate, evaluation_vgg_loss
+    from optimisation import loss
+    from optimisation.summary import BackgroundSummaryWriter
+    from utils import TransformedHuaweiDataset
+    from utils.functions import apply_spectral_norm
+
     # Create results path
     if args.save_dir:  # If specified
         save_path = Path(args.save_dir).resolve()
@@ -39,14 +43,14 @@ def main(args):
         save_path.parent.mkdir(exist_ok=True)
     save_path.mkdir()  # Will throw an exception if the path exists OR the parent path _doesn't_
 
-    kwargs = {'pin_memory': True} if args.cuda else {}
-
     print('\nMODEL SETTINGS: \n', args.asdict(), '\n')
     print("Random Seed: ", args.seed)
 
     # Save config
     torch.save(args, save_path / 'denoising.config')
     writer = SummaryWriter(save_path / 'summaries')
+    if args.background_logging:
+        writer = BackgroundSummaryWriter(writer)
 
     # generator
     generator = getattr(models, args.generator)(args)
@@ -75,10 +79,10 @@ def main(args):
                                                       data_subset=args.data_subset)
 
     train_loader = DataLoader(train_dataset, batch_size=args.train_batch_size,
-                              shuffle=True, num_workers=args.workers, **kwargs)
+                              shuffle=True, **loader_options(args))
 
     val_loader = DataLoader(val_dataset, batch_size=args.test_batch_size,
-                            shuffle=False, num_workers=args.workers, **kwargs)
+                            shuffle=False, **loader_options(args))
 
     best_loss = np.inf
 
@@ -94,9 +98,11 @@ def main(args):
             gen_optimizer.load_state_dict(checkpoint['gen_optimizer'])
             disc_optimizer.load_state_dict(checkpoint['disc_optimizer'])
 
+    vgg_loss = evaluation_vgg_loss(args, content_criterion)
+
     if args.evaluate:
         # Evaluate model using PSNR and SSIM metrics
-        evaluate(args, generator, val_loader)
+        evaluate(args, generator, val_loader, vgg_loss)
         return
 
     # pre-train generator
@@ -132,9 +138,10 @@ def main(args):
             'best_loss': best_loss
         }
         save_checkpoint(checkpoint, model_filename, is_best, save_path)
+    writer.close()
 
     # Evaluate model using PSNR and SSIM metrics
-    evaluate(args, generator, val_loader)
+    evaluate(args, generator, val_loader, vgg_loss)
 
 
 def save_checkpoint(checkpoint, filename, is_best, save_path):
@@ -1,5 +1,39 @@
-from .simple_cnn import *
-from .complex_cnn import *
-from .densenet import *
-from . import layers
-from . import complex_layers
+"""
+Denoising models, constructed by name with `getattr(models, args.model)(args)`.
+
+Architectures and submodules are imported on first access, so that importing the package does
+not load the code of every architecture, nor that of quantization, pruning or export.
+"""
+import importlib
+
+# Module defining each class exported by the package
+_REGISTRY = {
+    'SimpleCNN': 'simple_cnn',
+    'GatedCNN': 'simple_cnn',
+    'ComplexNet': 'complex_cnn',
+    'DenseGatedCNN': 'densenet',
+    'RDDB': 'densenet',
+    'ResidualDenseBlock': 'densenet',
+    'ConvLayer': 'layers',
+    'GatedConvLayer': 'layers',
+    'SelfAttention': 'layers',
+}
+
+_SUBMODULES = ('layers', 'complex_layers', 'container', 'fft', 'simple_cnn', 'complex_cnn', 'densenet',
+               'conversion', 'export', 'quantization', 'pruning', 'ensemble')
+
+__all__ = list(_REGISTRY)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'{__name__}.{name}')
+    if name in _REGISTRY:
+        value = getattr(importlib.import_module(f'{__name__}.{_REGISTRY[name]}'), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_REGISTRY) | set(_SUBMODULES))
@@ -30,7 +30,7 @@ class ComplexNet(nn.Module):
 
     def forward(self, x, c=None, class_labels=None):
         out = self.transformer.transform(x)
-        out = self.transformer.invert(self.model(out, c, class_labels))
+        out = self.transformer.invert(self.model(out, c, class_labels), x.shape[2:])
 
         if self.residual:   # learn noise residual
             out = out + x
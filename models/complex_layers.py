@@ -5,12 +5,15 @@ from numpy.random import RandomState
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from models.layers import ConvLayerParent
+from models.layers import ConvLayerParent, _fuse_gate_state_dict, _split_gate_state_dict
 
 
 class ComplexConv2d(nn.Module):
-
+    """
+    Convolution of complex inputs, [B, C, H, W] of a complex dtype, with complex weights
+    """
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1, bias=True):
         super().__init__()
 
@@ -19,44 +22,81 @@ class ComplexConv2d(nn.Module):
         self.kernel_size = kernel_size
         self.stride = stride
         self.padding = padding
-
-        self.conv_real = nn.Conv2d(in_channels, out_channels, kernel_size=kernel_size,
-                                   stride=stride, padding=padding, dilation=dilation, bias=False)
-        self.conv_im = nn.Conv2d(in_channels, out_channels, kernel_size=kernel_size,
-                                 stride=stride, padding=padding, dilation=dilation, bias=False)
+        self.dilation = dilation
 
         # initialize weights to be as independent as possible using the He criterion
-        weight_real, weight_im = _complex_he_init(self.conv_real.weight.shape)
-        self.conv_real.weight.data = weight_real
-        self.conv_im.weight.data = weight_im
+        weight_real, weight_im = _complex_he_init((out_channels, in_channels, kernel_size, kernel_size))
+        self.weight = nn.Parameter(torch.complex(weight_real, weight_im))
 
         if bias:
-            self.bias = nn.Parameter(torch.zeros(1, out_channels, 1, 1, 2))
+            self.bias = nn.Parameter(torch.zeros(out_channels, dtype=torch.cfloat))
         else:
             self.register_parameter('bias', None)
 
+    @staticmethod
+    def _upgrade_state_dict(state_dict, prefix):
+        """Convert, in place, the entries of a checkpoint saved before the port to complex dtypes"""
+        real_key, im_key = prefix + 'conv_real.weight', prefix + 'conv_im.weight'
+        if real_key in state_dict and im_key in state_dict:
+            state_dict[prefix + 'weight'] = torch.complex(state_dict.pop(real_key), state_dict.pop(im_key))
+        _upgrade_legacy_entry(state_dict, prefix + 'bias', (-1,))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self._upgrade_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def block_weight(self):
+        """
+        Real weight acting on input channels that interleave the real and imaginary parts,
+        [real_0, im_0, real_1, im_1, ...], and producing output channels interleaved the same way.
+        Each 2 x 2 block of channels is
+            [ W_real  -W_im   ]
+            [ W_im     W_real ]
+        """
+        weight_real, weight_im = self.weight.real, self.weight.imag
+        block = torch.stack([torch.stack([weight_real, -weight_im], dim=2),
+                             torch.stack([weight_im, weight_real], dim=2)], dim=1)   # [O, 2, I, 2, k, k]
+        return block.flatten(2, 3).flatten(0, 1)
+
     def forward(self, x):
         """
         if x = a + ib, y = c + id, then:
         xy = (a + ib)(c + id) = (ac - bd) + i(ad + bc)
+
+        All four products, and the bias, are computed by a single real convolution with the block weight.
+        A complex tensor in the channels last layout, viewed as real, is a channels last tensor with
+        interleaved real and imaginary channels, and the convolution keeps that layout: both
+        conversions are views, and only an input in another layout, such as the first, is copied.
         """
-        x_real, x_im = torch.unbind(x, dim=-1)
+        # [B, C, H, W] complex -> [B, 2C, H, W] real
+        x = x.contiguous(memory_format=torch.channels_last)
+        x = torch.view_as_real(x).movedim(-1, 2).flatten(1, 2)
+        bias = None if self.bias is None else torch.view_as_real(self.bias).flatten()
 
-        out_real = self.conv_real(x_real) - self.conv_im(x_im)
-        out_im = self.conv_im(x_real) + self.conv_real(x_im)
-        # Concatenate the real and imaginary values to form a complex matrix
-        out = torch.cat([out_real[..., None], out_im[..., None]], dim=-1)
+        out = F.conv2d(x, self.block_weight(), bias, self.stride, self.padding, self.dilation)
+        # [B, 2C, H, W] real -> [B, C, H, W] complex
+        out = out.contiguous(memory_format=torch.channels_last)   # the layout of the convolution already
+        return torch.view_as_complex(out.unflatten(1, (self.out_channels, 2)).movedim(2, -1))
 
-        if self.bias is not None:
-            out += self.bias
 
-        return out
+class ComplexReLU(nn.Module):
+    """ReLU applied separately to the real and imaginary parts"""
+
+    def __init__(self, inplace=False):
+        super().__init__()
+        self.inplace = inplace
+
+    def forward(self, x):
+        if self.inplace:
+            torch.view_as_real(x).relu_()
+            return x
+        return torch.view_as_complex(torch.view_as_real(x).relu())
 
 
 class ComplexConvLayer(ConvLayerParent):
 
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, dilation=1,
-                 layer_activation=nn.ReLU(inplace=True), num_norm_groups=0, num_classes=0,
+                 layer_activation=ComplexReLU(inplace=True), num_norm_groups=0, num_classes=0,
                  normalize=True, preserve_size=False):
         super().__init__(in_channels, out_channels, kernel_size, stride, padding, dilation,
                          layer_activation, num_norm_groups, num_classes, normalize, preserve_size)
@@ -102,8 +142,8 @@ class ComplexGatedConv2d(nn.Module):
                                                padding, dilation, bias=False)
             self.conv_gate = ComplexConv2d(in_channels, out_channels, kernel_size, stride,
                                            padding, dilation, bias=False)
-            self.cond_features_bias = nn.Parameter(torch.Tensor(1, out_channels, 1, 1, 2))
-            self.cond_gate_bias = nn.Parameter(torch.Tensor(1, out_channels, 1, 1, 2))
+            self.cond_features_bias = nn.Parameter(torch.empty(1, out_channels, 1, 1, dtype=torch.cfloat))
+            self.cond_gate_bias = nn.Parameter(torch.empty(1, out_channels, 1, 1, dtype=torch.cfloat))
             self.reset_parameters()
 
         if self.residual:
@@ -116,16 +156,32 @@ class ComplexGatedConv2d(nn.Module):
     def reset_parameters(self):
         stdv = 1. / math.sqrt(self.in_channels)
         if self.cond_features_bias is not None:
-            self.cond_features_bias.data.uniform_(-stdv, stdv)
+            torch.view_as_real(self.cond_features_bias.data).uniform_(-stdv, stdv)
         if self.cond_gate_bias is not None:
-            self.cond_gate_bias.data.uniform_(-stdv, stdv)
+            torch.view_as_real(self.cond_gate_bias.data).uniform_(-stdv, stdv)
+
+    _concat_dims = {'weight': 0, 'bias': 0}
+
+    @staticmethod
+    def _upgrade_state_dict(state_dict, prefix):
+        """Convert, in place, the entries of a checkpoint saved before the port to complex dtypes"""
+        for name in ('conv', 'conv_features', 'conv_gate'):
+            ComplexConv2d._upgrade_state_dict(state_dict, prefix + name + '.')
+        for name in ('cond_features_bias', 'cond_gate_bias'):
+            _upgrade_legacy_entry(state_dict, prefix + name, (1, -1, 1, 1))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Accept checkpoints saved from the fused variant
+        self._upgrade_state_dict(state_dict, prefix)
+        _split_gate_state_dict(state_dict, prefix, self._concat_dims)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x, c=None):
         """
         hi = σ(Wg,i ∗ xi + V^T g,ic) * activation(Wf,i ∗ xi + V^Tf,ic)
 
         Args:
-            x: input tensor, [B, C, H, W, 2]
+            x: input tensor, [B, C, H, W] of a complex dtype
             c: extra conditioning data (image ISO).
             In cases where c encodes spatial or sequential information (such as a sequence of linguistic features),
             the matrix products are replaced with convolutions.
@@ -137,15 +193,95 @@ class ComplexGatedConv2d(nn.Module):
         gate = self.conv_gate(x)
 
         if self.local_condition and c is not None:
-            c = c.view(-1, 1, 1, 1, 1)
+            c = c.view(-1, 1, 1, 1)
             features += (self.cond_features_bias * c)
             gate += (self.cond_gate_bias * c)
 
         if self.activation is not None:
             features = self.activation(features)
 
-        gate = self.sigmoid(gate)
-        out = features * gate
+        out = _gate(features, gate, self.sigmoid)
+
+        if self.residual:
+            residual = x
+            if self.downsample is not None:
+                residual = self.downsample(residual)
+            out += residual
+
+        return out
+
+
+class FusedComplexGatedConv2d(nn.Module):
+    """
+    Complex gated convolutional layer computing the features and the gate with a single
+    complex convolution of twice the output channels, which is then split in two.
+    Numerically equivalent to ComplexGatedConv2d, and loads its checkpoints (and vice versa).
+    """
+    def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, dilation=1,
+                 activation=None, local_condition=False, residual=True):
+        super().__init__()
+
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+        self.dilation = dilation
+        self.activation = activation
+        self.local_condition = local_condition
+        self.residual = residual
+
+        self.sigmoid = nn.Sigmoid()
+
+        # Output channels are [features, gate]. With conditioning data the bias is set to false
+        self.conv = ComplexConv2d(in_channels, 2 * out_channels, kernel_size, stride,
+                                  padding, dilation, bias=not local_condition)
+        if not local_condition:
+            self.register_parameter('cond_features_bias', None)
+            self.register_parameter('cond_gate_bias', None)
+        else:
+            self.cond_features_bias = nn.Parameter(torch.empty(1, out_channels, 1, 1, dtype=torch.cfloat))
+            self.cond_gate_bias = nn.Parameter(torch.empty(1, out_channels, 1, 1, dtype=torch.cfloat))
+            self.reset_parameters()
+
+        if self.residual:
+            self.downsample = None
+            if stride != 1 or in_channels != out_channels:
+                self.downsample = nn.Sequential(
+                    ComplexConv2d(in_channels, out_channels, kernel_size=1, stride=stride),
+                )
+
+    reset_parameters = ComplexGatedConv2d.reset_parameters
+    _concat_dims = ComplexGatedConv2d._concat_dims
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Accept checkpoints saved from the two-convolution variant
+        ComplexGatedConv2d._upgrade_state_dict(state_dict, prefix)
+        _fuse_gate_state_dict(state_dict, prefix, self._concat_dims)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, c=None):
+        """
+        Args:
+            x: input tensor, [B, C, H, W] of a complex dtype
+            c: extra conditioning data (image ISO)
+
+        Returns:
+            layer activations, hi
+        """
+        out = self.conv(x)
+
+        if self.local_condition and c is not None:
+            cond_bias = torch.cat([self.cond_features_bias, self.cond_gate_bias], dim=1)
+            out = out + cond_bias * c.view(-1, 1, 1, 1)
+
+        features = out[:, :self.out_channels]
+        gate = out[:, self.out_channels:]
+
+        if self.activation is not None:
+            features = self.activation(features)
+
+        out = _gate(features, gate, self.sigmoid)
 
         if self.residual:
             residual = x
@@ -159,18 +295,20 @@ class ComplexGatedConv2d(nn.Module):
 class ComplexGatedConvLayer(ConvLayerParent):
 
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, dilation=1,
-                 conv_activation=None, layer_activation=nn.ReLU(inplace=True), local_condition=False,
+                 conv_activation=None, layer_activation=ComplexReLU(inplace=True), local_condition=False,
                  conv_residual=True, num_norm_groups=0, num_classes=0,
-                 normalize=True, preserve_size=False):
+                 normalize=True, preserve_size=False, fused=False):
         super().__init__(in_channels, out_channels, kernel_size, stride, padding, dilation,
                          layer_activation, num_norm_groups, num_classes, normalize, preserve_size)
 
         self.conv_activation = conv_activation
         self.local_condition = local_condition
         self.conv_residual = conv_residual
+        self.fused = fused
 
-        self.conv = ComplexGatedConv2d(in_channels, out_channels, kernel_size, stride, self.padding, dilation,
-                                       conv_activation, local_condition, conv_residual)
+        gated_conv = FusedComplexGatedConv2d if fused else ComplexGatedConv2d
+        self.conv = gated_conv(in_channels, out_channels, kernel_size, stride, self.padding, dilation,
+                               conv_activation, local_condition, conv_residual)
         self.norm = complex_norm(out_channels, num_classes) if normalize else None
 
     def forward(self, x, c=None, class_labels=None):
@@ -184,7 +322,12 @@ class ComplexGatedConvLayer(ConvLayerParent):
 
 
 class ComplexBatchNorm2d(nn.Module):
+    """
+    Complex batch normalization ('Deep Complex Networks', https://arxiv.org/pdf/1705.09792.pdf).
 
+    Whitening and the affine transform are combined into one channel-wise widely linear map,
+    out = alpha * x + alpha_conj * conj(x) + offset, which is applied in a single pass.
+    """
     def __init__(self, num_features, eps=1e-5, momentum=0.9, affine=True,
                  track_running_stats=True):
         super().__init__()
@@ -202,8 +345,7 @@ class ComplexBatchNorm2d(nn.Module):
             self.gamma_ii = nn.Parameter(torch.full(gamma_shape, fill_value=1.0 / math.sqrt(2)))
             self.gamma_ri = nn.Parameter(torch.zeros(gamma_shape))
             # centering
-            beta_shape = gamma_shape + (2,)
-            self.beta = nn.Parameter(torch.zeros(beta_shape))
+            self.beta = nn.Parameter(torch.zeros(gamma_shape, dtype=torch.cfloat))
         else:
             self.register_parameter('gamma_rr', None)
             self.register_parameter('gamma_ii', None)
@@ -230,62 +372,61 @@ class ComplexBatchNorm2d(nn.Module):
     def reset_running_stats(self):
         if self.track_running_stats:
             self.running_Vrr.fill_(1. / math.sqrt(2))
-            self.running_Vri.fill_(1. / math.sqrt(2))
-            self.running_Vii.zero_()
+            self.running_Vii.fill_(1. / math.sqrt(2))
+            self.running_Vri.zero_()
             self.running_mean_real.zero_()
             self.running_mean_im.zero_()
             self.num_batches_tracked.zero_()
 
-    @staticmethod
-    def _moving_average(new_value, running_mean, momentum):
-        return momentum * new_value + (1.0 - momentum) * running_mean
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the port to complex dtypes
+        _upgrade_legacy_entry(state_dict, prefix + 'beta', (1, -1, 1, 1))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
+    @torch.no_grad()
     def _update_stats(self, Vrr, Vii, Vri, mean_real, mean_im, momentum):
-        if self.affine:
-            self.running_Vrr = self._moving_average(Vrr, self.running_Vrr, momentum)
-            self.running_Vii = self._moving_average(Vii, self.running_Vii, momentum)
-            self.running_Vri = self._moving_average(Vri, self.running_Vri, momentum)
-            self.running_mean_real = self._moving_average(mean_real, self.running_mean_real, momentum)
-            self.running_mean_im = self._moving_average(mean_im, self.running_mean_im, momentum)
-
-    @staticmethod
-    def _channelwise_mean(tensor):
-        return tensor.mean(0, keepdim=True).mean(2, keepdim=True).mean(3, keepdim=True)
-
-    def complex_batch_norm(self, x, training=False, momentum=0.9):
-        x_real, x_im = torch.unbind(x, dim=-1)
-
+        # exponential moving average, momentum * new_value + (1 - momentum) * running_value
+        self.running_Vrr.lerp_(Vrr, momentum)
+        self.running_Vii.lerp_(Vii, momentum)
+        self.running_Vri.lerp_(Vri, momentum)
+        self.running_mean_real.lerp_(mean_real, momentum)
+        self.running_mean_im.lerp_(mean_im, momentum)
+
+    def whitening(self, x, training=False, momentum=0.9):
+        """
+        Returns:
+            the channel-wise mean and the entries Wrr, Wii, Wri of the whitening matrix,
+            each of shape [1, C, 1, 1]
+        """
         if training:
-            x_real_mean = self._channelwise_mean(x_real)
-            x_im_mean = self._channelwise_mean(x_im)
-            centered_real = x_real - x_real_mean
-            centered_im = x_im - x_im_mean
-            # Covariance matrices
-            Vrr = self._channelwise_mean(centered_real ** 2) + self.eps
-            Vii = self._channelwise_mean(centered_im ** 2) + self.eps
-            Vri = self._channelwise_mean(centered_real * centered_im)
-            # update moving averages
-            self._update_stats(Vrr, Vii, Vri, x_real_mean, x_im_mean, momentum)
+            mean_real, mean_im, Vrr, Vii, Vri = _channelwise_moments(x)
+            Vrr = Vrr + self.eps
+            Vii = Vii + self.eps
+            if self.track_running_stats:
+                self._update_stats(Vrr, Vii, Vri, mean_real, mean_im, momentum)
         else:
-            centered_real = x_real - self.running_mean_real
-            centered_im = x_im - self.running_mean_im
-            Vrr = self.running_Vrr
-            Vii = self.running_Vii
-            Vri = self.running_Vri
-
-        out_real, out_im = complex_standardization(centered_real, centered_im, Vrr, Vii, Vri)
+            mean_real, mean_im = self.running_mean_real, self.running_mean_im
+            Vrr, Vii, Vri = self.running_Vrr, self.running_Vii, self.running_Vri
 
-        if self.affine:
-            out_real = (self.gamma_rr * out_real + self.gamma_ri * out_im)
-            out_im = (self.gamma_ri * out_real + self.gamma_ii * out_im)
-            out = torch.cat([out_real[..., None], out_im[..., None]], dim=-1) + self.beta
-        else:
-            out = torch.cat([out_real[..., None], out_im[..., None]], dim=-1)
+        return (torch.complex(mean_real, mean_im),) + _inverse_sqrt_2x2(Vrr, Vii, Vri)
 
-        return out
+    def affine_matrix(self):
+        """
+        Entries Grr, Gri, Gir, Gii of the scaling applied after whitening:
+            out_real = gamma_rr * real + gamma_ri * im
+            out_im = gamma_ri * out_real + gamma_ii * im
+        """
+        if not self.affine:
+            return None
+        return _affine_matrix(self.gamma_rr, self.gamma_ii, self.gamma_ri)
 
-    def forward(self, x):
+    def complex_batch_norm(self, x, training=False, momentum=0.9):
+        mean, Wrr, Wii, Wri = self.whitening(x, training, momentum)
+        alpha, alpha_conj, offset = _widely_linear_coefficients(mean, Wrr, Wii, Wri,
+                                                                self.affine_matrix(), self.beta)
+        return _widely_linear(x, alpha, alpha_conj, offset)
 
+    def _exponential_average_factor(self):
         exponential_average_factor = 0.0
 
         if self.training and self.track_running_stats:
@@ -295,8 +436,39 @@ class ComplexBatchNorm2d(nn.Module):
             else:  # use exponential moving average
                 exponential_average_factor = self.momentum
 
+        return exponential_average_factor
+
+    def forward(self, x):
         return self.complex_batch_norm(x, self.training or not self.track_running_stats,
-                                       exponential_average_factor)
+                                       self._exponential_average_factor())
+
+    @torch.no_grad()
+    def fold(self):
+        """
+        Eval-time form of the layer: the running statistics and the affine transform
+        folded into a single ComplexAffine2d
+        """
+        if not self.track_running_stats:
+            raise ValueError("Only batch norms that track running statistics can be folded")
+        mean, Wrr, Wii, Wri = self.whitening(None)
+        alpha, alpha_conj, offset = _widely_linear_coefficients(mean, Wrr, Wii, Wri,
+                                                                self.affine_matrix(), self.beta)
+        return ComplexAffine2d(alpha, alpha_conj, offset)
+
+
+class ComplexAffine2d(nn.Module):
+    """
+    Channel-wise widely linear map of complex inputs, out = alpha * x + alpha_conj * conj(x) + offset.
+    This is the eval-time form of ComplexBatchNorm2d.
+    """
+    def __init__(self, alpha, alpha_conj, offset):
+        super().__init__()
+        self.register_buffer('alpha', alpha.detach().clone())
+        self.register_buffer('alpha_conj', alpha_conj.detach().clone())
+        self.register_buffer('offset', offset.detach().clone())
+
+    def forward(self, x):
+        return _widely_linear(x, self.alpha, self.alpha_conj, self.offset)
 
 
 class ComplexConditionalNorm(nn.Module):
@@ -312,21 +484,24 @@ class ComplexConditionalNorm(nn.Module):
         self.embed.weight.data[:, 3 * num_features:].zero_()    # Initialise bias at 0
 
     def forward(self, x, class_labels):
-        out_real, out_im = torch.unbind(self.norm(x), dim=-1)
+        mean, Wrr, Wii, Wri = self.norm.whitening(x, self.norm.training or not self.norm.track_running_stats,
+                                                  self.norm._exponential_average_factor())
+
         params = self.embed(class_labels)
         gammas = params[:, :3 * self.num_features]
         beta = params[:, 3 * self.num_features:].view(-1, self.num_features, 1, 1, 2)
+        beta = torch.complex(beta[..., 0], beta[..., 1])
 
         gamma_rr, gamma_ii, gamma_ri = gammas.chunk(3, 1)
         gamma_rr = gamma_rr.view(-1, self.num_features, 1, 1)
         gamma_ii = gamma_ii.view_as(gamma_rr)
         gamma_ri = gamma_rr.view_as(gamma_rr)
 
-        out_real = (gamma_rr * out_real + gamma_ri * out_im)
-        out_im = (gamma_ri * out_real + gamma_ii * out_im)
-        out = torch.cat([out_real[..., None], out_im[..., None]], dim=-1) + beta
+        # Per-sample coefficients, [B, C, 1, 1]
+        alpha, alpha_conj, offset = _widely_linear_coefficients(
+            mean, Wrr, Wii, Wri, _affine_matrix(gamma_rr, gamma_ii, gamma_ri), beta)
 
-        return out
+        return _widely_linear(x, alpha, alpha_conj, offset)
 
 
 def complex_norm(num_channels, num_classes=0):
@@ -336,10 +511,87 @@ def complex_norm(num_channels, num_classes=0):
         return ComplexBatchNorm2d(num_features=num_channels)
 
 
-def complex_standardization(centered_real, centered_im, Vrr, Vii, Vri):
+def _gate(features, gate, sigmoid):
+    """Gate the real and imaginary parts of the features separately"""
+    return torch.view_as_complex(torch.view_as_real(features) * sigmoid(torch.view_as_real(gate)))
+
+
+def _upgrade_legacy_entry(state_dict, key, shape):
+    """
+    Convert, in place, a state dict entry that stores complex values in a trailing
+    [real, imaginary] dimension, as saved before the port to complex dtypes
+    """
+    tensor = state_dict.get(key)
+    if tensor is not None and not tensor.is_complex():
+        state_dict[key] = torch.view_as_complex(tensor.reshape(-1, 2).contiguous()).view(shape)
+
+
+def _channelwise_moments(x):
+    """
+    Channel-wise means and (biased) covariances of the real and imaginary parts of x.
+    The covariances are taken of the centred samples, which keeps them accurate for inputs whose
+    mean is large against their spread, and all three come from one reduction of their products.
+
+    Returns:
+        mean_real, mean_im, Vrr, Vii, Vri, each of shape [1, C, 1, 1]
+    """
+    mean = x.mean(dim=(0, 2, 3), keepdim=True)
+    centered = torch.view_as_real(x - mean)
+    # products r * r, i * i and r * i of every sample, [B, C, H, W, 3]
+    covariances = (centered[..., [0, 1, 0]] * centered[..., [0, 1, 1]]).mean(dim=(0, 2, 3))
+    Vrr, Vii, Vri = (covariance.view(1, -1, 1, 1) for covariance in covariances.unbind(-1))
+
+    return mean.real, mean.imag, Vrr, Vii, Vri
+
+
+def _affine_matrix(gamma_rr, gamma_ii, gamma_ri):
+    """
+    Entries Grr, Gri, Gir, Gii of the matrix applying
+        out_real = gamma_rr * real + gamma_ri * im
+        out_im = gamma_ri * out_real + gamma_ii * im
+    Note that out_im uses the already scaled real part.
+    """
+    return gamma_rr, gamma_ri, gamma_ri * gamma_rr, gamma_ri ** 2 + gamma_ii
+
+
+def _widely_linear_coefficients(mean, Wrr, Wii, Wri, affine=None, beta=None):
+    """
+    Express out = G W (x - mean) + beta, for the real 2x2 matrices W (symmetric whitening)
+    and G (affine), as out = alpha * x + alpha_conj * conj(x) + offset.
+
+    The real matrix M = G W acting on [real, im] corresponds to
+        alpha = ((Mrr + Mii) + i(Mir - Mri)) / 2
+        alpha_conj = ((Mrr - Mii) + i(Mir + Mri)) / 2
+    """
+    if affine is None:
+        Mrr, Mri, Mir, Mii = Wrr, Wri, Wri, Wii
+    else:
+        Grr, Gri, Gir, Gii = affine
+        Mrr = Grr * Wrr + Gri * Wri
+        Mri = Grr * Wri + Gri * Wii
+        Mir = Gir * Wrr + Gii * Wri
+        Mii = Gir * Wri + Gii * Wii
+
+    alpha = torch.complex((Mrr + Mii) / 2, (Mir - Mri) / 2)
+    alpha_conj = torch.complex((Mrr - Mii) / 2, (Mir + Mri) / 2)
+    offset = -(alpha * mean + alpha_conj * mean.conj())
+    if beta is not None:
+        offset = offset + beta
+
+    return alpha, alpha_conj, offset
+
+
+def _widely_linear(x, alpha, alpha_conj, offset):
+    return torch.addcmul(offset, alpha, x).addcmul_(alpha_conj, x.conj())
+
+
+def _inverse_sqrt_2x2(Vrr, Vii, Vri):
     """
     The normalization procedure allows one to decorrelate the
-    imaginary and real parts of a unit
+    imaginary and real parts of a unit. This returns the entries Wrr, Wii, Wri of the
+    inverse square root of the covariance matrix, which whitens the centered values:
+        out_real = Wrr * centered_real + Wri * centered_im
+        out_im = Wri * centered_real + Wii * centered_im
     """
     # We require the covariance matrix's inverse square root. That first requires
     # square rooting, followed by inversion
@@ -366,10 +618,7 @@ def complex_standardization(centered_real, centered_im, Vrr, Vii, Vri):
     Wii = (Vrr + s) * inverse_st
     Wri = -Vri * inverse_st
 
-    out_real = Wrr * centered_real + Wri * centered_im
-    out_im = Wri * centered_real + Wii * centered_im
-
-    return out_real, out_im
+    return Wrr, Wii, Wri
 
 
 def _calculate_fan_in_and_fan_out(shape):
@@ -418,25 +667,25 @@ def _complex_he_init(shape):
 
 def _test_complex_conv2d():
     x = torch.randn(6, 3, 12, 12)
-    x_fourier = torch.rfft(x, onesided=True, signal_ndim=2)
+    x_fourier = torch.fft.rfft2(x)
     conv = ComplexConv2d(3, x.size(1), kernel_size=3, padding=1)
     out = conv(x_fourier)
-    out = torch.irfft(out, onesided=True, signal_ndim=2, signal_sizes=x.shape[2:])
+    out = torch.fft.irfft2(out, s=x.shape[2:])
     assert out.shape == x.shape
 
 
 def _test_complex_gated_conv2d():
     x = torch.randn(6, 3, 12, 12)
-    x_fourier = torch.rfft(x, onesided=True, signal_ndim=2)
+    x_fourier = torch.fft.rfft2(x)
     c = torch.randn(x.size(0))
     conv = ComplexGatedConv2d(x.size(1), 3, kernel_size=3, padding=1, local_condition=True)
     out = conv(x_fourier, c)
-    out = torch.irfft(out, onesided=True, signal_ndim=2, signal_sizes=x.shape[2:])
+    out = torch.fft.irfft2(out, s=x.shape[2:])
     assert out.shape == x.shape
 
 
 def _test_complex_batch_norm():
-    x = torch.randn(6, 3, 12, 12, 2)
+    x = torch.randn(6, 3, 12, 12, dtype=torch.cfloat)
     bn = ComplexBatchNorm2d(3).eval()
     out = bn(x)
     assert out.shape == x.shape
@@ -445,7 +694,7 @@ def _test_complex_batch_norm():
 
 
 def _test_complex_cond_batch_norm():
-    x = torch.randn(5, 16, 6, 6, 2)
+    x = torch.randn(5, 16, 6, 6, dtype=torch.cfloat)
     y = torch.randint(3, (x.size(0),)).long()
     bn = ComplexConditionalNorm(num_features=16, num_classes=3)
     out = bn(x, y)
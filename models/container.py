@@ -14,6 +14,6 @@ class SequentialMeta(nn.Module):
 
     def forward(self, x, *args):
         for layer in self.chain:
-            x = layer(x, args)
+            x = layer(x, *args)
         return x
 
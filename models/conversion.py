@@ -0,0 +1,271 @@
+"""Conversions between equivalent layouts of trained models"""
+import copy
+from collections import OrderedDict
+from inspect import signature
+
+import torch
+import torch.nn as nn
+
+from models.layers import (GatedConv2d, FusedGatedConv2d, GatedConvTranspose2d, FusedGatedConvTranspose2d,
+                           ConvLayerParent, ConvLayer, GatedConvLayer, ConditionalNorm, ClassConditionalConv2d, FoldedConvLayer,
+                           FoldedGatedConvLayer, _fuse_gate_state_dict)
+from models.complex_layers import ComplexGatedConv2d, FusedComplexGatedConv2d, ComplexBatchNorm2d
+from models.densenet import ResidualDenseBlock, RDDB
+
+
+_FUSED_GATED_CONVS = {
+    GatedConv2d: FusedGatedConv2d,
+    GatedConvTranspose2d: FusedGatedConvTranspose2d,
+    ComplexGatedConv2d: FusedComplexGatedConv2d,
+}
+_UNFUSED_GATED_CONVS = {fused: unfused for unfused, fused in _FUSED_GATED_CONVS.items()}
+
+
+def _convert_module(module, target_class, state_dict=None, **overrides):
+    """
+    Construct a `target_class` module with the hyperparameters of `module` and load its state.
+    Relies on the constructor arguments being stored as attributes of the same name.
+    """
+    kwargs = {name: getattr(module, name) for name in signature(target_class).parameters}
+    kwargs.update(overrides)
+    converted = target_class(**kwargs)
+    converted.load_state_dict(module.state_dict() if state_dict is None else state_dict)
+    parameter = next(module.parameters(), None)
+    if parameter is not None:
+        converted = converted.to(device=parameter.device, dtype=parameter.dtype)
+    return converted.train(module.training)
+
+
+def _replace_modules(model, conversions):
+    """Replace, in place, every submodule whose type is a key of `conversions`"""
+    if type(model) in conversions:
+        return _convert_module(model, conversions[type(model)])
+
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if type(child) in conversions:
+                setattr(module, name, _convert_module(child, conversions[type(child)]))
+    return model
+
+
+def fuse_gated_convs(model: nn.Module) -> nn.Module:
+    """
+    Replace every two-convolution gated layer of `model` with its fused variant,
+    which computes features and gate with a single convolution. Outputs are unchanged.
+    """
+    return _replace_modules(model, _FUSED_GATED_CONVS)
+
+
+def unfuse_gated_convs(model: nn.Module) -> nn.Module:
+    """
+    Inverse of `fuse_gated_convs`. The state dict of the returned model is
+    in the original two-convolution layout.
+    """
+    return _replace_modules(model, _UNFUSED_GATED_CONVS)
+
+
+def _norm_scale_shift(norm):
+    """
+    Channel-wise scale and shift, [num_classes, C], equivalent to a frozen normalization layer,
+    or None if the normalization depends on the input (e.g. group norm)
+    """
+    batch_norm = norm.norm if isinstance(norm, ConditionalNorm) else norm
+    if not isinstance(batch_norm, nn.BatchNorm2d) or batch_norm.running_var is None:
+        return None
+
+    inverse_std = (batch_norm.running_var + batch_norm.eps).rsqrt()
+    if isinstance(norm, ConditionalNorm):
+        gamma, beta = norm.embed.weight.chunk(2, 1)
+    elif batch_norm.affine:
+        gamma, beta = batch_norm.weight[None], batch_norm.bias[None]
+    else:
+        gamma, beta = torch.ones_like(inverse_std)[None], torch.zeros_like(inverse_std)[None]
+
+    scale = gamma * inverse_std
+    shift = beta - batch_norm.running_mean * scale
+    return scale, shift
+
+
+def _fold_conv_layer(layer, scale, shift):
+    conv = layer.conv
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(scale[0])
+    folded_conv = ClassConditionalConv2d(scale[..., None, None, None] * conv.weight, scale * bias + shift,
+                                         conv.stride, conv.padding, conv.dilation)
+    return FoldedConvLayer(folded_conv, layer.layer_activation)
+
+
+def _fold_gated_conv_layer(layer, scale, shift):
+    gated = layer.conv
+    state = gated.state_dict()
+    _fuse_gate_state_dict(state, '', GatedConv2d._concat_dims)  # no-op for the fused variant
+
+    # The scale applies to the features, but not to the gate
+    feature_scale = torch.cat([scale, torch.ones_like(scale)], dim=1)
+    bias = state.get('conv.bias', torch.zeros_like(feature_scale[0]))
+    conv = ClassConditionalConv2d(feature_scale[..., None, None, None] * state['conv.weight'],
+                                  feature_scale * bias, gated.stride, gated.padding, gated.dilation)
+
+    cond_bias = None
+    if gated.local_condition:
+        cond_bias = feature_scale * torch.cat([gated.cond_features_bias, gated.cond_gate_bias])
+
+    downsample, residual_scale = None, None
+    if gated.residual and gated.downsample is not None:
+        residual = gated.downsample[0]
+        downsample = ClassConditionalConv2d(scale[..., None, None, None] * residual.weight,
+                                            scale * residual.bias + shift, residual.stride)
+    elif gated.residual:
+        residual_scale = scale
+
+    return FoldedGatedConvLayer(conv, cond_bias, downsample, residual_scale, shift, layer.layer_activation)
+
+
+@torch.no_grad()
+def fold_norms(model: nn.Module) -> nn.Module:
+    """
+    Inference-time export: fold the frozen statistics of batch norms into the weights and biases
+    of the preceding convolutions. ConditionalNorm layers are folded into per-class weight banks,
+    selected by `class_labels`, and complex batch norms are replaced by their folded form.
+    Normalization that depends on the input, like group norm, is left unchanged.
+
+    The model is modified in place and switched to eval mode. Its outputs are unchanged.
+    """
+    model.eval()
+
+    def _fold(parent, layer):
+        # Complex batch norms inside a ComplexConditionalNorm provide only the whitening
+        if type(layer) is ComplexBatchNorm2d and isinstance(parent, ConvLayerParent) and layer.track_running_stats:
+            return layer.fold()
+        if type(layer) not in (ConvLayer, GatedConvLayer) or layer.norm is None:
+            return None
+        scale_shift = _norm_scale_shift(layer.norm)
+        if scale_shift is None:
+            return None
+        if type(layer) is ConvLayer:
+            return _fold_conv_layer(layer, *scale_shift)
+        if layer.conv.activation is None:   # otherwise the scale does not commute with the activation
+            return _fold_gated_conv_layer(layer, *scale_shift)
+        return None
+
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            folded = _fold(module, child)
+            if folded is not None:
+                setattr(module, name, folded)
+    return model
+
+
+_GATED_CONVS = tuple(_FUSED_GATED_CONVS) + tuple(_UNFUSED_GATED_CONVS)
+
+
+def _specialize_gated_conv(gated, c):
+    """Gated convolution with the conditioning biases for `c` baked into the convolution biases"""
+    state = gated.state_dict()
+    features_bias = state.pop('cond_features_bias').flatten() * c
+    gate_bias = state.pop('cond_gate_bias').flatten() * c
+    if 'conv.weight' in state:  # fused variant
+        state['conv.bias'] = torch.cat([features_bias, gate_bias])
+    else:
+        state['conv_features.bias'] = features_bias
+        state['conv_gate.bias'] = gate_bias
+    return _convert_module(gated, type(gated), state, local_condition=False)
+
+
+@torch.no_grad()
+def specialize_iso(model: nn.Module, c: float) -> nn.Module:
+    """
+    Specialize a model for a single value of the conditioning data, the normalized image ISO
+    (see `utils.normalize_iso`). Everything that depends on the ISO alone is constant-folded:
+    the conditioning biases of gated convolutions become convolution biases, and the learned
+    residual scalings of dense blocks become constants. The ISO passed to the returned model
+    is ignored.
+
+    Returns:
+        a specialized copy of `model`
+    """
+    model = copy.deepcopy(model)
+
+    def _specialize(layer):
+        if isinstance(layer, _GATED_CONVS) and layer.local_condition:
+            return _specialize_gated_conv(layer, c)
+        if isinstance(layer, FoldedGatedConvLayer) and layer.cond_bias is not None:
+            layer.conv.bias += layer.cond_bias * c
+            layer.cond_bias = None
+        elif isinstance(layer, (ResidualDenseBlock, RDDB)) and layer.cond_beta is not None:
+            beta = layer.cond_beta(layer.cond_beta.weight.new_full((1, 1), c)).sigmoid()
+            del layer.beta
+            layer.register_buffer('beta', beta[..., None, None])
+            layer.cond_beta = None
+        return None
+
+    specialized = _specialize(model)
+    if specialized is not None:
+        return specialized
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            specialized = _specialize(child)
+            if specialized is not None:
+                setattr(module, name, specialized)
+    return model
+
+
+class ISOSpecializedModel(nn.Module):
+    """
+    Runs batches in which every image shares the same ISO through a copy of the model
+    specialized for that ISO (see `specialize_iso`); other batches go through the model itself.
+    Specializations are created on first use and cached by ISO. The cache is dropped when the
+    wrapper is moved or cast, or loads a state dict.
+
+    With a grid, the ISO of a batch is first snapped to the nearest grid value, which bounds the
+    number of specializations at the cost of approximating the conditioning data. Without one,
+    only the `cache_size` most recently used specializations are kept.
+    """
+    def __init__(self, model, grid=None, cache_size=16):
+        """
+        Args:
+            model: model conditioned on the normalized image ISO
+            grid (optional): normalized ISO values to quantize to
+            cache_size: specializations to keep without a grid
+        """
+        super().__init__()
+        self.model = model
+        self.grid = None if grid is None else torch.as_tensor(grid, dtype=torch.float).flatten()
+        self.cache_size = cache_size
+        # not submodules: specializations are derived from, and saved as, the model
+        self._specializations = OrderedDict()
+
+    def clear(self):
+        """Drop the cached specializations, e.g. after the weights of the model have changed"""
+        self._specializations = OrderedDict()
+
+    def _apply(self, fn, *args, **kwargs):
+        self.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.clear()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def quantize(self, c):
+        if self.grid is None:
+            return c
+        return self.grid[(self.grid - c).abs().argmin()].item()
+
+    def specialization(self, c):
+        """The model specialized for the (normalized) ISO `c`"""
+        c = self.quantize(float(c))
+        if c in self._specializations:
+            self._specializations.move_to_end(c)
+        else:
+            self._specializations[c] = specialize_iso(self.model, c)
+            if self.grid is None and len(self._specializations) > self.cache_size:
+                self._specializations.popitem(last=False)
+        return self._specializations[c]
+
+    def forward(self, x, c=None, class_labels=None):
+        if c is None:
+            return self.model(x, c, class_labels)
+        c = c.flatten()
+        if not bool((c == c[0]).all()):
+            return self.model(x, c, class_labels)
+        return self.specialization(c[0].item())(x, None, class_labels)
@@ -1,33 +1,74 @@
 """DenseNet"""
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from models import ConvLayer, GatedConvLayer
+from models.layers import ConvLayer, GatedConv2d, FusedGatedConv2d, GatedConvLayer, SelfAttention
+
+
+def _input_conv(layer):
+    """
+    Weight and bias of the convolution with which a ConvLayer, or a GatedConvLayer without a
+    residual, reads its input: for a gated layer, that of [features, gate]
+    """
+    conv = layer.conv
+    if isinstance(conv, FusedGatedConv2d):
+        return conv.conv.weight, conv.conv.bias
+    if isinstance(conv, GatedConv2d):
+        bias = None
+        if conv.conv_features.bias is not None:
+            bias = torch.cat([conv.conv_features.bias, conv.conv_gate.bias])
+        return torch.cat([conv.conv_features.weight, conv.conv_gate.weight]), bias
+    return conv.weight, conv.bias
+
+
+def _input_weights(start, stop, *weights):
+    """
+    Weights with which convolutions read their input channels `start` to `stop`, concatenated
+    along the output channels. A leaf for torch.fx, so that quantization sees a weight it can
+    compute ahead of time, rather than the operations on it.
+    """
+    return torch.cat([weight[:, start:stop] for weight in weights])
+
+
+torch.fx.wrap('_input_weights')
+
+
+def _from_conv_output(layer, out, c):
+    """Output of a ConvLayer, or a GatedConvLayer without a residual, from that of its convolution"""
+    if isinstance(layer, GatedConvLayer):
+        out = layer.conv.gated(out, c)
+    if layer.layer_activation is not None:
+        out = layer.layer_activation(out)
+    return out
 
 
 class ResidualDenseBlock(nn.Module):
     """
     Residual Dense Block
     """
-    def __init__(self, nc, gc=32, kernel_size=3, local_condition=True, learn_beta=False, beta=0.2):
+    def __init__(self, nc, gc=32, kernel_size=3, local_condition=True, learn_beta=False, beta=0.2,
+                 fused=False):
         super().__init__()
+        # growth channels of each of the four dense convolutions
+        gc = [gc] * 4 if isinstance(gc, int) else list(gc)
 
-        self.conv1 = ConvLayer(nc, gc, kernel_size=kernel_size, normalize=False,
+        self.conv1 = ConvLayer(nc, gc[0], kernel_size=kernel_size, normalize=False,
                                layer_activation=nn.LeakyReLU(0.2))
-        self.conv2 = ConvLayer(nc + gc, gc, kernel_size=kernel_size, normalize=False,
+        self.conv2 = ConvLayer(nc + gc[0], gc[1], kernel_size=kernel_size, normalize=False,
                                layer_activation=nn.LeakyReLU(0.2))
-        self.conv3 = ConvLayer(nc + 2 * gc, gc, kernel_size=kernel_size, normalize=False,
+        self.conv3 = ConvLayer(nc + sum(gc[:2]), gc[2], kernel_size=kernel_size, normalize=False,
                                layer_activation=nn.LeakyReLU(0.2))
-        self.conv4 = ConvLayer(nc + 3 * gc, gc, kernel_size=kernel_size, normalize=False,
+        self.conv4 = ConvLayer(nc + sum(gc[:3]), gc[3], kernel_size=kernel_size, normalize=False,
                                layer_activation=nn.LeakyReLU(0.2))
 
         if learn_beta:
-            self.conv5 = ConvLayer(nc + 4 * gc, nc, kernel_size=kernel_size, normalize=False,
+            self.conv5 = ConvLayer(nc + sum(gc), nc, kernel_size=kernel_size, normalize=False,
                                    layer_activation=None)
         else:
-            self.conv5 = GatedConvLayer(nc + 4 * gc, nc, kernel_size=kernel_size,
+            self.conv5 = GatedConvLayer(nc + sum(gc), nc, kernel_size=kernel_size,
                                         local_condition=local_condition, conv_residual=False,
-                                        normalize=False, layer_activation=None)
+                                        normalize=False, layer_activation=None, fused=fused)
 
         self.beta = beta
         if learn_beta and local_condition:
@@ -35,12 +76,43 @@ class ResidualDenseBlock(nn.Module):
         else:
             self.register_parameter('cond_beta', None)
 
+    def _dense_convs(self, x, c):
+        """
+        Output of the last convolution, which, like each growth convolution, reads the
+        concatenation of the input and the outputs of the growth convolutions before it.
+
+        Rather than concatenating, which copies every earlier feature map again for every
+        convolution, the weights of the convolutions are split by the feature map they read:
+        each feature map is convolved once with the weights of the convolution that reads it
+        next, and once with those of all the later ones, the results of which are added up
+        until they are read. The two are separate so that what a layer keeps for backward is
+        not a view that holds on to the partial sums of the later layers.
+        """
+        layers = (self.conv1, self.conv2, self.conv3, self.conv4, self.conv5)
+        weights, biases = zip(*(_input_conv(layer) for layer in layers))
+        # the convolutions of a dense block share their kernel size
+        conv_args = [layers[0].stride] * 2, [layers[0].padding] * 2, [layers[0].dilation] * 2, 1
+        partial_sums = [None] * len(layers)
+        features, start = x, 0
+        for layer_no, layer in enumerate(layers):
+            stop = start + features.size(1)
+            if layer_no + 1 < len(layers):
+                later = F.conv2d(features, _input_weights(start, stop, *weights[layer_no + 1:]), None, *conv_args)
+                # indexed rather than iterated over, for torch.fx
+                parts = later.split([weight.size(0) for weight in weights[layer_no + 1:]], 1)
+                for part_no, reader_no in enumerate(range(layer_no + 1, len(layers))):
+                    partial_sums[reader_no] = parts[part_no] if partial_sums[reader_no] is None \
+                        else partial_sums[reader_no] + parts[part_no]
+
+            out = F.conv2d(features, _input_weights(start, stop, weights[layer_no]), biases[layer_no], *conv_args)
+            if partial_sums[layer_no] is not None:
+                out = out + partial_sums[layer_no]
+            features = _from_conv_output(layer, out, c)
+            start = stop
+        return features
+
     def forward(self, x, c=None, class_labels=None):
-        x1 = self.conv1(x, c)
-        x2 = self.conv2(torch.cat((x, x1), 1), c)
-        x3 = self.conv3(torch.cat((x, x1, x2), 1), c)
-        x4 = self.conv4(torch.cat((x, x1, x2, x3), 1), c)
-        x5 = self.conv5(torch.cat((x, x1, x2, x3, x4), 1), c)
+        x5 = self._dense_convs(x, c)
 
         if self.cond_beta is not None:
             beta = self.cond_beta(c.view(-1, 1)).sigmoid()[..., None][..., None]
@@ -54,12 +126,15 @@ class RDDB(nn.Module):
     """
     Residual in Residual Dense Block
     """
-    def __init__(self, nc, gc=32, kernel_size=3, local_condition=True, learn_beta=False, beta=0.2):
+    def __init__(self, nc, gc=32, kernel_size=3, local_condition=True, learn_beta=False, beta=0.2,
+                 fused=False):
         super().__init__()
+        # growth channels of each of the three dense blocks
+        gc = [gc] * 3 if isinstance(gc, int) else gc
 
-        self.rdb1 = ResidualDenseBlock(nc, gc, kernel_size, local_condition, learn_beta, beta)
-        self.rdb2 = ResidualDenseBlock(nc, gc, kernel_size, local_condition, learn_beta, beta)
-        self.rdb3 = ResidualDenseBlock(nc, gc, kernel_size, local_condition, learn_beta, beta)
+        self.rdb1 = ResidualDenseBlock(nc, gc[0], kernel_size, local_condition, learn_beta, beta, fused)
+        self.rdb2 = ResidualDenseBlock(nc, gc[1], kernel_size, local_condition, learn_beta, beta, fused)
+        self.rdb3 = ResidualDenseBlock(nc, gc[2], kernel_size, local_condition, learn_beta, beta, fused)
 
         self.beta = beta
         if learn_beta and local_condition:
@@ -87,18 +162,23 @@ class DenseGatedCNN(nn.Module):
     """
     def __init__(self, args):
         super().__init__()
-        gc = 32
+        # Growth channels of the dense convolutions: 32, unless set per dense block, e.g. by pruning
+        growth_channels = args.dense_growth_channels
         # Input layer
         layers = [ConvLayer(args.cnn_in_channels, args.cnn_hidden_channels, normalize=False,
                             layer_activation=None)]
 
         # Hidden layers
-        for _ in range(args.cnn_hidden_layers):
+        for layer_no in range(args.cnn_hidden_layers):
+            gc = 32 if growth_channels is None else growth_channels[3 * layer_no:3 * layer_no + 3]
             layers.append(RDDB(args.cnn_hidden_channels, gc, local_condition=args.iso,
-                               learn_beta=args.learn_beta, beta=0.2))
+                               learn_beta=args.learn_beta, beta=0.2, fused=args.fused_gates))
         # Output layer
         layers.append(ConvLayer(args.cnn_hidden_channels, args.cnn_in_channels, normalize=False,
                                 layer_activation=None))
+        if args.self_attention:  # halfway through the hidden layers
+            layers.insert(1 + args.cnn_hidden_layers // 2,
+                          SelfAttention(args.cnn_hidden_channels, window_size=args.attention_window))
         self.model = nn.ModuleList(layers)
 
         # init
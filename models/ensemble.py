@@ -0,0 +1,80 @@
+"""Inference with several weight sets of one architecture at once"""
+import copy
+
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+
+from models.simple_cnn import SimpleCNN, GatedCNN
+from models.densenet import DenseGatedCNN
+
+_STACKABLE = (SimpleCNN, GatedCNN, DenseGatedCNN)
+
+
+class StackedModels(nn.Module):
+    """
+    Models of the same architecture and settings, e.g. the checkpoints of a training run, run as
+    one: their parameters and buffers are stacked along a new first dimension, and the forward
+    is vectorized over it with `torch.func.vmap`, so that a batch goes through all the models in
+    one forward rather than one per model. Convolutions become grouped convolutions, which pays
+    off on GPUs; on CPUs they can be slower than a loop over the models.
+    For inference: the models are put in eval mode, and the stacked weights are not trained.
+    """
+    def __init__(self, models, chunk_size=None):
+        """
+        Args:
+            models: models to stack, of the same class and settings
+            chunk_size: number of models to run at once (default: all), to bound the memory
+        """
+        super().__init__()
+        models = [model.eval() for model in models]
+        if not models:
+            raise ValueError("No models to stack")
+        if not isinstance(models[0], _STACKABLE) or any(type(model) is not type(models[0]) for model in models):
+            raise ValueError("Only models of one class out of {} can be stacked".format(
+                ', '.join(cls.__name__ for cls in _STACKABLE)))
+
+        params, buffers = stack_module_state(models)
+        self.chunk_size = chunk_size
+        self.num_models = len(models)
+        # The stacked weights are buffers of this module, so that they move with it
+        self._param_names, self._buffer_names = list(params), list(buffers)
+        for index, tensor in enumerate([*params.values(), *buffers.values()]):
+            self.register_buffer(f'stacked_{index}', tensor.detach())
+        # Structure without weights, for torch.func.functional_call; not a submodule, so that
+        # moving this module leaves it on the meta device
+        object.__setattr__(self, 'architecture', copy.deepcopy(models[0]).to('meta'))
+
+    @classmethod
+    def from_checkpoints(cls, args, checkpoint_paths, chunk_size=None):
+        """Stack the models of checkpoints saved by `main.py`, constructed from `args`"""
+        architectures = {architecture.__name__: architecture for architecture in _STACKABLE}
+        if args.model not in architectures:
+            raise ValueError(f"{args.model} models can not be stacked")
+        stacked = []
+        for path in checkpoint_paths:
+            model = architectures[args.model](args)
+            model.load_state_dict(torch.load(path, map_location='cpu')['model'])
+            stacked.append(model)
+        return cls(stacked, chunk_size)
+
+    def _stacked_state(self):
+        num_tensors = len(self._param_names) + len(self._buffer_names)
+        tensors = (getattr(self, f'stacked_{index}') for index in range(num_tensors))
+        params = {name: next(tensors) for name in self._param_names}
+        buffers = {name: next(tensors) for name in self._buffer_names}
+        return params, buffers
+
+    def forward(self, noisy, iso=None, class_labels=None):
+        """
+        Returns:
+            the outputs of every model, [num_models, B, C, H, W]
+        """
+        def _forward(params, buffers):
+            return functional_call(self.architecture, (params, buffers), (noisy, iso, class_labels))
+
+        return vmap(_forward, chunk_size=self.chunk_size)(*self._stacked_state())
+
+    def ensemble(self, noisy, iso=None, class_labels=None):
+        """Mean of the outputs of the models, as for a snapshot ensemble"""
+        return self(noisy, iso, class_labels).mean(0)
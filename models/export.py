@@ -0,0 +1,61 @@
+"""Export of trained models to ONNX, and inference on the exported graphs with ONNX Runtime"""
+import torch
+import torch.nn as nn
+
+INPUT_NAMES = ('noisy', 'iso', 'class_labels')
+OUTPUT_NAME = 'denoised'
+
+
+def export_onnx(model: nn.Module, path, in_channels: int = 3):
+    """
+    Export a model to ONNX, with the noisy images, [B, C, H, W], normalized ISOs, [B, 1], and
+    class labels, [B], as inputs. The batch size, height and width are dynamic.
+    The models take all three inputs, even when they ignore the ISO or the class.
+
+    Uses the torch.export based exporter, which requires PyTorch >= 2.5 and onnxscript.
+    Normalization must not be folded beforehand: folded class-conditional convolutions
+    specialize on the batch size.
+
+    Args:
+        model: model to export, in eval mode
+        path: file to write the ONNX graph to
+        in_channels: number of channels of the images
+    """
+    if any(parameter.is_complex() for parameter in model.parameters()):
+        raise ValueError("Complex-valued models can not be exported to ONNX")
+
+    from torch.export import Dim
+
+    parameter = next(model.parameters())
+    example_inputs = (torch.rand(2, in_channels, 16, 16, device=parameter.device),
+                      torch.zeros(2, 1, device=parameter.device),
+                      torch.zeros(2, dtype=torch.long, device=parameter.device))
+    batch = Dim('batch')
+    dynamic_shapes = ({0: batch, 2: Dim('height'), 3: Dim('width')}, {0: batch}, {0: batch})
+    torch.onnx.export(model, example_inputs, str(path), input_names=list(INPUT_NAMES),
+                      output_names=[OUTPUT_NAME], dynamic_shapes=dynamic_shapes, dynamo=True)
+
+
+class OnnxRuntimeModel:
+    """
+    A model exported by `export_onnx`, run on CPU with ONNX Runtime. It is called like the
+    PyTorch model, with tensors, and needs neither the model code nor the checkpoint.
+    """
+    def __init__(self, path, num_threads=0):
+        """
+        Args:
+            path: ONNX file written by `export_onnx`
+            num_threads: number of threads per operator, 0 lets ONNX Runtime decide
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+        self.input_names = {graph_input.name for graph_input in self.session.get_inputs()}
+
+    def __call__(self, noisy, iso=None, class_labels=None):
+        inputs = dict(zip(INPUT_NAMES, (noisy, iso, class_labels)))
+        feeds = {name: value.cpu().numpy() for name, value in inputs.items() if name in self.input_names}
+        denoised, = self.session.run([OUTPUT_NAME], feeds)
+        return torch.from_numpy(denoised)
@@ -5,9 +5,10 @@ class FourierTransformerReal:
 
     def __init__(self, signal_dim=2):
         self.signal_dim = signal_dim
+        self.dims = tuple(range(-signal_dim, 0))
 
     def transform(self, x):
-        return torch.rfft(x, signal_ndim=self.signal_dim)
+        return torch.fft.rfftn(x, dim=self.dims)
 
-    def invert(self, x):
-        return torch.irfft(x, signal_ndim=self.signal_dim, signal_sizes=x.shape[2:])
+    def invert(self, x, signal_sizes):
+        return torch.fft.irfftn(x, s=signal_sizes, dim=self.dims)
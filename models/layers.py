@@ -2,6 +2,7 @@ import math
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 def norm(num_channels, num_norm_groups, num_classes=0):
@@ -15,6 +16,47 @@ def norm(num_channels, num_norm_groups, num_classes=0):
         return nn.BatchNorm2d(num_features=num_channels)
 
 
+def _conditioning_bias(c, *cond_biases):
+    """
+    Per-sample bias, [B, C, 1, 1], from the concatenated channel biases, [C_i], and the
+    conditioning data, [B, 1]. A leaf for torch.fx, so that quantization keeps this small
+    computation in floating point.
+    """
+    return (torch.cat(cond_biases) * c.view(-1, 1))[..., None, None]
+
+
+torch.fx.wrap('_conditioning_bias')
+
+
+def _fuse_gate_state_dict(state_dict, prefix, concat_dims):
+    """
+    Merge the `conv_features` and `conv_gate` entries of a two-convolution gated layer
+    into the `conv` entries of its fused counterpart. Modifies `state_dict` in place.
+
+    Args:
+        concat_dims: maps each parameter name of the convolution to the output channel dimension
+    """
+    for name, dim in concat_dims.items():
+        features_key = prefix + 'conv_features.' + name
+        gate_key = prefix + 'conv_gate.' + name
+        if features_key in state_dict and gate_key in state_dict:
+            state_dict[prefix + 'conv.' + name] = torch.cat([state_dict.pop(features_key),
+                                                             state_dict.pop(gate_key)], dim)
+
+
+def _split_gate_state_dict(state_dict, prefix, concat_dims):
+    """
+    Inverse of `_fuse_gate_state_dict`: split the `conv` entries of a fused gated layer
+    into `conv_features` and `conv_gate` entries. Modifies `state_dict` in place.
+    """
+    for name, dim in concat_dims.items():
+        key = prefix + 'conv.' + name
+        if key in state_dict:
+            features, gate = state_dict.pop(key).chunk(2, dim)
+            state_dict[prefix + 'conv_features.' + name] = features
+            state_dict[prefix + 'conv_gate.' + name] = gate
+
+
 class ConvLayerParent(nn.Module):
 
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, dilation=1,
@@ -116,6 +158,29 @@ class GatedConv2d(nn.Module):
         if self.cond_gate_bias is not None:
             self.cond_gate_bias.data.uniform_(-stdv, stdv)
 
+    _concat_dims = {'weight': 0, 'bias': 0}
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Accept checkpoints saved from the fused variant
+        _split_gate_state_dict(state_dict, prefix, self._concat_dims)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def gated(self, out, c=None):
+        """
+        Gated activations, without the residual, from the output of the convolutions,
+        [features, gate], concatenated along the channels
+        """
+        if self.local_condition and c is not None:
+            out = out + _conditioning_bias(c, self.cond_features_bias, self.cond_gate_bias)
+
+        features = out[:, :self.out_channels]
+        gate = out[:, self.out_channels:]
+
+        if self.activation is not None:
+            features = self.activation(features)
+
+        return features * self.sigmoid(gate)
+
     def forward(self, x, c=None):
         """
         hi = σ(Wg,i ∗ xi + V^T g,ic) * activation(Wf,i ∗ xi + V^Tf,ic)
@@ -152,21 +217,92 @@ class GatedConv2d(nn.Module):
         return out
 
 
+class FusedGatedConv2d(nn.Module):
+    """
+    Gated convolutional layer computing the features and the gate with a single
+    convolution of twice the output channels, which is then split in two.
+    Numerically equivalent to GatedConv2d, and loads its checkpoints (and vice versa).
+    """
+    def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, dilation=1,
+                 activation=None, local_condition=False, residual=True):
+        super().__init__()
+
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+        self.dilation = dilation
+        self.activation = activation
+        self.local_condition = local_condition
+        self.residual = residual
+
+        self.sigmoid = nn.Sigmoid()
+
+        # Output channels are [features, gate]. With conditioning data the bias is set to false
+        self.conv = nn.Conv2d(in_channels, 2 * out_channels, kernel_size, stride, self.padding, dilation,
+                              bias=not local_condition)
+        if not local_condition:
+            self.register_parameter('cond_features_bias', None)
+            self.register_parameter('cond_gate_bias', None)
+        else:
+            self.cond_features_bias = nn.Parameter(torch.Tensor(out_channels))
+            self.cond_gate_bias = nn.Parameter(torch.Tensor(out_channels))
+            self.reset_parameters()
+
+        if self.residual:
+            self.downsample = None
+            if stride != 1 or in_channels != out_channels:
+                self.downsample = nn.Sequential(
+                    nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=stride),
+                )
+
+    reset_parameters = GatedConv2d.reset_parameters
+    gated = GatedConv2d.gated
+    _concat_dims = GatedConv2d._concat_dims
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Accept checkpoints saved from the two-convolution variant
+        _fuse_gate_state_dict(state_dict, prefix, self._concat_dims)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, c=None):
+        """
+        Args:
+            x: input tensor, [B, C, H, W]
+            c: extra conditioning data (image ISO)
+
+        Returns:
+            layer activations, hi
+        """
+        out = self.gated(self.conv(x), c)
+
+        if self.residual:
+            residual = x
+            if self.downsample is not None:
+                residual = self.downsample(residual)
+            out += residual
+
+        return out
+
+
 class GatedConvLayer(ConvLayerParent):
 
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, dilation=1,
                  conv_activation=None, layer_activation=nn.ReLU(inplace=True), local_condition=False,
                  conv_residual=True, num_norm_groups=0, num_classes=0,
-                 normalize=True, preserve_size=False):
+                 normalize=True, preserve_size=False, fused=False):
         super().__init__(in_channels, out_channels, kernel_size, stride, padding, dilation,
                          layer_activation, num_norm_groups, num_classes, normalize, preserve_size)
 
         self.conv_activation = conv_activation
         self.local_condition = local_condition
         self.conv_residual = conv_residual
+        self.fused = fused
 
-        self.conv = GatedConv2d(in_channels, out_channels, kernel_size, stride, self.padding, dilation,
-                                conv_activation, local_condition, conv_residual)
+        gated_conv = FusedGatedConv2d if fused else GatedConv2d
+        self.conv = gated_conv(in_channels, out_channels, kernel_size, stride, self.padding, dilation,
+                               conv_activation, local_condition, conv_residual)
         self.norm = norm(out_channels, num_norm_groups, num_classes) if normalize else None
 
     def forward(self, x, c=None, class_labels=None):
@@ -229,6 +365,14 @@ class GatedConvTranspose2d(nn.Module):
         if self.cond_gate_bias is not None:
             self.cond_gate_bias.data.uniform_(-stdv, stdv)
 
+    # ConvTranspose2d weights are laid out as [in_channels, out_channels, H, W]
+    _concat_dims = {'weight': 1, 'bias': 0}
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Accept checkpoints saved from the fused variant
+        _split_gate_state_dict(state_dict, prefix, self._concat_dims)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x, c=None):
         """
         hi = σ(Wg,i ∗ xi + V^T g,ic) * activation(Wf,i ∗ xi + V^Tf,ic)
@@ -265,6 +409,84 @@ class GatedConvTranspose2d(nn.Module):
         return out
 
 
+class FusedGatedConvTranspose2d(nn.Module):
+    """
+    Transposed counterpart of FusedGatedConv2d, equivalent to GatedConvTranspose2d.
+    """
+    def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, output_padding=0, dilation=1,
+                 activation=None, local_condition=False, residual=True):
+        super().__init__()
+
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+        self.output_padding = output_padding
+        self.dilation = dilation
+        self.activation = activation
+        self.local_condition = local_condition
+        self.residual = residual
+
+        self.sigmoid = nn.Sigmoid()
+
+        # Output channels are [features, gate]. With conditioning data the bias is set to false
+        self.conv = nn.ConvTranspose2d(in_channels, 2 * out_channels, kernel_size, stride,
+                                       padding, output_padding, dilation=dilation, bias=not local_condition)
+        if not local_condition:
+            self.register_parameter('cond_features_bias', None)
+            self.register_parameter('cond_gate_bias', None)
+        else:
+            self.cond_features_bias = nn.Parameter(torch.Tensor(out_channels))
+            self.cond_gate_bias = nn.Parameter(torch.Tensor(out_channels))
+            self.reset_parameters()
+
+        if self.residual:
+            self.upsample = None
+            if stride != 1 or in_channels != out_channels:
+                self.upsample = nn.Sequential(
+                    nn.ConvTranspose2d(in_channels, out_channels, kernel_size=1, stride=stride),
+                )
+
+    reset_parameters = GatedConvTranspose2d.reset_parameters
+    _concat_dims = GatedConvTranspose2d._concat_dims
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Accept checkpoints saved from the two-convolution variant
+        _fuse_gate_state_dict(state_dict, prefix, self._concat_dims)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, c=None):
+        """
+        Args:
+            x: input tensor, [B, C, H, W]
+            c: extra conditioning data (image ISO)
+
+        Returns:
+            layer activations, hi
+        """
+        out = self.conv(x)
+
+        if self.local_condition and c is not None:
+            out = out + _conditioning_bias(c, self.cond_features_bias, self.cond_gate_bias)
+
+        features = out[:, :self.out_channels]
+        gate = out[:, self.out_channels:]
+
+        if self.activation is not None:
+            features = self.activation(features)
+
+        out = features * self.sigmoid(gate)
+
+        if self.residual:
+            residual = x
+            if self.upsample is not None:
+                residual = self.upsample(residual)
+            out += residual
+
+        return out
+
+
 class ResidualBLock(nn.Module):
 
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1,
@@ -342,38 +564,196 @@ class ConditionalNorm(nn.Module):
         return out
 
 
+class ClassConditionalConv2d(nn.Module):
+    """
+    Convolution with a separate weight and bias for each class, selected by `class_labels`.
+    Used for inference, where class-conditional normalization has been folded into the weights.
+    """
+    def __init__(self, weight, bias, stride=1, padding=0, dilation=1):
+        """
+        Args:
+            weight: weight bank, [num_classes, out_channels, in_channels, H, W]
+            bias: bias bank, [num_classes, out_channels]
+        """
+        super().__init__()
+        self.num_classes, self.out_channels, self.in_channels = weight.shape[:3]
+        self.stride = stride
+        self.padding = padding
+        self.dilation = dilation
+        self.register_buffer('weight', weight)
+        self.register_buffer('bias', bias)
+
+    def forward(self, x, class_labels=None):
+        if self.num_classes == 1:
+            return F.conv2d(x, self.weight[0], self.bias[0], self.stride, self.padding, self.dilation)
+
+        batch_size = x.size(0)
+        if batch_size == 1:
+            return F.conv2d(x, self.weight[class_labels[0]], self.bias[class_labels[0]],
+                            self.stride, self.padding, self.dilation)
+
+        # Convolve every sample with the weights of its class in one grouped convolution
+        weight = self.weight[class_labels].flatten(0, 1)
+        out = F.conv2d(x.reshape(1, -1, *x.shape[2:]), weight, self.bias[class_labels].flatten(),
+                       self.stride, self.padding, self.dilation, groups=batch_size)
+        return out.view(batch_size, self.out_channels, *out.shape[2:])
+
+
+def _select_class(bank, class_labels):
+    """Select the rows [num_classes, C] of `bank` for `class_labels`, broadcastable to [B, C, H, W]"""
+    if bank.size(0) == 1:
+        return bank.view(1, -1, 1, 1)
+    return bank[class_labels].unsqueeze(-1).unsqueeze(-1)
+
+
+class FoldedConvLayer(nn.Module):
+    """
+    Inference form of ConvLayer, with the normalization folded into the convolution
+    """
+    def __init__(self, conv, layer_activation=None):
+        super().__init__()
+        self.conv = conv
+        self.layer_activation = layer_activation
+
+    def forward(self, x, c=None, class_labels=None):
+        out = self.conv(x, class_labels)
+        if self.layer_activation is not None:
+            out = self.layer_activation(out)
+
+        return out
+
+
+class FoldedGatedConvLayer(nn.Module):
+    """
+    Inference form of GatedConvLayer, with the normalization folded into the weights.
+    The normalization scale is folded into the feature convolution and the residual path,
+    and its shift into the residual path:
+        norm(features * gate + residual) = (scale * features) * gate + (scale * residual + shift)
+    """
+    def __init__(self, conv, cond_bias=None, downsample=None, residual_scale=None, residual_shift=None,
+                 layer_activation=None):
+        """
+        Args:
+            conv: ClassConditionalConv2d producing [features, gate]
+            cond_bias: bank of conditioning biases for [features, gate], [num_classes, 2C]
+            downsample: ClassConditionalConv2d for the residual, if it is not the identity
+            residual_scale: bank of scales of an identity residual, [num_classes, C]
+            residual_shift: bank of shifts of an identity or missing residual, [num_classes, C]
+        """
+        super().__init__()
+        self.out_channels = conv.out_channels // 2
+        self.conv = conv
+        self.downsample = downsample
+        self.register_buffer('cond_bias', cond_bias)
+        self.register_buffer('residual_scale', residual_scale)
+        self.register_buffer('residual_shift', residual_shift)
+        self.layer_activation = layer_activation
+
+    def forward(self, x, c=None, class_labels=None):
+        out = self.conv(x, class_labels)
+
+        if self.cond_bias is not None and c is not None:
+            out = out + _select_class(self.cond_bias, class_labels) * c.view(-1, 1, 1, 1)
+
+        features = out[:, :self.out_channels]
+        gate = out[:, self.out_channels:].sigmoid()
+
+        if self.downsample is not None:
+            residual = self.downsample(x, class_labels)
+        elif self.residual_scale is not None:
+            residual = torch.addcmul(_select_class(self.residual_shift, class_labels),
+                                     _select_class(self.residual_scale, class_labels), x)
+        else:
+            residual = _select_class(self.residual_shift, class_labels)
+
+        out = torch.addcmul(residual, features, gate)
+        if self.layer_activation is not None:
+            out = self.layer_activation(out)
+
+        return out
+
+
 class SelfAttention(nn.Module):
-    """ Self attention Layer"""
-    def __init__(self, in_dim, activation):
+    """
+    Self attention layer, with memory linear in the number of pixels.
+    The (H*W) x (H*W) attention matrix is never materialized: attention is computed with
+    `scaled_dot_product_attention` over chunks of queries, or, with a window size, within
+    non-overlapping windows of window_size x window_size pixels.
+    """
+    def __init__(self, in_dim, activation=None, window_size=0, chunk_size=256):
+        """
+        Args:
+            in_dim: number of input channels
+            window_size: side of the windows to attend within; 0 attends over the whole image
+            chunk_size: number of queries attended with at once, when attending over the whole image
+        """
         super().__init__()
         self.chanel_in = in_dim
         self.activation = activation
+        self.window_size = window_size
+        self.chunk_size = chunk_size
 
         self.query_conv = nn.Conv2d(in_channels=in_dim, out_channels=in_dim // 8, kernel_size=1)
         self.key_conv = nn.Conv2d(in_channels=in_dim, out_channels=in_dim // 8, kernel_size=1)
         self.value_conv = nn.Conv2d(in_channels=in_dim, out_channels=in_dim, kernel_size=1)
         self.gamma = nn.Parameter(torch.zeros(1))
 
-        self.softmax = nn.Softmax(dim=-1)  #
+    def _to_windows(self, x):
+        """[B, C, H, W] -> [B * num_windows, window_size ** 2, C], for H and W multiples of the window size"""
+        batch_size, channels, height, width = x.shape
+        w = self.window_size
+        x = x.view(batch_size, channels, height // w, w, width // w, w).permute(0, 2, 4, 3, 5, 1)
+        return x.reshape(-1, w * w, channels)
+
+    def _from_windows(self, x, batch_size, height, width):
+        """Inverse of `_to_windows`"""
+        w = self.window_size
+        x = x.view(batch_size, height // w, width // w, w, w, -1).permute(0, 5, 1, 3, 2, 4)
+        return x.reshape(batch_size, -1, height, width)
+
+    def _attend(self, query, key, value, mask=None):
+        """Unscaled dot product attention, query: [B, N, C // 8], key: [B, M, C // 8], value: [B, M, C]"""
+        # as a single attention head, cancelling the scaling of scaled_dot_product_attention
+        query = query[:, None] * math.sqrt(query.size(-1))
+        key, value = key[:, None], value[:, None]
+        mask = None if mask is None else mask[:, None]
+        if torch.compiler.is_compiling():   # graph capture, e.g. for export, with a dynamic number of pixels
+            return F.scaled_dot_product_attention(query, key, value, attn_mask=mask)[:, 0]
+        return torch.cat([F.scaled_dot_product_attention(query_chunk, key, value, attn_mask=mask)[:, 0]
+                          for query_chunk in query.split(self.chunk_size, dim=2)], dim=1)
 
-    def forward(self, x):
-        """
-            inputs :
-                x : input feature maps( B X C X W X H)
-            returns :
-                out : self attention value + input feature
-                attention: B X N X N (N is Width*Height)
+    def forward(self, x, c=None, class_labels=None):
         """
-        m_batchsize, C, width, height = x.size()
-        proj_query = self.query_conv(x).view(m_batchsize, -1, width * height).permute(0, 2, 1)  # B X CX(N)
-        proj_key = self.key_conv(x).view(m_batchsize, -1, width * height)  # B X C x (*W*H)
-        energy = torch.bmm(proj_query, proj_key)  # transpose check
-        attention = self.softmax(energy)  # BX (N) X (N)
-        proj_value = self.value_conv(x).view(m_batchsize, -1, width * height)  # B X C X N
-
-        out = torch.bmm(proj_value, attention.permute(0, 2, 1))
-        out = out.view(m_batchsize, C, width, height)
-
-        out = self.gamma * out + x
+        Args:
+            x: input feature maps, [B, C, H, W]
 
-        return out
+        Returns:
+            self attention value + input feature
+        """
+        batch_size, channels, height, width = x.size()
+        if not self.window_size:
+            proj_query = self.query_conv(x).flatten(2).transpose(1, 2)  # B X N X C // 8 (N is H * W)
+            proj_key = self.key_conv(x).flatten(2).transpose(1, 2)
+            proj_value = self.value_conv(x).flatten(2).transpose(1, 2)  # B X N X C
+            out = self._attend(proj_query, proj_key, proj_value)
+            out = out.transpose(1, 2).view(batch_size, channels, height, width)
+            return self.gamma * out + x
+
+        # Pad to whole windows, and exclude the padding from the keys
+        w = self.window_size
+        padding = (0, -width % w, 0, -height % w)
+        padded = F.pad(x, padding)
+        mask = None
+        if torch.compiler.is_compiling() or any(padding):   # the padding is dynamic in captured graphs
+            mask = self._to_windows(F.pad(x.new_ones(1, 1, height, width), padding)).transpose(1, 2) > 0
+        padded_height, padded_width = padded.shape[2:]
+
+        proj_query = self._to_windows(self.query_conv(padded))
+        proj_key = self._to_windows(self.key_conv(padded))
+        proj_value = self._to_windows(self.value_conv(padded))
+        if mask is not None:
+            mask = mask.repeat(batch_size, 1, 1)
+        out = self._attend(proj_query, proj_key, proj_value, mask)
+        out = self._from_windows(out, batch_size, padded_height, padded_width)[..., :height, :width]
+
+        return self.gamma * out + x
@@ -0,0 +1,219 @@
+"""Structured channel pruning of trained models"""
+import copy
+
+import torch
+import torch.nn as nn
+
+from models.layers import GatedConv2d, FusedGatedConv2d, GatedConvLayer, SelfAttention, _split_gate_state_dict
+from models.conversion import _norm_scale_shift
+from models.simple_cnn import GatedCNN
+from models.densenet import ResidualDenseBlock, DenseGatedCNN
+
+
+# The settings that pruning changes: those that construct the pruned model, and the ratio, which
+# is reset so that the pruned model is not pruned again
+PRUNED_SETTINGS = ('cnn_hidden_channels', 'dense_growth_channels', 'prune_ratio')
+
+
+@torch.no_grad()
+def _mean_activations(model, modules, loader, num_batches):
+    """Mean absolute output, per channel, of each of `modules` while `model` runs on `loader`"""
+    totals = [0.] * len(modules)
+
+    def _hook(index):
+        def _accumulate(module, inputs, output):
+            totals[index] = totals[index] + output.abs().mean(dim=(0, 2, 3))
+        return _accumulate
+
+    handles = [module.register_forward_hook(_hook(index)) for index, module in enumerate(modules)]
+    device = next(model.parameters()).device
+    training = model.training
+    model.eval()
+    try:
+        num_seen = 0
+        for sample in loader:
+            if num_seen == num_batches:
+                break
+            model(sample['noisy'].to(device), sample['iso'].to(device),
+                  sample['class'].squeeze(-1).to(device))
+            num_seen += 1
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(training)
+
+    if num_seen == 0:
+        raise ValueError("The loader is empty")
+    return [total / num_seen for total in totals]
+
+
+def _gated_cnn_importance(model, criterion, loader, num_batches):
+    """
+    Importance of the hidden channels of a GatedCNN. The identity residuals of the hidden layers
+    carry every channel from layer to layer, so a channel is ranked over all of them.
+    """
+    hidden_layers = model.model[:-1]
+    if criterion == 'scale':
+        scales = [_norm_scale_shift(layer.norm) for layer in hidden_layers]
+        if any(scale is None for scale in scales):
+            raise ValueError("The `scale` criterion requires batch normalization")
+        return sum(scale.abs().amax(0) for scale, _ in scales)
+
+    # mean gate activations
+    gates = _mean_activations(model, [layer.conv.sigmoid for layer in hidden_layers], loader, num_batches)
+    return sum(gates)
+
+
+def _dense_block_importance(block, activations=None):
+    """
+    Importance of the channels of the four growth convolutions of a ResidualDenseBlock:
+    their magnitude, from the filter norms or measured `activations`, times how strongly the
+    following convolutions read them
+    """
+    convs = [block.conv1, block.conv2, block.conv3, block.conv4, block.conv5]
+    offset = block.conv1.in_channels
+    importance = []
+    for conv_no, layer in enumerate(convs[:-1]):
+        channels = slice(offset, offset + layer.out_channels)
+        reads = sum(_conv_weight(consumer)[:, channels].abs().sum(dim=(0, 2, 3))
+                    for consumer in convs[conv_no + 1:])
+        if activations is None:
+            magnitude = _conv_weight(layer).flatten(1).norm(dim=1)
+        else:
+            magnitude = activations[conv_no]
+        importance.append(magnitude * reads)
+        offset += layer.out_channels
+    return importance
+
+
+def _conv_weight(layer):
+    """Weight of a ConvLayer, or the feature weight of a GatedConvLayer"""
+    if isinstance(layer, GatedConvLayer):
+        if isinstance(layer.conv, FusedGatedConv2d):
+            return layer.conv.conv.weight[:layer.out_channels]
+        return layer.conv.conv_features.weight
+    return layer.conv.weight
+
+
+def _keep_top(importance, num_channels):
+    """Indices, in increasing order, of the `num_channels` most important channels"""
+    return importance.topk(num_channels).indices.sort().values
+
+
+def _pruned_layer_state(layer, in_index, out_index):
+    """
+    State dict of a ConvLayer or GatedConvLayer with only the input channels `in_index`
+    and output channels `out_index`, in the two-convolution layout for gated layers
+    """
+    state = layer.state_dict()
+    if isinstance(layer.conv, FusedGatedConv2d):
+        _split_gate_state_dict(state, 'conv.', GatedConv2d._concat_dims)
+
+    for key, value in state.items():
+        if key.endswith('embed.weight'):   # class-conditional [scales, shifts]
+            state[key] = value[:, torch.cat([out_index, layer.out_channels + out_index])]
+        elif value.dim() == 4:
+            state[key] = value[out_index][:, in_index]
+        elif value.dim() == 1:
+            state[key] = value[out_index]
+    return state
+
+
+def _replace_state(state, prefix, layer_state):
+    for key in [key for key in state if key.startswith(prefix)]:
+        del state[key]
+    state.update({prefix + key: value for key, value in layer_state.items()})
+
+
+def prune_channels(model: nn.Module, args, ratio: float, criterion: str = 'scale', loader=None,
+                   num_batches: int = 32):
+    """
+    Structured pruning: remove the least important channels of a trained GatedCNN or
+    DenseGatedCNN, from the weights of every layer that produces or consumes them, so that the
+    pruned model is smaller and faster. It should be fine-tuned afterwards.
+
+    GatedCNN: the hidden channels, shared by all hidden layers through their residual
+    connections, are ranked by the scales of the batch norms that follow each layer
+    (criterion `scale`), or the mean gate activations over `loader` (criterion `activation`).
+    DenseGatedCNN: the growth channels of the dense convolutions are ranked, across all dense
+    blocks, by their filter norms (`scale`) or mean absolute activations (`activation`), each
+    times the weights the following convolutions read them with. The number of channels kept
+    thus varies between layers.
+
+    Args:
+        model: model to prune; it is left unchanged
+        args: settings the model was constructed with
+        ratio: fraction of the prunable channels to remove
+        criterion: `scale` or `activation`
+        loader: loader of training samples for the `activation` criterion
+        num_batches: number of batches of `loader` to collect statistics on
+
+    Returns:
+        the pruned model, and the settings that construct it, with a `prune_ratio` of 0
+    """
+    if criterion not in ('scale', 'activation'):
+        raise ValueError(f"Unknown pruning criterion '{criterion}'")
+    if criterion == 'activation' and loader is None:
+        raise ValueError("The `activation` criterion requires a loader")
+
+    if any(isinstance(module, SelfAttention) for module in model.modules()):
+        raise ValueError("Pruning is not supported for models with self attention")
+
+    pruned_args = copy.copy(args)
+    pruned_args.prune_ratio = 0.
+    state = model.state_dict()
+
+    if type(model) is GatedCNN:
+        importance = _gated_cnn_importance(model, criterion, loader, num_batches)
+        kept = _keep_top(importance, max(1, round(len(importance) * (1 - ratio))))
+        pruned_args.cnn_hidden_channels = len(kept)
+
+        all_inputs = torch.arange(args.cnn_in_channels, device=kept.device)
+        for layer_no, layer in enumerate(model.model):
+            in_index = all_inputs if layer_no == 0 else kept
+            out_index = kept if layer_no < len(model.model) - 1 else all_inputs
+            _replace_state(state, f'model.{layer_no}.', _pruned_layer_state(layer, in_index, out_index))
+
+    elif type(model) is DenseGatedCNN:
+        blocks = [(name, module) for name, module in model.named_modules()
+                  if isinstance(module, ResidualDenseBlock)]
+        activations = [None] * len(blocks)
+        if criterion == 'activation':
+            # the outputs of the growth convolutions, which the blocks compute without calling them
+            outputs = [getattr(block, f'conv{conv_no}').layer_activation
+                       for _, block in blocks for conv_no in range(1, 5)]
+            means = _mean_activations(model, outputs, loader, num_batches)
+            activations = [means[4 * block_no:4 * block_no + 4] for block_no in range(len(blocks))]
+        importance = [_dense_block_importance(block, block_activations)
+                      for (_, block), block_activations in zip(blocks, activations)]
+
+        # Rank channels across layers, relative to the mean importance of their layer
+        relative = torch.cat([layer / layer.mean() for block in importance for layer in block])
+        threshold = relative.quantile(ratio)
+
+        pruned_args.dense_growth_channels = []
+        for (name, block), block_importance in zip(blocks, importance):
+            in_index = torch.arange(block.conv1.in_channels, device=relative.device)
+            offset = block.conv1.in_channels
+            widths = []
+            layers = (block.conv1, block.conv2, block.conv3, block.conv4, block.conv5)
+            for layer_no, (layer, layer_importance) in enumerate(zip(layers, block_importance + [None])):
+                if layer_importance is None:   # the output convolution of the block keeps its channels
+                    out_index = torch.arange(layer.out_channels, device=relative.device)
+                else:
+                    num_kept = max(1, int((layer_importance / layer_importance.mean() >= threshold).sum()))
+                    out_index = _keep_top(layer_importance, num_kept)
+                    widths.append(num_kept)
+                _replace_state(state, f'{name}.conv{layer_no + 1}.',
+                               _pruned_layer_state(layer, in_index, out_index))
+                # The next convolution reads the concatenation of the inputs and the kept outputs
+                in_index = torch.cat([in_index, offset + out_index])
+                offset += layer.out_channels
+            pruned_args.dense_growth_channels.append(widths)
+    else:
+        raise ValueError(f"Pruning is not supported for {type(model).__name__}")
+
+    pruned = type(model)(pruned_args)
+    pruned.load_state_dict(state)
+    parameter = next(model.parameters())
+    return pruned.to(parameter.device).train(model.training), pruned_args
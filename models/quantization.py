@@ -0,0 +1,106 @@
+"""Post-training static int8 quantization for CPU inference"""
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from models.layers import ConditionalNorm, SelfAttention
+from models.conversion import fuse_gated_convs
+
+
+# Modules kept in floating point, and not traced
+_FLOAT_MODULES = (ConditionalNorm, SelfAttention)
+
+
+def _check_quantizable(model):
+    if any(parameter.is_complex() for parameter in model.parameters()):
+        raise ValueError("Complex-valued models can not be quantized")
+
+
+def _use_engine(backend):
+    """Run quantized operators on the engine of `backend`, which this build of torch must support"""
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ValueError("Quantized engine '{}' is not supported by this build of torch, which supports: {}".format(
+            backend, ', '.join(torch.backends.quantized.supported_engines)))
+    torch.backends.quantized.engine = backend
+
+
+def _prepare(model, example_inputs, backend):
+    """
+    Fuse the gated convolutions of (a copy of) `model`, and insert observers for calibration.
+    The class-conditional normalization, a lookup in a table of scales and shifts, and self
+    attention stay in floating point; so does the ISO-conditioned bias of gated convolutions,
+    which is small next to the convolution output and would otherwise need its own quantization
+    steps.
+    Sigmoid gates use the fixed output range of the backend, whose engine is selected.
+    """
+    _check_quantizable(model)
+    _use_engine(backend)
+    model = fuse_gated_convs(copy.deepcopy(model)).eval()
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    for module_class in _FLOAT_MODULES:
+        qconfig_mapping.set_object_type(module_class, None)
+    custom_config = PrepareCustomConfig().set_non_traceable_module_classes(list(_FLOAT_MODULES))
+    return prepare_fx(model, qconfig_mapping, example_inputs, prepare_custom_config=custom_config)
+
+
+def _example_inputs(sample):
+    return sample['noisy'], sample['iso'], sample['class'].squeeze(-1)
+
+
+@torch.no_grad()
+def quantize_static(model: nn.Module, calibration_loader, num_batches: int = 32,
+                    backend: str = 'x86') -> nn.Module:
+    """
+    Quantize the weights and activations of a trained model to int8, with activation ranges
+    calibrated on samples of `calibration_loader`. Calibration should cover the range of ISOs
+    the model will be used on. The quantized model runs on CPU.
+
+    Args:
+        model: trained model; it is left unchanged
+        calibration_loader: loader of samples, as produced by `utils.transform_sample`
+        num_batches: number of batches to calibrate on
+        backend: quantized engine to target, 'x86' or 'qnnpack' (ARM), which is also
+            selected for running the model
+
+    Returns:
+        the quantized model
+    """
+    prepared = None
+    for batch_no, sample in enumerate(calibration_loader):
+        if batch_no == num_batches:
+            break
+        inputs = _example_inputs(sample)
+        if prepared is None:
+            prepared = _prepare(model.cpu(), inputs, backend)
+        prepared(*inputs)
+
+    if prepared is None:
+        raise ValueError("The calibration loader is empty")
+    return convert_fx(prepared)
+
+
+@torch.no_grad()
+def load_quantized(model: nn.Module, state_dict: dict, backend: str = 'x86') -> nn.Module:
+    """
+    Rebuild a model quantized by `quantize_static` from its state dict.
+
+    Args:
+        model: freshly constructed model of the same architecture as the quantized one
+        state_dict: state dict of the quantized model
+        backend: quantized engine the model was quantized for, which is selected for running it
+
+    Returns:
+        the quantized model
+    """
+    in_channels = next(module for module in model.modules() if isinstance(module, nn.Conv2d)).in_channels
+    # The graph does not depend on the input size, and the quantization parameters are loaded
+    inputs = torch.zeros(1, in_channels, 8, 8), torch.zeros(1, 1), torch.zeros(1, dtype=torch.long)
+    prepared = _prepare(model.cpu(), inputs, backend)
+    prepared(*inputs)
+    quantized = convert_fx(prepared)
+    quantized.load_state_dict(state_dict)
+    return quantized
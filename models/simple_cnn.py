@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 
-from models.layers import GatedConvLayer, ConvLayer
+from models.layers import GatedConvLayer, ConvLayer, SelfAttention
 
 
 class SimpleCNN(nn.Module):
@@ -46,15 +46,20 @@ class GatedCNN(nn.Module):
 
         # Input layer
         layers = [GatedConvLayer(args.cnn_in_channels, args.cnn_hidden_channels,
-                                 local_condition=args.iso, num_classes=args.num_classes)]
+                                 local_condition=args.iso, num_classes=args.num_classes,
+                                 fused=args.fused_gates)]
         # Hidden layers
         for _ in range(args.cnn_hidden_layers):
             layers.append(GatedConvLayer(args.cnn_hidden_channels, args.cnn_hidden_channels,
-                                         num_classes=args.num_classes, local_condition=args.iso))
+                                         num_classes=args.num_classes, local_condition=args.iso,
+                                         fused=args.fused_gates))
         # Output layer
         layers.append(GatedConvLayer(args.cnn_hidden_channels, args.cnn_in_channels,
                                      num_classes=args.num_classes, local_condition=args.iso,
-                                     normalize=False, layer_activation=None))
+                                     normalize=False, layer_activation=None, fused=args.fused_gates))
+        if args.self_attention:  # halfway through the hidden layers
+            layers.insert(1 + args.cnn_hidden_layers // 2,
+                          SelfAttention(args.cnn_hidden_channels, window_size=args.attention_window))
         self.model = nn.ModuleList(layers)
 
         self.residual = args.residual
@@ -0,0 +1,110 @@
+"""Knowledge distillation from a trained teacher model"""
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import models
+
+
+def load_model(model_path, cuda=False):
+    """
+    Construct a trained model from a checkpoint file, or a directory with `model_best.pth.tar`,
+    and the `denoising.config` saved alongside it
+    """
+    model_path = Path(model_path).resolve()
+    if model_path.is_dir():
+        model_path = model_path / "model_best.pth.tar"
+    model_args = torch.load(model_path.parent / "denoising.config")
+    model = getattr(models, model_args.model)(model_args)
+    model = model.cuda() if cuda else model
+    model.load_state_dict(torch.load(model_path)['model'])
+    return model
+
+
+class Distiller(nn.Module):
+    """
+    Knowledge distillation: mixes the loss of a student against the clean targets with its loss
+    against the outputs of a frozen teacher, and optionally matches the features the output layers
+    of student and teacher receive, through a learned 1x1 convolution.
+
+    The outputs of the teacher are cached per training sample, as half precision on the CPU,
+    so that the teacher runs once per sample rather than once per epoch. Matching features
+    requires running the teacher on every batch.
+    """
+    def __init__(self, teacher, student, criterion, output_weight=0.5, feature_weight=0., cache_size=0):
+        """
+        Args:
+            teacher: trained model, conditioned on the same data as the student
+            student: model to train
+            criterion: loss between the student outputs and the teacher outputs
+            output_weight: weight of the loss against the teacher outputs; the loss against the
+                           clean targets has weight 1 - output_weight
+            feature_weight: weight of the mean squared error between features
+            cache_size: number of samples in the dataset, indexed by `sample['index']`;
+                        0 disables the cache
+        """
+        super().__init__()
+        self.teacher = models.conversion.fold_norms(teacher)
+        self.teacher.requires_grad_(False)
+        self.criterion = criterion
+        self.output_weight = output_weight
+        self.feature_weight = feature_weight
+
+        self.adapter = None
+        if feature_weight > 0:
+            self._features = {}
+            student.model[-1].register_forward_pre_hook(self._save_features('student'))
+            self.teacher.model[-1].register_forward_pre_hook(self._save_features('teacher'))
+            self.adapter = nn.Conv2d(student.model[-1].in_channels, self.teacher.model[-1].in_channels,
+                                     kernel_size=1)
+
+        self.cache_size = cache_size if feature_weight == 0 else 0
+        self.cached = torch.zeros(self.cache_size, dtype=torch.bool)
+        self.cache = None   # allocated once the output size is known
+
+    def _save_features(self, name):
+        def _hook(module, inputs):
+            self._features[name] = inputs[0]
+        return _hook
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.teacher.eval()   # the teacher stays frozen
+        return self
+
+    @torch.no_grad()
+    def teacher_outputs(self, noisy, iso, class_labels, index=None):
+        """Outputs of the teacher for a batch, from the cache where possible"""
+        if self.cache_size == 0 or index is None:
+            return self.teacher(noisy, iso, class_labels)
+
+        index = index.cpu()
+        missing = ~self.cached[index]
+        if missing.any():
+            device_missing = missing.to(noisy.device)
+            outputs = self.teacher(noisy[device_missing], iso[device_missing], class_labels[device_missing])
+            if self.cache is None:
+                self.cache = torch.empty(self.cache_size, *outputs.shape[1:], dtype=torch.half)
+            self.cache[index[missing]] = outputs.half().cpu()
+            self.cached[index[missing]] = True
+        return self.cache[index].to(noisy.device, noisy.dtype, non_blocking=True)
+
+    def forward(self, loss, denoised, noisy, iso, class_labels, index=None):
+        """
+        Args:
+            loss: loss of the student against the clean targets
+            denoised: outputs of the student
+            noisy, iso, class_labels: inputs of the student
+            index: dataset indices of the samples, for the cache
+
+        Returns:
+            the distillation loss
+        """
+        targets = self.teacher_outputs(noisy, iso, class_labels, index)
+        loss = (1 - self.output_weight) * loss + self.output_weight * self.criterion(denoised, targets)
+        if self.adapter is not None:
+            student_features = self.adapter(self._features['student'])
+            loss = loss + self.feature_weight * F.mse_loss(student_features, self._features['teacher'])
+        return loss
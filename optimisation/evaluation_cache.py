@@ -0,0 +1,82 @@
+"""Persistent per-sample evaluation results, keyed by model weights, data split and metric settings"""
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Subset
+
+
+def _update_hash(digest, value):
+    """Add a state dict entry to `digest`: tensors by their data, containers recursively"""
+    if isinstance(value, torch.Tensor):
+        if value.is_quantized:
+            value = value.dequantize()
+        value = value.detach().cpu().contiguous()
+        digest.update(f'{value.dtype}{tuple(value.shape)}'.encode())
+        digest.update(value.flatten().view(torch.uint8).numpy().tobytes())
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            _update_hash(digest, item)
+    else:
+        digest.update(repr(value).encode())
+
+
+def _split_indices(dataset):
+    """Indices of the samples of `dataset` in the dataset it was split from"""
+    indices = dataset.indices if hasattr(dataset, 'indices') else range(len(dataset))
+    return [int(index) for index in indices]
+
+
+def weights_fingerprint(path):
+    """
+    Identifies a weights file, by its path, size and modification time, which is cheaper than
+    hashing it. None, for weights that are downloaded, stays None.
+    """
+    if path is None:
+        return None
+    stat = Path(path).stat()
+    return [str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns]
+
+
+def evaluation_key(model, dataset, metric_settings):
+    """
+    Fingerprint of an evaluation: a hash of the model weights, of the samples of `dataset`, as
+    its `indices` into the dataset it was split from, like a Subset, and the directory of the
+    data, and of `metric_settings`
+    """
+    digest = hashlib.sha256()
+    for name, value in model.state_dict().items():
+        digest.update(name.encode())
+        _update_hash(digest, value)
+
+    root_dataset = dataset.dataset if isinstance(dataset, Subset) else dataset
+    data = {'root_dir': str(getattr(root_dataset, 'root_dir', '')), 'indices': _split_indices(dataset),
+            'metrics': metric_settings}
+    digest.update(json.dumps(data, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:32]
+
+
+class EvaluationCache:
+    """
+    Per-sample metric results of one evaluation, stored column-wise, one array per metric and
+    one of the sample indices, in `<directory>/<key>.npz`. They can be read with `numpy.load`.
+    """
+    def __init__(self, directory, key):
+        self.path = Path(directory) / f'{key}.npz'
+
+    def load(self):
+        """The stored columns, an empty dict if there are none"""
+        if not self.path.is_file():
+            return {}
+        with np.load(self.path) as columns:
+            return dict(columns)
+
+    def save(self, columns):
+        """Store `columns`, replacing the stored ones"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so that an interrupted write leaves the old results
+        temporary_path = self.path.with_suffix('.tmp.npz')
+        np.savez_compressed(temporary_path, **columns)
+        temporary_path.replace(self.path)
@@ -1,4 +1,5 @@
-import torchvision
+from pathlib import Path
+
 import torch.nn as nn
 from torch.nn import MSELoss
 from utils.metrics import *
@@ -13,28 +14,50 @@ class _FeatureExtractor(nn.Module):
         return self.features(x)
 
 
+def _vgg19_features(weights=None):
+    """
+    Convolutional layers of VGG19, with ImageNet weights downloaded by torchvision, or loaded from
+    `weights`: a state dict of torchvision's `vgg19`, like the `vgg19-dcbb9e9d.pth` it downloads
+    """
+    from torchvision.models import vgg   # loads slowly, and only VGGLoss needs it
+    if weights is None:
+        return vgg.vgg19(pretrained=True).features
+
+    features = vgg.make_layers(vgg.cfgs['E'])
+    state_dict = torch.load(weights, map_location='cpu')
+    features.load_state_dict({key[len('features.'):]: value for key, value in state_dict.items()
+                              if key.startswith('features.')})
+    return features
+
+
 class VGGLoss(nn.Module):
     """
     The VGG loss based on the ReLU activation layers of the
     pre-trained 19 layer VGG network. This is calculated as
     the euclidean distance between the feature representations
      of a reconstructed image.
+
+    The features of the clean images can be cached per training sample, with
+    `cache_clean_features`, so that VGG runs on the clean patches once rather than every epoch.
     """
     vgg_feature_layer_default = '22'  # VGG19 layer number from which to extract features
 
-    def __init__(self, args=None, prefactor=0.006):
+    def __init__(self, args=None, prefactor=0.006, weights=None):
         """
         Args:
             prefactor: prefactor by which to scale the loss.
                        Rescaling by a factor of 1 / 12.75 gives VGG losses of a scale that
                        is comparable to MSE loss. This is equivalent to multiplying with a
                        rescaling factor of ≈ 0.006.
+            weights: file with the VGG19 weights, defaults to `args.vgg_weights`;
+                     if neither is given they are downloaded
         """
         super().__init__()
-        vgg_features = torchvision.models.vgg19(pretrained=True).features
-        modules = [m for m in vgg_features]
+        if weights is None and args is not None:
+            weights = args.vgg_weights
+        modules = [m for m in _vgg19_features(weights)]
 
-        vgg_feature_layer = self.feature_layer_default if args is None else args.vgg_feature_layer
+        vgg_feature_layer = self.vgg_feature_layer_default if args is None else str(args.vgg_feature_layer)
         if vgg_feature_layer == '22':
             self.vgg = nn.Sequential(*modules[:8])
         elif vgg_feature_layer == '54':
@@ -42,18 +65,66 @@ class VGGLoss(nn.Module):
         else:
             raise ValueError("'vgg_feature_layer' has to be either 22 or 54")
 
-        self.vgg.requires_grad = False
+        self.vgg.requires_grad_(False)
         self.prefactor = prefactor
 
-    def forward(self, noisy, clean):
-        def _forward(x):
-            x = self.vgg(x)
-            return x
+        self.cache_size = 0
+        self.cache_file = None
+        self.cached = torch.zeros(0, dtype=torch.bool)
+        self.cache = None   # allocated once the feature size is known
 
-        vgg_noisy = _forward(noisy)
-        with torch.no_grad():
-            vgg_clean = _forward(clean.detach())
+    def cache_clean_features(self, num_samples, cache_file=None):
+        """
+        Cache the features of the clean images, as half precision on the CPU, per sample.
+        The clean images of a sample must not change between epochs.
+
+        Args:
+            num_samples: number of samples in the dataset, indexed by `sample['index']`
+            cache_file: file to memory-map the cache to, rather than holding it in memory
+        """
+        self.cache_size = num_samples
+        self.cache_file = cache_file
+        self.cached = torch.zeros(num_samples, dtype=torch.bool)
+        self.cache = None
+        return self
+
+    def _allocate_cache(self, feature_shape):
+        shape = (self.cache_size, *feature_shape)
+        if self.cache_file is None:
+            return torch.empty(shape, dtype=torch.half)
+        Path(self.cache_file).unlink(missing_ok=True)   # features of an earlier run may differ
+        return torch.from_file(str(self.cache_file), shared=True, size=torch.Size(shape).numel(),
+                               dtype=torch.half).view(shape)
+
+    @torch.no_grad()
+    def clean_features(self, clean, index=None):
+        """Features of the clean images of a batch, from the cache where possible"""
+        if self.cache_size == 0 or index is None:
+            return self.vgg(clean)
+
+        index = index.cpu()
+        missing = ~self.cached[index]
+        if missing.any():
+            features = self.vgg(clean[missing.to(clean.device)])
+            if self.cache is None:
+                self.cache = self._allocate_cache(features.shape[1:])
+            self.cache[index[missing]] = features.half().cpu()
+            self.cached[index[missing]] = True
+        return self.cache[index].to(clean.device, clean.dtype, non_blocking=True)
+
+    def forward(self, noisy, clean, index=None, reduction='mean'):
+        """
+        Args:
+            noisy: denoised images
+            clean: clean images
+            index: dataset indices of the samples, for the cache
+            reduction: `mean` over the batch, or `none` for the loss of each sample
+        """
+        vgg_noisy = self.vgg(noisy)
+        vgg_clean = self.clean_features(clean.detach(), index)
 
+        if reduction == 'none':
+            return self.prefactor * F.mse_loss(vgg_noisy, vgg_clean, reduction='none').mean(dim=(1, 2, 3))
         loss = self.prefactor * F.mse_loss(vgg_noisy, vgg_clean)
 
         return loss
@@ -100,7 +171,10 @@ class HingeLossGAN(nn.Module):
 
 
 class SobelMagnitude(nn.Module):
-
+    """
+    Channel-wise gradient magnitude of the Sobel filters. Both kernels are applied by one grouped
+    convolution, whose outputs alternate between the horizontal and the vertical gradients.
+    """
     def __init__(self, in_channels, out_channels=None, eps=1.e-5):
         super().__init__()
 
@@ -109,22 +183,15 @@ class SobelMagnitude(nn.Module):
         self.out_channels = out_channels
         self.eps = eps
 
-        kernel_x = torch.FloatTensor([[1, 0, -1], [2, 0, -2], [1, 0, -1]])[None][None]
-        kernel_x = kernel_x.expand(out_channels, -1, -1, -1)
-        self.sobel_x = nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1, padding=1,
-                                 bias=False, groups=in_channels)
-        self.sobel_x.weight = nn.Parameter(kernel_x, requires_grad=False)
-
-        kernel_y = torch.FloatTensor([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])[None][None]
-        kernel_y = kernel_y.expand(out_channels, -1, -1, -1)
-        self.sobel_y = nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1, padding=1,
-                                 bias=False, groups=in_channels)
-        self.sobel_y.weight = nn.Parameter(kernel_y, requires_grad=False)
+        kernel_x = torch.FloatTensor([[1, 0, -1], [2, 0, -2], [1, 0, -1]])
+        kernel_y = torch.FloatTensor([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+        kernels = torch.stack((kernel_x, kernel_y))[:, None]    # [2, 1, 3, 3]
+        self.register_buffer('kernels', kernels.repeat(out_channels, 1, 1, 1))
 
     def forward(self, x):
-        G_x = self.sobel_x(x)
-        G_y = self.sobel_y(x)
-        G = ((G_x ** 2 + G_y ** 2) + self.eps).sqrt()   # channel-wise magnitude
+        G = F.conv2d(x, self.kernels, padding=1, groups=self.in_channels)
+        G = G.unflatten(1, (self.out_channels, 2))   # [B, out_channels, (G_x, G_y), H, W]
+        G = (G.pow(2).sum(2) + self.eps).sqrt()   # channel-wise magnitude
         return G
 
 
@@ -132,6 +199,9 @@ class EdgeAwareLoss(nn.Module):
     """
     Edge-aware loss function, where the pixels in the edges are granted higher weights
     compared to non-edge pixels (https://arxiv.org/pdf/1810.06766v1.pdf)
+
+    The edge maps of the denoised and the clean images are computed by one convolution, or the
+    clean ones are cached per training sample, with `cache_clean_edges`.
     """
     def __init__(self, in_channels=3, weight=0.025):
         super().__init__()
@@ -139,8 +209,47 @@ class EdgeAwareLoss(nn.Module):
         self.sobel = SobelMagnitude(in_channels)
         self.criterion = nn.MSELoss()
 
-    def forward(self, noisy, clean):
-        edge_map_noisy = self.sobel(noisy)
-        edge_map_clean = self.sobel(clean)
+        self.cache_size = 0
+        self.cached = torch.zeros(0, dtype=torch.bool)
+        self.cache = None   # allocated once the image size is known
+
+    def cache_clean_edges(self, num_samples):
+        """
+        Cache the edge maps of the clean images, as half precision on the CPU, per sample.
+        The clean images of a sample must not change between epochs.
+
+        Args:
+            num_samples: number of samples in the dataset, indexed by `sample['index']`
+        """
+        self.cache_size = num_samples
+        self.cached = torch.zeros(num_samples, dtype=torch.bool)
+        self.cache = None
+        return self
+
+    @torch.no_grad()
+    def clean_edges(self, clean, index):
+        """Edge maps of the clean images of a batch, from the cache where possible"""
+        index = index.cpu()
+        missing = ~self.cached[index]
+        if missing.any():
+            edges = self.sobel(clean[missing.to(clean.device)])
+            if self.cache is None:
+                self.cache = torch.empty(self.cache_size, *edges.shape[1:], dtype=torch.half)
+            self.cache[index[missing]] = edges.half().cpu()
+            self.cached[index[missing]] = True
+        return self.cache[index].to(clean.device, clean.dtype, non_blocking=True)
+
+    def forward(self, noisy, clean, index=None):
+        """
+        Args:
+            noisy: denoised images
+            clean: clean images
+            index: dataset indices of the samples, for the cache
+        """
+        if self.cache_size == 0 or index is None:
+            edge_map_noisy, edge_map_clean = self.sobel(torch.cat((noisy, clean.detach()))).chunk(2)
+        else:
+            edge_map_noisy = self.sobel(noisy)
+            edge_map_clean = self.clean_edges(clean, index)
         edge_loss = self.criterion(edge_map_noisy, edge_map_clean)
         return self.criterion(noisy, clean) + self.weight * edge_loss
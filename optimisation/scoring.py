@@ -0,0 +1,161 @@
+"""Scoring of every checkpoint of a training run, in parallel"""
+import os
+import re
+from pathlib import Path
+
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Dataset
+
+import models
+from models.ensemble import StackedModels
+from optimisation.loss import VGGLoss
+from optimisation.training import evaluate, _evaluation_metrics
+from utils.loader import TransformedHuaweiDataset, transform_sample
+
+SCORE_COLUMNS = ('psnr', 'ssim', 'vgg_loss', 'msssim')
+
+
+class DecodedDataset(Dataset):
+    """
+    Samples of a dataset, decoded and transformed once, and held as tensors that can be shared
+    between processes
+    """
+    def __init__(self, dataset, batch_size=32, num_workers=0):
+        """
+        Args:
+            dataset: dataset of transformed samples, e.g. a Subset of TransformedHuaweiDataset
+            batch_size, num_workers: settings of the loader that decodes the samples
+        """
+        batches = list(DataLoader(dataset, batch_size=batch_size, num_workers=num_workers))
+        self.samples = {key: torch.cat([batch[key] for batch in batches]).share_memory_()
+                        for key in batches[0]}
+        root_dataset = getattr(dataset, 'dataset', dataset)
+        # identify the samples like the dataset they come from, for the evaluation cache
+        self.root_dir = getattr(root_dataset, 'root_dir', None)
+        self.indices = self.samples['index'].tolist() if 'index' in self.samples else range(len(self))
+
+    def __len__(self):
+        return len(next(iter(self.samples.values())))
+
+    def __getitem__(self, idx):
+        return {key: value[idx] for key, value in self.samples.items()}
+
+
+def validation_set(args):
+    """The validation samples of a training run, split like `main.py` splits them"""
+    dataset = TransformedHuaweiDataset(root_dir=args.data_dir, transform=transform_sample)
+    _, val_dataset = dataset.random_split(test_ratio=args.test_split, data_subset=args.data_subset,
+                                          seed=args.seed)
+    return val_dataset
+
+
+def _checkpoint_epoch(path):
+    return int(re.search(r'(\d+)', path.name).group(1))
+
+
+# State of the scoring worker processes
+_worker = {}
+
+
+def _init_worker(args, dataset, num_threads):
+    torch.set_num_threads(num_threads)
+    _worker['args'] = args
+    _worker['dataset'] = dataset
+    _worker['vgg_loss'] = None    # constructed for the first checkpoint
+
+
+def _score(path):
+    """Evaluate the model of one checkpoint, in a worker process"""
+    args = _worker['args']
+    model = getattr(models, args.model)(args)
+    model = model.cuda() if args.cuda else model
+    model.load_state_dict(torch.load(path, map_location='cuda' if args.cuda else 'cpu')['model'])
+
+    if _worker['vgg_loss'] is None:
+        _worker['vgg_loss'] = VGGLoss(args)
+    loader = DataLoader(_worker['dataset'], batch_size=args.test_batch_size, pin_memory=args.cuda)
+    print("===> Scoring '{}'".format(path))
+    scores = evaluate(args, model, loader, _worker['vgg_loss'])
+    return {'epoch': _checkpoint_epoch(path), 'checkpoint': path.name, **dict(zip(SCORE_COLUMNS, scores))}
+
+
+def _score_pool(args, checkpoints, dataset, num_processes=None):
+    """Evaluate the models of `checkpoints` in a pool of processes"""
+    num_processes = min(num_processes or os.cpu_count(), len(checkpoints))
+    num_threads = max(1, torch.get_num_threads() // num_processes)
+    # Spawned processes receive the samples through shared memory, and may use CUDA
+    context = mp.get_context('spawn')
+    with context.Pool(num_processes, initializer=_init_worker, initargs=(args, dataset, num_threads)) as pool:
+        return pool.map(_score, checkpoints, chunksize=1)
+
+
+@torch.no_grad()
+def _score_stacked(args, checkpoints, dataset, chunk_size=None):
+    """Evaluate the models of `checkpoints` together, as StackedModels, in this process"""
+    stacked = StackedModels.from_checkpoints(args, checkpoints, chunk_size)
+    stacked = stacked.cuda() if args.cuda else stacked
+    # the metrics of evaluate, in the order of SCORE_COLUMNS
+    psnr, ssim, msssim, vgg_loss = (constructor() for constructor in _evaluation_metrics(args).values())
+    if args.cuda:
+        vgg_loss.cuda()
+
+    totals = torch.zeros(len(SCORE_COLUMNS), len(checkpoints), dtype=torch.float64)
+    for sample in DataLoader(dataset, batch_size=args.test_batch_size, pin_memory=args.cuda):
+        noisy, clean, iso = sample['noisy'], sample['clean'], sample['iso']
+        class_labels = sample['class'].squeeze(-1)
+        if args.cuda:
+            noisy, clean, iso, class_labels = noisy.cuda(), clean.cuda(), iso.cuda(), class_labels.cuda()
+
+        # The outputs of all models, [K, B, C, H, W], are scored as one batch
+        denoised = stacked(noisy, iso, class_labels).flatten(0, 1)
+        clean = clean.repeat(len(checkpoints), 1, 1, 1)
+        scores = (psnr(denoised, clean), ssim(denoised, clean), vgg_loss(denoised, clean, reduction='none'),
+                  msssim(denoised, clean))
+        totals += torch.stack([score.view(len(checkpoints), -1).sum(1) for score in scores]).cpu()
+
+    averages = (totals / len(dataset)).tolist()
+    return [{'epoch': _checkpoint_epoch(path), 'checkpoint': path.name,
+             **{column: values[model_no] for column, values in zip(SCORE_COLUMNS, averages)}}
+            for model_no, path in enumerate(checkpoints)]
+
+
+def score_checkpoints(run_dir, num_processes=None, args=None, stacked=False, chunk_size=None):
+    """
+    Evaluate every `checkpoint_*.pth.tar` of a training run on its validation set.
+    The validation samples are decoded once and shared with a pool of processes, each of which
+    scores a part of the checkpoints.
+
+    Args:
+        run_dir: results directory of the run, with the checkpoints and `denoising.config`
+        num_processes: number of scoring processes (default: one per CPU, at most one per checkpoint)
+        args: settings of the run (default: its saved `denoising.config`)
+        stacked: evaluate all checkpoints in one process, with one vectorized forward per batch
+                 (see `models.ensemble.StackedModels`), rather than in a pool of processes;
+                 this does not use the evaluation cache
+        chunk_size: with `stacked`, number of models to run at once (default: all)
+
+    Returns:
+        a data frame with the PSNR, SSIM, VGG loss and MS-SSIM of every checkpoint, by epoch,
+        also saved as `checkpoint_scores.csv` in `run_dir`
+    """
+    run_dir = Path(run_dir).resolve()
+    checkpoints = sorted(run_dir.glob('checkpoint_*.pth.tar'), key=_checkpoint_epoch)
+    if not checkpoints:
+        raise ValueError("No checkpoints in '{}'".format(run_dir))
+    if args is None:
+        args = torch.load(run_dir / 'denoising.config')
+    args.cuda = args.cuda and torch.cuda.is_available()
+
+    print('==> Decoding the validation set')
+    dataset = DecodedDataset(validation_set(args), args.test_batch_size, args.workers)
+
+    if stacked:
+        scores = _score_stacked(args, checkpoints, dataset, chunk_size)
+    else:
+        scores = _score_pool(args, checkpoints, dataset, num_processes)
+
+    table = pd.DataFrame(scores).set_index('epoch').sort_index()
+    table.to_csv(run_dir / 'checkpoint_scores.csv')
+    return table
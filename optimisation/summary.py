@@ -0,0 +1,106 @@
+"""TensorBoard logging off the training thread"""
+import threading
+import warnings
+from collections import deque
+
+import torch
+import torchvision.utils as vutils
+
+
+class BackgroundSummaryWriter:
+    """
+    Wraps a `SummaryWriter`, so that `add_scalar`, `add_image` and `add_image_grid` return at once:
+    the values are handed to a background thread, which converts them, builds the image grids,
+    and writes them. Scalars and images wait in separate bounded queues; when a queue is full,
+    its oldest entries are dropped, so that logging never stalls training.
+    """
+    def __init__(self, writer, max_scalars=10000, max_images=16):
+        """
+        Args:
+            writer: the `SummaryWriter` to write with, closed with this one
+            max_scalars, max_images: sizes of the queues of scalars and of images
+        """
+        self.writer = writer
+        self.scalars = deque(maxlen=max_scalars)
+        self.images = deque(maxlen=max_images)
+        self.dropped = 0
+        self.busy = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._write, name='summary-writer', daemon=True)
+        self.thread.start()
+
+    def _put(self, queue, entry):
+        with self.condition:
+            if self.closed:
+                raise ValueError("The summary writer is closed")
+            if len(queue) == queue.maxlen:
+                self.dropped += 1
+            queue.append(entry)
+            self.condition.notify_all()
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        # Tensors are converted by the background thread, so that the training thread does not
+        # wait for the device
+        if isinstance(scalar_value, torch.Tensor):
+            scalar_value = scalar_value.detach()
+        self._put(self.scalars, ('add_scalar', tag, scalar_value, global_step))
+
+    def add_image(self, tag, img_tensor, global_step=None):
+        self._put(self.images, ('add_image', tag, img_tensor.detach().cpu(), global_step))
+
+    def add_image_grid(self, tag, images, global_step=None):
+        """Log a batch of images as one grid, each normalized to its own range"""
+        self._put(self.images, ('add_image_grid', tag, images.detach().cpu(), global_step))
+
+    def _next(self):
+        """The next entry to write, scalars first, or None once closed and written"""
+        with self.condition:
+            self.busy = False
+            self.condition.notify_all()
+            while not (self.scalars or self.images or self.closed):
+                self.condition.wait()
+            queue = self.scalars or self.images
+            if not queue:
+                return None
+            self.busy = True
+            return queue.popleft()
+
+    def _write(self):
+        for method, tag, value, global_step in iter(self._next, None):
+            try:
+                if method == 'add_scalar':
+                    self.writer.add_scalar(tag, value.item() if isinstance(value, torch.Tensor) else value,
+                                           global_step)
+                elif method == 'add_image_grid':
+                    grid = vutils.make_grid(value, normalize=True, scale_each=True)
+                    self.writer.add_image(tag, grid, global_step)
+                else:
+                    self.writer.add_image(tag, value, global_step)
+            except Exception as error:   # a failed summary must not stop the others, nor training
+                warnings.warn("Could not write summary '{}': {!r}".format(tag, error))
+
+    def flush(self):
+        """Wait until the queued entries are written, and flush the writer"""
+        with self.condition:
+            while self.scalars or self.images or self.busy:
+                self.condition.wait()
+        self.writer.flush()
+
+    def close(self):
+        """Write the queued entries, stop the background thread and close the writer"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.writer.close()
+        if self.dropped:
+            print("===> Dropped {} summaries while logging".format(self.dropped))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
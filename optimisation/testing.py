@@ -1,3 +1,4 @@
+from dataclasses import replace
 from tqdm import tqdm
 from utils.loader import TestDataset
 from torch.utils.data import DataLoader
@@ -11,7 +12,9 @@ def test(args, sample_transform):
     if not args.resume:
         raise ValueError("You need to specify a checkpoint in `resume` if you want to run on test")
     model_path = Path(args.resume).resolve()
-    if model_path.is_file():
+    if model_path.suffix == '.onnx':
+        model_args = None   # exported models are self-contained
+    elif model_path.is_file():
         model_args = torch.load(model_path.parent / "denoising.config")
     elif model_path.is_dir():
         model_args = torch.load(model_path / "denoising.config")
@@ -25,16 +28,29 @@ def test(args, sample_transform):
 
     save_path.mkdir(parents=True)
 
-    print('==> Loading checkpoint for testing')
-    checkpoint = torch.load(model_path)
-    print('==> Checkpoint loaded')
-    model = getattr(models, model_args.model)(model_args)
-    model = model.cuda() if args.cuda else model
-    model.load_state_dict(checkpoint['model'])
-    model.eval()
+    if model_args is None or args.inference_backend == 'onnxruntime':
+        # Run an exported graph on CPU with ONNX Runtime
+        if model_args is not None:
+            model_path = _export_checkpoint(model_path, model_args, save_path / 'model.onnx')
+        model, cuda = models.export.OnnxRuntimeModel(model_path), False
+    else:
+        print('==> Loading checkpoint for testing')
+        checkpoint = torch.load(model_path)
+        print('==> Checkpoint loaded')
+        model = getattr(models, model_args.model)(model_args)
+        # Quantized models run on CPU only
+        cuda = args.cuda and 'quantization_backend' not in checkpoint
+        if 'quantization_backend' in checkpoint:
+            model = models.quantization.load_quantized(model, checkpoint['model'],
+                                                       checkpoint['quantization_backend'])
+        else:
+            model = model.cuda() if cuda else model
+            model.load_state_dict(checkpoint['model'])
+            # Fold the frozen normalization statistics into the convolutions
+            model = models.conversion.fold_norms(model)
 
     test_dataset = TestDataset(args.test_data_dir, transform=sample_transform)
-    test_loader = DataLoader(test_dataset, num_workers=args.workers, pin_memory=args.cuda)
+    test_loader = DataLoader(test_dataset, num_workers=args.workers, pin_memory=cuda)
 
     with torch.no_grad():
         for img_no, sample in enumerate(tqdm(test_loader)):
@@ -42,12 +58,61 @@ def test(args, sample_transform):
             iso = sample['iso']
             class_labels = sample['class'].squeeze(-1)
 
-            noisy = noisy.cuda() if args.cuda else noisy
-            iso = iso.cuda() if args.cuda else iso
-            class_labels = class_labels.cuda() if args.cuda else class_labels
+            noisy = noisy.cuda() if cuda else noisy
+            iso = iso.cuda() if cuda else iso
+            class_labels = class_labels.cuda() if cuda else class_labels
 
             denoised = model(noisy, iso, class_labels)
             denoised = torch.clamp(((denoised * 0.5) + 0.5), min=0, max=1)
             denoised = denoised.cpu()
             im = F.to_pil_image(torch.squeeze(denoised))
             im.save(save_path / f"Test_Image_{img_no+1}.png")
+
+
+def _export_checkpoint(model_path, model_args, onnx_path):
+    """Export the model of a checkpoint to ONNX, and return the path of the exported graph"""
+    print('==> Exporting checkpoint to ONNX')
+    checkpoint = torch.load(model_path)
+    if 'quantization_backend' in checkpoint:
+        raise ValueError("Quantized models can not be exported to ONNX")
+    model = getattr(models, model_args.model)(model_args)
+    model.load_state_dict(checkpoint['model'])
+    models.export.export_onnx(model.eval(), onnx_path, model_args.cnn_in_channels)
+    print("==> Exported model to '{}'".format(onnx_path))
+    return onnx_path
+
+
+def quantize(args, model, calibration_loader, val_loader, save_path, vgg_loss_calculator=None):
+    """
+    Quantize a trained model to int8 for CPU inference, compare it with the floating point model
+    on the validation set, and save it as `model_quantized.pth.tar` in `save_path`.
+    The saved checkpoint can be used for `test`.
+
+    Args:
+        vgg_loss_calculator (optional): VGG loss of the run, see `evaluation_vgg_loss`
+    """
+    # not needed, nor imported, for `test`
+    from optimisation.training import evaluate, evaluation_vgg_loss
+
+    cpu_args = replace(args, cuda=False)
+    model = model.cpu()
+
+    print('==> Calibrating quantized model')
+    quantized = models.quantization.quantize_static(model, calibration_loader, args.quantization_batches,
+                                                    args.quantization_backend)
+
+    vgg_loss = (vgg_loss_calculator if vgg_loss_calculator is not None else evaluation_vgg_loss(cpu_args)).cpu()
+    print('==> Evaluating floating point model')
+    float_psnr, float_ssim, *_ = evaluate(cpu_args, model, val_loader, vgg_loss)
+    print('==> Evaluating quantized model')
+    quantized_psnr, quantized_ssim, *_ = evaluate(cpu_args, quantized, val_loader, vgg_loss)
+    print("===> PSNR change after quantization: {:+.4f}".format(quantized_psnr - float_psnr))
+    print("===> SSIM change after quantization: {:+.4f}".format(quantized_ssim - float_ssim))
+
+    checkpoint = {
+        'model': quantized.state_dict(),
+        'quantization_backend': args.quantization_backend,
+    }
+    torch.save(checkpoint, save_path / 'model_quantized.pth.tar')
+    print("===> Saved quantized model '{}'".format(save_path / 'model_quantized.pth.tar'))
+    return quantized
@@ -1,15 +1,29 @@
 import time
 from tqdm import tqdm
+import numpy as np
 import torch
 from torchnet.meter import AverageValueMeter
 import torchvision.utils as vutils
 
 from utils.metrics.psnr import PSNR
 from utils.metrics.ssim import SSIM
-from optimisation.loss import VGGLoss
+from utils.metrics.msssim import MSSSIM
+from optimisation.loss import VGGLoss, EdgeAwareLoss
+from optimisation.evaluation_cache import evaluation_key, weights_fingerprint, EvaluationCache
+from optimisation.summary import BackgroundSummaryWriter
 
 
-def train(args, train_loader, model, criterion, optimizer, epoch, summary_writer):
+def _criterion_loss(criterion, denoised, clean, sample):
+    """
+    Loss of a batch against the clean images; VGGLoss and EdgeAwareLoss cache their VGG features
+    and edge maps by sample index
+    """
+    if isinstance(criterion, (VGGLoss, EdgeAwareLoss)):
+        return criterion(denoised, clean, sample.get('index'))
+    return criterion(denoised, clean)
+
+
+def train(args, train_loader, model, criterion, optimizer, epoch, summary_writer, distiller=None):
     # Meters to log batch time and loss
     batch_time_meter = AverageValueMeter()
     loss_meter = AverageValueMeter()
@@ -39,7 +53,9 @@ def train(args, train_loader, model, criterion, optimizer, epoch, summary_writer
 
             # Denoise the image and calculate the loss wrt target clean image
             denoised = model(noisy, iso, class_labels)
-            loss = criterion(denoised, clean)
+            loss = _criterion_loss(criterion, denoised, clean, sample)
+            if distiller is not None:
+                loss = distiller(loss, denoised, noisy, iso, class_labels, sample['index'])
 
             # Calculate gradients and update weights
             loss.backward()
@@ -138,7 +154,7 @@ def train_gan(args, train_loader, generator, discriminator, content_criterion,
             end = time.time()
 
             # Write image samples to tensorboard
-            if i == 0:
+            if i == 0 and summary_writer is not None:
                 if args.train_batch_size >= args.num_samples_to_log:
                     log_images(noisy, denoised, clean, summary_writer,
                                args.num_samples_to_log, (epoch * steps) + i, 'Train')
@@ -151,9 +167,10 @@ def train_gan(args, train_loader, generator, discriminator, content_criterion,
 
             # Write the results to tensorboard
             training_iters = (epoch * steps) + i
-            summary_writer.add_scalar('Train/Content_loss', generator_content_loss, training_iters)
-            summary_writer.add_scalar('Train/Adversarial_loss', generator_adversarial_loss, training_iters)
-            summary_writer.add_scalar('Train/Total_generator_loss', generator_total_loss, training_iters)
+            if summary_writer is not None:
+                summary_writer.add_scalar('Train/Content_loss', generator_content_loss, training_iters)
+                summary_writer.add_scalar('Train/Adversarial_loss', generator_adversarial_loss, training_iters)
+                summary_writer.add_scalar('Train/Total_generator_loss', generator_total_loss, training_iters)
 
     average_loss = total_loss_meter.mean
     print("===> Average total loss: {:4f}".format(average_loss))
@@ -178,6 +195,9 @@ def validate(args, val_loader, model, criterion, training_iters, summary_writer)
     # Average meters
     batch_time_meter = AverageValueMeter()
     loss_meter = AverageValueMeter()
+    msssim_meter = AverageValueMeter()
+
+    msssim_calculator = MSSSIM(data_range=1, channels=args.cnn_in_channels)
 
     # Switch to evaluation mode
     model.eval()
@@ -202,10 +222,12 @@ def validate(args, val_loader, model, criterion, training_iters, summary_writer)
 
                 # Denoise the image and calculate the loss wrt target clean image
                 denoised = model(noisy, iso, class_labels)
-                loss = criterion(denoised, clean)
+                loss = _criterion_loss(criterion, denoised, clean, sample)
+                msssim = msssim_calculator(denoised, clean).mean()
 
                 # Update meters
                 loss_meter.add(loss.item())
+                msssim_meter.add(msssim.item())
                 batch_time_meter.add(time.time() - end)
                 end = time.time()
 
@@ -222,8 +244,10 @@ def validate(args, val_loader, model, criterion, training_iters, summary_writer)
     average_loss = loss_meter.mean
     # Write average loss to tensorboard
     summary_writer.add_scalar('Test/Loss', average_loss, training_iters)
+    summary_writer.add_scalar('Test/MS-SSIM', msssim_meter.mean, training_iters)
 
     print("===> Average total loss: {:4f}".format(average_loss))
+    print("===> Average MS-SSIM score: {:.4f}".format(msssim_meter.mean))
     print("===> Average batch time: {:.4f}".format(batch_time_meter.mean))
 
     return average_loss
@@ -231,32 +255,101 @@ def validate(args, val_loader, model, criterion, training_iters, summary_writer)
 
 def log_images(noisy_image, denoised_image, clean_image,
                summary_writer, n_samples, training_iters, prefix):
-    summary_writer.add_image(
-        str(prefix) + '/denoised_images', vutils.make_grid(denoised_image.data[:n_samples], normalize=True,
-                                                           scale_each=True), training_iters)
-    summary_writer.add_image(
-        str(prefix) + '/clean_images', vutils.make_grid(clean_image.data[:n_samples], normalize=True,
-                                                        scale_each=True), training_iters)
-    summary_writer.add_image(
-        str(prefix) + '/noisy_images', vutils.make_grid(noisy_image.data[:n_samples], normalize=True,
-                                                        scale_each=True), training_iters)
-
-
-def evaluate(args, model, data_loader):
+    for name, images in (('denoised_images', denoised_image), ('clean_images', clean_image),
+                         ('noisy_images', noisy_image)):
+        tag = str(prefix) + '/' + name
+        if isinstance(summary_writer, BackgroundSummaryWriter):
+            # the grid is built by the background thread
+            summary_writer.add_image_grid(tag, images.data[:n_samples], training_iters)
+        else:
+            summary_writer.add_image(
+                tag, vutils.make_grid(images.data[:n_samples], normalize=True, scale_each=True), training_iters)
+
+
+def evaluation_vgg_loss(args, criterion=None):
+    """
+    The VGG loss to pass to every `evaluate` of a run, so that its weights are loaded once:
+    the training `criterion` if it is a VGG loss constructed from `args`, or a new one
+    """
+    if isinstance(criterion, VGGLoss) and args.args_to_loss:
+        return criterion
+    return VGGLoss(args)
+
+
+def _evaluation_metrics(args, vgg_loss_calculator=None):
+    """
+    Constructors of the evaluation metrics, by the name of their per-sample results. The names
+    include the settings specific to one metric; the evaluation cache key includes the others.
+    """
+    return {
+        'psnr': lambda: PSNR(data_range=1),
+        'ssim': lambda: SSIM(data_range=1, channels=args.cnn_in_channels),
+        'msssim': lambda: MSSSIM(data_range=1, channels=args.cnn_in_channels),
+        f'vgg_loss_{args.vgg_feature_layer}': lambda: vgg_loss_calculator if vgg_loss_calculator is not None else VGGLoss(args),
+    }
+
+
+def evaluate(args, model, data_loader, vgg_loss_calculator=None):
+    """
+    Evaluate a model with the PSNR, SSIM, MS-SSIM and VGG loss of every sample of `data_loader`.
+    With `args.evaluation_cache`, the per-sample results are stored in that directory, keyed by the
+    model weights, the samples and the metric settings, and only metrics without stored results
+    are computed.
+
+    Returns:
+        the average PSNR, SSIM, VGG loss and MS-SSIM
+    """
+    metrics = _evaluation_metrics(args, vgg_loss_calculator)
+    results, cache = {}, None
+    if args.evaluation_cache:
+        metric_settings = {'data_range': 1, 'channels': args.cnn_in_channels,
+                           'vgg_weights': weights_fingerprint(args.vgg_weights)}
+        key = evaluation_key(model, data_loader.dataset, metric_settings)
+        cache = EvaluationCache(args.evaluation_cache, key)
+        results = cache.load()
+
+    missing = {name: constructor() for name, constructor in metrics.items() if name not in results}
+    if missing:
+        computed = _evaluate_samples(args, model, data_loader, missing)
+        if 'index' in results and not np.array_equal(results['index'], computed['index']):
+            if np.array_equal(np.sort(results['index']), np.sort(computed['index'])):
+                # stored for another order of the samples: put the stored results in this order
+                ranks = np.argsort(np.argsort(computed['index']))
+                order = np.argsort(results['index'])[ranks]
+                results = {name: values[order] for name, values in results.items()}
+            else:
+                results = {}
+                computed = _evaluate_samples(args, model, data_loader,
+                                             {name: constructor() for name, constructor in metrics.items()})
+        results.update(computed)
+        if cache is not None:
+            cache.save(results)
+    else:
+        print("===> Loaded evaluation results from '{}'".format(cache.path))
+
+    average_psnr, average_ssim, average_msssim, average_vgg_loss = \
+        (float(results[name].mean()) for name in metrics)
+    print("===> Average PSNR score: {:4f}".format(average_psnr))
+    print("===> Average SSIM score: {:.4f}".format(average_ssim))
+    print("===> Average MS-SSIM score: {:.4f}".format(average_msssim))
+    print("===> Average VGG loss: {:4f}".format(average_vgg_loss))
+
+    return average_psnr, average_ssim, average_vgg_loss, average_msssim
+
+
+def _evaluate_samples(args, model, data_loader, calculators):
+    """
+    Results of each of `calculators` for every sample of `data_loader`, as arrays by name,
+    along with the sample indices
+    """
     # Average meters
     batch_time_meter = AverageValueMeter()
-    psnr_meter = AverageValueMeter()
-    ssim_meter = AverageValueMeter()
-    vgg_loss_meter = AverageValueMeter()
+    meters = {name: AverageValueMeter() for name in calculators}
+    results = {name: [] for name in ('index', *calculators)}
 
-    psnr_calculator = PSNR(data_range=1)
-    ssim_calculator = SSIM(data_range=1, channels=args.cnn_in_channels)
-    vgg_loss_calculator = VGGLoss(args)
-
-    if args.cuda:
-        psnr_calculator.cuda()
-        ssim_calculator.cuda()
-        vgg_loss_calculator.cuda()
+    for calculator in calculators.values():
+        if args.cuda:
+            calculator.cuda()
 
     # Switch to evaluation mode
     model.eval()
@@ -264,6 +357,7 @@ def evaluate(args, model, data_loader):
     with torch.no_grad():
         end = time.time()
         steps = len(data_loader)
+        num_samples = 0
         # Start progress bar. Maximum value = number of batches.
         with tqdm(total=steps) as pbar:
             # Iterate through the validation batch samples
@@ -272,6 +366,8 @@ def evaluate(args, model, data_loader):
                 clean = sample['clean']
                 iso = sample['iso']
                 class_labels = sample['class'].squeeze(-1)
+                index = sample.get('index', torch.arange(num_samples, num_samples + len(noisy)))
+                num_samples += len(noisy)
 
                 # Send inputs to correct device
                 noisy = noisy.cuda() if args.cuda else noisy
@@ -279,34 +375,23 @@ def evaluate(args, model, data_loader):
                 iso = iso.cuda() if args.cuda else iso
                 class_labels = class_labels.cuda() if args.cuda else class_labels
 
-                # Denoise the image and calculate the loss wrt target clean image
+                # Denoise the image and calculate the metrics wrt target clean image, per sample
                 denoised = model(noisy, iso, class_labels)
-                psnr = psnr_calculator(denoised, clean).mean()
-                ssim = ssim_calculator(denoised, clean).mean()
-                vgg_loss = vgg_loss_calculator(denoised, clean)
-
-                # Update meters
-                psnr_meter.add(psnr.item())
-                ssim_meter.add(ssim.item())
-                vgg_loss_meter.add(vgg_loss.item())
+                results['index'].append(torch.as_tensor(index))
+                for name, calculator in calculators.items():
+                    if isinstance(calculator, VGGLoss):
+                        value = calculator(denoised, clean, reduction='none')
+                    else:
+                        value = calculator(denoised, clean)
+                    results[name].append(value.cpu())
+                    meters[name].add(value.mean().item())
 
                 batch_time_meter.add(time.time() - end)
                 end = time.time()
 
                 # Update progress bar
-                pbar.set_postfix(psnr=psnr_meter.mean)
-                pbar.set_postfix(ssim=ssim_meter.mean)
-                pbar.set_postfix(ssim=vgg_loss_meter.mean)
+                pbar.set_postfix({name: meter.mean for name, meter in meters.items()})
                 pbar.update()
 
-    average_psnr = psnr_meter.mean
-    average_ssim = ssim_meter.mean
-    average_vgg_loss = vgg_loss_meter.mean
-    # Write average loss to tensorboard
-    print("===> Average PSNR score: {:4f}".format(average_psnr))
-    print("===> Average SSIM score: {:.4f}".format(average_ssim))
-    print("===> Average VGG loss: {:4f}".format(average_vgg_loss))
     print("===> Average batch time: {:.4f}".format(batch_time_meter.mean))
-    # TODO: Save results to a csv/text file
-
-    return average_psnr, average_ssim, average_vgg_loss
+    return {name: torch.cat(values).numpy() for name, values in results.items()}
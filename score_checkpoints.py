@@ -0,0 +1,18 @@
+"""Score every checkpoint of a training run on its validation set, in parallel"""
+import argparse
+
+from optimisation.scoring import score_checkpoints
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('run_dir', help="results directory of the run, with its checkpoints and denoising.config")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="number of scoring processes (default: one per CPU)")
+    parser.add_argument('--stacked', action='store_true',
+                        help="run all checkpoints together, with one vectorized forward per batch")
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help="with --stacked, number of checkpoints to run at once (default: all)")
+    arguments = parser.parse_args()
+    print(score_checkpoints(arguments.run_dir, arguments.processes, stacked=arguments.stacked,
+                            chunk_size=arguments.chunk_size).to_string())
@@ -1,3 +1,5 @@
 from pathlib import Path
 
+from benchmarks.synthetic import make_transformed_dataset
+
 ROOT_DIR: str = Path(__file__).resolve().parent.parent
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import torch
+
+from models import GatedCNN, DenseGatedCNN
+from optimisation.distillation import Distiller
+
+
+def _args(**kwargs):
+    args = SimpleNamespace(cnn_in_channels=3, cnn_hidden_channels=8, cnn_hidden_layers=1, num_classes=0,
+                           residual=True, iso=True, fused_gates=False, learn_beta=True,
+                           dense_growth_channels=None, self_attention=False,
+                           attention_window=0)
+    args.__dict__.update(kwargs)
+    return args
+
+
+def test_teacher_output_cache():
+    teacher = DenseGatedCNN(_args(cnn_hidden_channels=16))
+    student = GatedCNN(_args())
+    distiller = Distiller(teacher, student, torch.nn.MSELoss(), cache_size=10)
+
+    calls = []
+    teacher.register_forward_hook(lambda module, inputs, output: calls.append(len(output)))
+    noisy, iso, class_labels = torch.rand(10, 3, 8, 8), torch.randn(10, 1), torch.zeros(10, dtype=torch.long)
+    expected = teacher(noisy, iso, class_labels)
+    calls.clear()
+
+    for index in (torch.tensor([1, 4, 7]), torch.tensor([4, 7, 9]), torch.tensor([9, 1])):
+        outputs = distiller.teacher_outputs(noisy[index], iso[index], class_labels[index], index)
+        torch.testing.assert_close(outputs, expected[index], atol=1e-3, rtol=1e-3)
+    # only the samples that were not seen before are run through the teacher
+    assert calls == [3, 1]
+
+
+def test_feature_matching():
+    teacher = DenseGatedCNN(_args(cnn_hidden_channels=16))
+    student = GatedCNN(_args())
+    distiller = Distiller(teacher, student, torch.nn.MSELoss(), feature_weight=1., cache_size=10)
+    noisy, iso = torch.rand(2, 3, 8, 8), torch.randn(2, 1)
+
+    denoised = student(noisy, iso)
+    loss = distiller(torch.nn.functional.mse_loss(denoised, noisy), denoised, noisy, iso, None,
+                     torch.tensor([0, 1]))
+    loss.backward()
+    assert distiller.adapter.weight.grad is not None
+    assert all(parameter.grad is None for parameter in teacher.parameters())
@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import Subset
+from torchvision.models import vgg
+
+from models import GatedCNN
+from optimisation.evaluation_cache import evaluation_key, EvaluationCache
+
+
+def _model():
+    args = SimpleNamespace(cnn_in_channels=3, cnn_hidden_channels=4, cnn_hidden_layers=1, residual=True,
+                           iso=True, use_class=False, learn_beta=False, num_classes=0, fused_gates=False,
+                           self_attention=False, attention_window=0)
+    return GatedCNN(args)
+
+
+def test_evaluation_key(tmp_path):
+    model, dataset = _model(), list(range(10))
+    key = evaluation_key(model, Subset(dataset, [1, 3]), {'data_range': 1})
+    assert key == evaluation_key(model, Subset(dataset, [1, 3]), {'data_range': 1})
+    assert key != evaluation_key(model, Subset(dataset, [1, 4]), {'data_range': 1})
+    assert key != evaluation_key(model, Subset(dataset, [1, 3]), {'data_range': 2})
+    with torch.no_grad():
+        next(model.parameters())[0] += 1e-3
+    assert key != evaluation_key(model, Subset(dataset, [1, 3]), {'data_range': 1})
+
+    cache = EvaluationCache(tmp_path, key)
+    assert cache.load() == {}
+    cache.save({'index': np.arange(2), 'psnr': np.ones(2)})
+    np.testing.assert_equal(cache.load(), {'index': np.arange(2), 'psnr': np.ones(2)})
+
+
+def test_evaluate_cache(tmp_path):
+    pytest.importorskip('torchnet')
+    from optimisation.training import evaluate
+
+    weights = tmp_path / 'vgg19.pth'
+    torch.save({'features.' + key: value for key, value in vgg.make_layers(vgg.cfgs['E']).state_dict().items()},
+               weights)
+    args = SimpleNamespace(cuda=False, cnn_in_channels=3, vgg_feature_layer=22, vgg_weights=weights,
+                           evaluation_cache=tmp_path / 'cache')
+    samples = [{'noisy': torch.rand(3, 3, 24, 24), 'clean': torch.rand(3, 3, 24, 24), 'iso': torch.rand(3, 1),
+                'class': torch.zeros(3, 1, dtype=torch.long), 'index': torch.arange(3) + 3 * batch_no}
+               for batch_no in range(2)]
+    loader = type('Loader', (), {'dataset': list(range(6)), '__iter__': lambda self: iter(samples),
+                                 '__len__': lambda self: len(samples)})()
+    model = _model()
+
+    results = evaluate(args, model, loader)
+    cache_file, = (tmp_path / 'cache').iterdir()
+    columns = dict(np.load(cache_file))
+    assert set(columns) == {'index', 'psnr', 'ssim', 'msssim', 'vgg_loss_22'}
+    np.testing.assert_equal(columns['index'], np.arange(6))
+    assert results[0] == pytest.approx(columns['psnr'].mean())
+
+    # Cached results are reused
+    stored_samples = samples[:]
+    samples.clear()
+    assert evaluate(args, model, loader) == pytest.approx(results)
+
+    # and only missing metrics are computed
+    del columns['msssim']
+    np.savez(cache_file, **columns)
+    samples.extend(stored_samples)
+    assert evaluate(args, model, loader) == pytest.approx(results)
+    assert set(np.load(cache_file)) == {'index', 'psnr', 'ssim', 'msssim', 'vgg_loss_22'}
+
+    # also when the samples come in another order
+    columns = dict(np.load(cache_file))
+    del columns['msssim']
+    np.savez(cache_file, **columns)
+    samples.reverse()
+    assert evaluate(args, model, loader) == pytest.approx(results)
+    reordered = dict(np.load(cache_file))
+    np.testing.assert_equal(reordered['index'], [3, 4, 5, 0, 1, 2])
+    for name in ('psnr', 'ssim', 'vgg_loss_22'):
+        np.testing.assert_allclose(reordered[name], np.concatenate([columns[name][3:], columns[name][:3]]))
+
+    # other VGG weights are evaluated anew
+    torch.save(torch.load(weights), weights)
+    evaluate(args, model, loader)
+    assert len(list((tmp_path / 'cache').iterdir())) == 2
@@ -1,9 +1,11 @@
 import numpy as np
+import pytest
 from skimage import io, measure, color
 import torch
 
 from tests.common import ROOT_DIR
-from utils.metrics import SSIM, PSNR
+from utils.metrics import SSIM, PSNR, MSSSIM, StreamingPSNR, StreamingSSIM
+from utils.metrics.ssim import ssim, _create_window, _gaussian
 
 RTOL = 1e-7
 
@@ -92,3 +94,85 @@ def test_ssim_multi_ch_identical():
 
         result = ssim(im_tensor, im_tensor).numpy()
         np.testing.assert_allclose(result, 1., rtol=RTOL)
+
+
+def _reference_ssim_maps(img1, img2, window_size=11):
+    """SSIM and contrast sensitivity maps, filtered with the full 2D Gaussian window"""
+    window_size = min(window_size, *img1.shape[2:])
+    window_1d = _gaussian(window_size, 1.5).to(img1.dtype)
+    window = (window_1d[:, None] * window_1d[None]).expand(img1.size(1), 1, window_size, window_size)
+
+    def _filter(x):
+        return torch.nn.functional.conv2d(x, window, groups=img1.size(1))
+
+    mu1, mu2 = _filter(img1), _filter(img2)
+    sigma1_sq = _filter(img1 * img1) - mu1 ** 2
+    sigma2_sq = _filter(img2 * img2) - mu2 ** 2
+    sigma12 = _filter(img1 * img2) - mu1 * mu2
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    cs_map = (2 * sigma12 + c2) / (sigma1_sq + sigma2_sq + c2)
+    return (2 * mu1 * mu2 + c1) / (mu1 ** 2 + mu2 ** 2 + c1) * cs_map, cs_map
+
+
+def test_ssim_separable_window():
+    """The separable Gaussian filter matches filtering with the full 2D window"""
+    torch.manual_seed(0)
+    img1, img2 = torch.rand(2, 2, 3, 20, 9, dtype=torch.float64)   # the window is truncated to 9
+    desired = _reference_ssim_maps(img1, img2)[0].mean(dim=(1, 2, 3))
+    np.testing.assert_allclose(ssim(img1, img2, data_range=1).numpy(), desired.numpy(), rtol=RTOL)
+
+
+def test_ssim_window():
+    """A 2D window given to `ssim` replaces the Gaussian window, and the cache of those stays small"""
+    torch.manual_seed(0)
+    img1, img2 = torch.rand(2, 2, 3, 20, 16, dtype=torch.float64)
+    window_1d = _gaussian(7, 1.5).to(img1.dtype)
+    window = (window_1d[:, None] * window_1d[None]).expand(3, 1, 7, 7)
+    desired = _reference_ssim_maps(img1, img2, window_size=7)[0].mean(dim=(1, 2, 3))
+    np.testing.assert_allclose(ssim(img1, img2, data_range=1, window=window).numpy(), desired.numpy(), rtol=RTOL)
+    with pytest.raises(ValueError, match="window"):
+        ssim(img1, img2, data_range=1, window=window[:1])
+
+    for window_size in range(3, 20):
+        ssim(img1, img2, data_range=1, window_size=window_size)
+    assert _create_window.cache_info().currsize <= 8
+
+
+# MS-SSIM of the example clean and noisy images, cropped to 331 x 250 pixels so that the pyramid
+# pads odd sizes, computed with pytorch_msssim 1.0.0 (`ms_ssim(..., data_range=255, size_average=False)`)
+MSSSIM_FIXTURES = {'building': 0.8686890070337352, 'foliage': 0.9444953944615039, 'text': 0.9330352143392652}
+
+
+def _load_example_pair(name):
+    def _load(kind):
+        image = io.imread(f"{ROOT_DIR}/example_images/{kind}_{name}.png")[:331, :250, :3]
+        return torch.from_numpy(image.astype(np.float64)).permute(2, 0, 1)
+    return _load('clean'), _load('noisy')
+
+
+def test_msssim():
+    """Test MS-SSIM against the values of an independent implementation"""
+    clean, noisy = (torch.stack(images) for images in zip(*map(_load_example_pair, MSSSIM_FIXTURES)))
+    result = MSSSIM(data_range=255, channels=3)(clean, noisy)
+    np.testing.assert_allclose(result.numpy(), list(MSSSIM_FIXTURES.values()), rtol=1e-6)
+
+
+def test_streaming_metrics():
+    """Test PSNR and SSIM of images fed in bands of varying heights against the whole images"""
+    torch.manual_seed(0)
+    img1 = torch.rand(2, 3, 67, 45)
+    img2 = (img1 + 0.1 * torch.randn_like(img1)).clamp(0, 1)
+
+    for bands in ([67], [1, 4, 20, 3, 30, 9], [12] * 5 + [7], [5, 2]):
+        height = sum(bands)
+        psnr, streaming_ssim = StreamingPSNR(data_range=1), StreamingSSIM(data_range=1)
+        for start, band in zip(np.cumsum([0] + bands[:-1]), bands):
+            psnr.update(img2[:, :, start:start + band], img1[:, :, start:start + band])
+            streaming_ssim.update(img1[:, :, start:start + band], img2[:, :, start:start + band])
+
+        np.testing.assert_allclose(psnr.compute().numpy(),
+                                   PSNR(data_range=1)(img2[:, :, :height], img1[:, :, :height]).numpy(),
+                                   rtol=RTOL)
+        np.testing.assert_allclose(streaming_ssim.compute().numpy(),
+                                   ssim(img1[:, :, :height], img2[:, :, :height], data_range=1).numpy(),
+                                   rtol=RTOL)
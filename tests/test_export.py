@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from PIL import Image
+
+from tests.common import ROOT_DIR
+from models import SimpleCNN, GatedCNN, DenseGatedCNN
+from models.export import export_onnx, OnnxRuntimeModel
+from utils.loader import transform_sample
+
+pytest.importorskip('onnxscript')
+pytest.importorskip('onnxruntime')
+
+
+@pytest.mark.parametrize('model_class, num_classes, fused', [
+    (SimpleCNN, 0, False),
+    (GatedCNN, 3, False),
+    (GatedCNN, 3, True),
+    (DenseGatedCNN, 0, True),
+])
+def test_onnx_parity(tmp_path, model_class, num_classes, fused):
+    args = SimpleNamespace(cnn_in_channels=3, cnn_hidden_channels=8, cnn_hidden_layers=1, num_classes=num_classes,
+                           residual=True, iso=True, fused_gates=fused, learn_beta=True, dense_growth_channels=None,
+                           self_attention=False, attention_window=0)
+    model = model_class(args).eval()
+    export_onnx(model, tmp_path / 'model.onnx')
+    exported = OnnxRuntimeModel(tmp_path / 'model.onnx')
+
+    image = Image.open(f"{ROOT_DIR}/tests/test_data/Category/Noisy/Test_image.png").convert('RGB')
+    sample = transform_sample({'noisy': image, 'iso': 1600, 'class': 'text'})
+    noisy, iso, class_labels = sample['noisy'][None], sample['iso'][None], sample['class']
+
+    # The exported graph accepts other batch sizes and image sizes than it was exported with
+    for batch in ((noisy, iso, class_labels), (torch.cat([noisy, noisy.flip(-1)]), iso.repeat(2, 1),
+                                               class_labels.repeat(2))):
+        with torch.no_grad():
+            expected = model(*batch)
+        torch.testing.assert_close(exported(*batch), expected, atol=1e-4, rtol=1e-4)
@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+from benchmarks import layers
+
+
+@pytest.mark.parametrize('name', ['ComplexBatchNorm2d', 'PSNR'])
+def test_time_layer(name):
+    timings = layers.time_layer(name, batch=2, channels=3, size=8, min_run_time=0.01)
+    assert set(timings) == {'forward_ms', 'forward_backward_ms'}
+    assert all(milliseconds > 0 for milliseconds in timings.values())
+
+
+def test_compare(tmp_path):
+    baseline = {'environment': layers.environment(),
+                'results': {'PSNR/b16-c3-s64': {'forward_ms': 1.0, 'forward_backward_ms': 2.0},
+                            'SSIM/b16-c3-s64': {'forward_ms': 4.0, 'forward_backward_ms': 8.0}}}
+    current = {'environment': layers.environment(),
+               'results': {'PSNR/b16-c3-s64': {'forward_ms': 1.05, 'forward_backward_ms': 3.0},
+                           'SSIM/b16-c3-s64': {'forward_ms': 2.0, 'forward_backward_ms': 8.0}}}
+    assert layers.compare(baseline, current) == [('PSNR/b16-c3-s64', 'forward_backward_ms', 2.0, 3.0)]
+    assert layers.compare(baseline, current, threshold=0.6) == []
+
+    paths = []
+    for name, results in (('baseline', baseline), ('current', current)):
+        paths.append(tmp_path / f'{name}.json')
+        paths[-1].write_text(json.dumps(results))
+    assert layers.main(['compare', *map(str, paths)]) == 1
+    assert layers.main(['compare', *map(str, paths), '--threshold', '0.6']) == 0
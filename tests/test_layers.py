@@ -0,0 +1,392 @@
+import copy
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from models.layers import (GatedConv2d, FusedGatedConv2d, GatedConvTranspose2d, FusedGatedConvTranspose2d,
+                           ConvLayer, GatedConvLayer, SelfAttention)
+from models.complex_layers import (ComplexConv2d, ComplexGatedConv2d, FusedComplexGatedConv2d, ComplexBatchNorm2d,
+                                   _channelwise_moments)
+from models.conversion import (fuse_gated_convs, unfuse_gated_convs, fold_norms, specialize_iso,
+                               ISOSpecializedModel)
+from models.densenet import RDDB, DenseGatedCNN, ResidualDenseBlock
+from models.simple_cnn import SimpleCNN, GatedCNN
+from models.pruning import prune_channels
+from models.ensemble import StackedModels
+from models.quantization import quantize_static, load_quantized
+
+ATOL = 1e-6
+
+
+def _check_fused_equivalence(unfused, fused_class, x, c):
+    fused = fused_class(unfused.in_channels, unfused.out_channels, padding=1,
+                        local_condition=unfused.local_condition)
+    fused.load_state_dict(unfused.state_dict())  # two-convolution layout is converted on load
+    torch.testing.assert_close(fused(x, c), unfused(x, c), atol=ATOL, rtol=0)
+
+    # and back again
+    unfused.load_state_dict(fused.state_dict())
+    torch.testing.assert_close(fused(x, c), unfused(x, c), atol=ATOL, rtol=0)
+
+
+def test_fused_gated_conv():
+    x = torch.randn(4, 3, 12, 12)
+    c = torch.randn(4)
+    for local_condition in (False, True):
+        conv = GatedConv2d(3, 8, local_condition=local_condition)
+        _check_fused_equivalence(conv, FusedGatedConv2d, x, c)
+
+
+def test_fused_gated_conv_transpose():
+    x = torch.randn(4, 3, 12, 12)
+    c = torch.randn(4)
+    for local_condition in (False, True):
+        conv = GatedConvTranspose2d(3, 8, local_condition=local_condition)
+        _check_fused_equivalence(conv, FusedGatedConvTranspose2d, x, c)
+
+
+def test_fused_complex_gated_conv():
+    x = torch.randn(4, 3, 12, 7, dtype=torch.cfloat)
+    c = torch.randn(4)
+    for local_condition in (False, True):
+        conv = ComplexGatedConv2d(3, 8, local_condition=local_condition)
+        _check_fused_equivalence(conv, FusedComplexGatedConv2d, x, c)
+
+
+def test_fuse_model():
+    model = torch.nn.Sequential(GatedConv2d(3, 8), GatedConv2d(8, 8, local_condition=True)).eval()
+    x = torch.randn(2, 3, 10, 10)
+    expected = model[1](model[0](x), torch.full((2,), 0.5))
+
+    fused = fuse_gated_convs(model)
+    assert all(isinstance(layer, FusedGatedConv2d) for layer in fused)
+    torch.testing.assert_close(fused[1](fused[0](x), torch.full((2,), 0.5)), expected,
+                               atol=ATOL, rtol=0)
+
+    unfused = unfuse_gated_convs(fused)
+    assert all(isinstance(layer, GatedConv2d) for layer in unfused)
+    assert 'conv_features.weight' in unfused[0].state_dict()
+
+
+def test_complex_conv():
+    x = torch.randn(4, 3, 12, 7, dtype=torch.cfloat)
+    conv = ComplexConv2d(3, 8, kernel_size=3, padding=1)
+    torch.nn.init.normal_(conv.bias)
+
+    expected = torch.nn.functional.conv2d(x, conv.weight, conv.bias, padding=1)
+    torch.testing.assert_close(conv(x), expected, atol=1e-5, rtol=0)
+
+    # the output is channels last, which the next complex convolution reads without copying
+    out = conv(x)
+    assert out.is_contiguous(memory_format=torch.channels_last)
+    assert out.contiguous(memory_format=torch.channels_last).data_ptr() == out.data_ptr()
+    next_conv = ComplexConv2d(8, 2, kernel_size=1)
+    torch.testing.assert_close(next_conv(out), torch.nn.functional.conv2d(expected, next_conv.weight, next_conv.bias),
+                               atol=1e-5, rtol=0)
+
+
+def test_complex_legacy_checkpoint():
+    """Checkpoints storing complex values in a trailing dimension of size 2 are converted on load"""
+    conv = ComplexConv2d(3, 8, kernel_size=3, padding=1)
+    legacy_state = {
+        'conv_real.weight': torch.randn(8, 3, 3, 3),
+        'conv_im.weight': torch.randn(8, 3, 3, 3),
+        'bias': torch.randn(1, 8, 1, 1, 2),
+    }
+    conv.load_state_dict(legacy_state)
+    torch.testing.assert_close(conv.weight.real, legacy_state['conv_real.weight'])
+    torch.testing.assert_close(conv.weight.imag, legacy_state['conv_im.weight'])
+    torch.testing.assert_close(torch.view_as_real(conv.bias), legacy_state['bias'].view(8, 2))
+
+    gated = FusedComplexGatedConv2d(3, 8, local_condition=True)
+    gated.load_state_dict({
+        'conv_features.conv_real.weight': torch.randn(8, 3, 3, 3),
+        'conv_features.conv_im.weight': torch.randn(8, 3, 3, 3),
+        'conv_gate.conv_real.weight': torch.randn(8, 3, 3, 3),
+        'conv_gate.conv_im.weight': torch.randn(8, 3, 3, 3),
+        'cond_features_bias': torch.randn(1, 8, 1, 1, 2),
+        'cond_gate_bias': torch.randn(1, 8, 1, 1, 2),
+        'downsample.0.conv_real.weight': torch.randn(8, 3, 1, 1),
+        'downsample.0.conv_im.weight': torch.randn(8, 3, 1, 1),
+        'downsample.0.bias': torch.randn(1, 8, 1, 1, 2),
+    })
+
+
+def _reference_complex_batch_norm(x, eps, gamma_rr, gamma_ii, gamma_ri, beta):
+    """Two-pass complex batch norm in training mode"""
+    centered = x - x.mean(dim=(0, 2, 3), keepdim=True)
+    centered_real, centered_im = centered.real, centered.imag
+    Vrr = centered_real.pow(2).mean(dim=(0, 2, 3), keepdim=True) + eps
+    Vii = centered_im.pow(2).mean(dim=(0, 2, 3), keepdim=True) + eps
+    Vri = (centered_real * centered_im).mean(dim=(0, 2, 3), keepdim=True)
+
+    # W = V^(-1/2), computed by eigendecomposition
+    V = torch.stack([Vrr.flatten(), Vri.flatten(), Vri.flatten(), Vii.flatten()], -1).view(-1, 2, 2)
+    eigenvalues, eigenvectors = torch.linalg.eigh(V.double())
+    W = (eigenvectors @ torch.diag_embed(eigenvalues.rsqrt()) @ eigenvectors.transpose(-1, -2)).float()
+    W = W.view(1, -1, 1, 1, 2, 2)
+    out_real = W[..., 0, 0] * centered_real + W[..., 0, 1] * centered_im
+    out_im = W[..., 1, 0] * centered_real + W[..., 1, 1] * centered_im
+
+    out_real = gamma_rr * out_real + gamma_ri * out_im
+    out_im = gamma_ri * out_real + gamma_ii * out_im
+    return torch.complex(out_real, out_im) + beta
+
+
+def test_complex_batch_norm():
+    x = torch.randn(6, 4, 12, 7, dtype=torch.cfloat) * 3 + (1 - 2j)
+    x = x + 0.5 * x.real  # correlate the real and imaginary parts
+    bn = ComplexBatchNorm2d(4)
+    for parameter in (bn.gamma_rr, bn.gamma_ii, bn.gamma_ri, bn.beta):
+        torch.nn.init.normal_(parameter)
+
+    running_mean_real = bn.running_mean_real
+    expected = _reference_complex_batch_norm(x, bn.eps, bn.gamma_rr, bn.gamma_ii, bn.gamma_ri, bn.beta)
+    torch.testing.assert_close(bn(x), expected, atol=1e-4, rtol=0)
+
+    # running statistics are updated in place, outside of autograd
+    assert bn.running_mean_real is running_mean_real
+    assert not running_mean_real.requires_grad
+    torch.testing.assert_close(running_mean_real.flatten(), 0.9 * x.real.mean(dim=(0, 2, 3)), atol=1e-5, rtol=0)
+
+    bn.eval()
+    torch.testing.assert_close(bn.fold()(x), bn(x), atol=1e-5, rtol=0)
+
+
+def test_complex_batch_norm_large_mean():
+    """Moments of inputs whose mean is large against their spread, which cancel if not centred"""
+    torch.manual_seed(0)
+    x = torch.randn(8, 4, 16, 16, dtype=torch.cfloat) * 0.01 + (100 + 100j)
+    _, _, Vrr, Vii, Vri = _channelwise_moments(x)
+    centered = torch.view_as_real(x.to(torch.cdouble) - x.to(torch.cdouble).mean(dim=(0, 2, 3), keepdim=True))
+    torch.testing.assert_close(Vrr.flatten().double(), centered[..., 0].pow(2).mean(dim=(0, 2, 3)),
+                               rtol=1e-3, atol=1e-8)
+    torch.testing.assert_close(Vri.flatten().double(), (centered[..., 0] * centered[..., 1]).mean(dim=(0, 2, 3)),
+                               rtol=1e-3, atol=1e-8)
+    assert (Vii > 0).all()
+    assert ComplexBatchNorm2d(4)(x).isfinite().all()
+
+
+def _randomize_norm_statistics(model):
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.normal_()
+            module.running_var.uniform_(0.5, 2)
+            if module.affine:
+                torch.nn.init.normal_(module.weight)
+                torch.nn.init.normal_(module.bias)
+    return model.eval()
+
+
+def test_fold_norms():
+    layers = torch.nn.ModuleList([
+        ConvLayer(3, 8),
+        GatedConvLayer(8, 8, local_condition=True),
+        GatedConvLayer(8, 6, local_condition=True, num_classes=3, fused=True),
+        GatedConvLayer(6, 6, conv_residual=False),
+        ConvLayer(6, 3, num_classes=3),
+    ])
+    _randomize_norm_statistics(layers)
+    for layer in layers:
+        if layer.conditional_norm:
+            torch.nn.init.normal_(layer.norm.embed.weight)
+
+    def _forward(model, x, c, class_labels):
+        for layer in model:
+            x = layer(x, c, class_labels)
+        return x
+
+    folded = fold_norms(copy.deepcopy(layers))
+    assert not any(isinstance(module, torch.nn.BatchNorm2d) for module in folded.modules())
+
+    x = torch.randn(4, 3, 10, 10)
+    c = torch.randn(4, 1)
+    for class_labels in (torch.tensor([0, 2, 1, 2]), torch.tensor([1])):
+        batch = len(class_labels)
+        torch.testing.assert_close(_forward(folded, x[:batch], c[:batch], class_labels),
+                                   _forward(layers, x[:batch], c[:batch], class_labels),
+                                   atol=1e-5, rtol=1e-5)
+
+
+def test_specialize_iso():
+    model = torch.nn.Sequential(GatedConvLayer(3, 8, local_condition=True, fused=True),
+                                RDDB(8, 4, local_condition=True, learn_beta=True))
+    for parameter in model.parameters():
+        torch.nn.init.normal_(parameter, std=0.1)
+    _randomize_norm_statistics(model)
+
+    def _forward(x, c):
+        return model[1](model[0](x, c), c)
+
+    specialized = ISOSpecializedModel(model[0], grid=[-1., 0., 1.])
+    x = torch.randn(2, 3, 10, 10)
+    torch.testing.assert_close(specialized(x, torch.full((2, 1), 0.2)), model[0](x, torch.zeros(2, 1)),
+                               atol=1e-6, rtol=0)
+    specialized(x, torch.full((2, 1), -0.1))
+    assert len(specialized._specializations) == 1
+
+    # the cache follows the weights and dtype of the model
+    specialized.load_state_dict({name: value + 1 for name, value in specialized.state_dict().items()})
+    assert not specialized._specializations
+    torch.testing.assert_close(specialized(x, torch.zeros(2, 1)), model[0](x, torch.zeros(2, 1)), atol=1e-6, rtol=0)
+    assert specialized.double()(x.double(), torch.zeros(2, 1)).dtype == torch.float64
+    model.float()
+
+    unquantized = ISOSpecializedModel(model[0], cache_size=2)
+    for iso in (0.1, 0.2, 0.1, 0.3):
+        unquantized(x, torch.full((2, 1), iso))
+    torch.testing.assert_close(torch.tensor(list(unquantized._specializations)), torch.tensor([0.1, 0.3]))
+
+    full = specialize_iso(model, 0.5)
+    assert not any(module.local_condition for module in full.modules() if isinstance(module, FusedGatedConv2d))
+    torch.testing.assert_close(full[1](full[0](x)), _forward(x, torch.full((2, 1), 0.5)), atol=1e-6, rtol=0)
+
+
+def test_quantize_static():
+    args = SimpleNamespace(cnn_in_channels=3, cnn_hidden_channels=8, cnn_hidden_layers=2, num_classes=3,
+                           residual=True, iso=True, fused_gates=False, learn_beta=True, self_attention=False,
+                           attention_window=0)
+    model = GatedCNN(args).eval()
+    samples = [{'noisy': torch.rand(4, 3, 16, 16) * 2 - 1, 'iso': torch.randn(4, 1),
+                'class': torch.randint(0, 3, (4, 1))} for _ in range(4)]
+    quantized = quantize_static(model, samples)
+
+    x, c, class_labels = torch.rand(2, 3, 16, 16) * 2 - 1, torch.randn(2, 1), torch.tensor([0, 2])
+    with torch.no_grad():
+        expected = model(x, c, class_labels)
+        out = quantized(x, c, class_labels)
+        assert (out - expected).abs().mean() < 0.1
+
+        rebuilt = load_quantized(GatedCNN(args), quantized.state_dict())
+        torch.testing.assert_close(rebuilt(x, c, class_labels), out, atol=0, rtol=0)
+
+    # the model runs on the engine it was quantized for
+    engine = torch.backends.quantized.engine
+    try:
+        quantized = quantize_static(model, samples, backend='qnnpack')
+        torch.backends.quantized.engine = 'x86'
+        rebuilt = load_quantized(GatedCNN(args), quantized.state_dict(), backend='qnnpack')
+        assert torch.backends.quantized.engine == 'qnnpack'
+        with torch.no_grad():
+            assert (rebuilt(x, c, class_labels) - expected).abs().mean() < 0.1
+        with pytest.raises(ValueError, match="not supported"):
+            load_quantized(GatedCNN(args), quantized.state_dict(), backend='tensorrt')
+    finally:
+        torch.backends.quantized.engine = engine
+
+
+def test_prune_channels():
+    x, c, class_labels = torch.rand(2, 3, 16, 16), torch.randn(2, 1), torch.tensor([0, 2])
+    for model_class, fused in ((GatedCNN, False), (GatedCNN, True), (DenseGatedCNN, True)):
+        args = SimpleNamespace(cnn_in_channels=3, cnn_hidden_channels=16, cnn_hidden_layers=1, num_classes=3,
+                               residual=True, iso=True, fused_gates=fused, learn_beta=False,
+                               dense_growth_channels=None, self_attention=False, attention_window=0)
+        model = _randomize_norm_statistics(model_class(args))
+
+        # Without removing channels, the model is unchanged
+        unpruned, _ = prune_channels(model, args, 0.)
+        with torch.no_grad():
+            torch.testing.assert_close(unpruned(x, c, class_labels), model(x, c, class_labels),
+                                       atol=ATOL, rtol=0)
+
+        pruned, pruned_args = prune_channels(model, args, 0.5)
+        num_parameters = sum(parameter.numel() for parameter in pruned.parameters())
+        assert num_parameters < 0.6 * sum(parameter.numel() for parameter in model.parameters())
+        # the settings construct the pruned model
+        model_class(pruned_args).load_state_dict(pruned.state_dict())
+        assert pruned(x, c, class_labels).shape == x.shape
+
+
+def test_self_attention():
+    attention = SelfAttention(16, chunk_size=50)
+    torch.nn.init.normal_(attention.gamma)
+    x = torch.randn(2, 16, 13, 11)
+
+    def _reference(x):
+        """Attention with the full (H * W) x (H * W) attention matrix"""
+        query = attention.query_conv(x).flatten(2).transpose(1, 2)
+        key = attention.key_conv(x).flatten(2)
+        value = attention.value_conv(x).flatten(2)
+        out = torch.bmm(value, torch.softmax(torch.bmm(query, key), dim=-1).transpose(1, 2))
+        return attention.gamma * out.view_as(x) + x
+
+    with torch.no_grad():
+        torch.testing.assert_close(attention(x), _reference(x), atol=1e-5, rtol=0)
+
+        # Windows attend independently, including the partial windows at the borders
+        attention.window_size = 4
+        out = attention(x)
+        for top, left in ((0, 0), (4, 8), (12, 8)):
+            window = x[..., top:top + 4, left:left + 4]
+            torch.testing.assert_close(out[..., top:top + 4, left:left + 4], _reference(window),
+                                       atol=1e-5, rtol=0)
+
+
+def _dense_block_reference(block, x, c):
+    """Output of the last convolution of a dense block, with concatenations"""
+    features = x
+    for conv in (block.conv1, block.conv2, block.conv3, block.conv4):
+        features = torch.cat((features, conv(features, c)), 1)
+    return block.conv5(features, c)
+
+
+def test_dense_block():
+    x, c = torch.randn(2, 8, 6, 6, requires_grad=True), torch.rand(2, 1)
+    for learn_beta, fused in ((True, False), (False, False), (False, True)):
+        block = ResidualDenseBlock(8, 4, learn_beta=learn_beta, local_condition=True, fused=fused)
+        out = block._dense_convs(x, c)
+        expected = _dense_block_reference(block, x, c)
+        torch.testing.assert_close(out, expected, atol=ATOL, rtol=0)
+
+        grad = torch.randn_like(out)
+        grads = torch.autograd.grad(out, [x, *block.parameters()], grad, allow_unused=True)
+        expected_grads = torch.autograd.grad(expected, [x, *block.parameters()], grad, allow_unused=True)
+        for computed, reference in zip(grads, expected_grads):
+            torch.testing.assert_close(computed, reference, atol=1e-5, rtol=0)
+
+    with torch.no_grad():
+        batches = torch.randn(3, 2, 8, 6, 6), torch.rand(3, 2, 1)
+        torch.testing.assert_close(torch.func.vmap(block)(*batches),
+                                   torch.stack([block(*batch) for batch in zip(*batches)]), atol=ATOL, rtol=0)
+
+
+def test_dense_block_memory():
+    block = ResidualDenseBlock(32, 16, local_condition=True, fused=True)
+    x, c = torch.randn(4, 32, 32, 32, requires_grad=True), torch.rand(4, 1)
+
+    def _measure(function):
+        """Bytes of the tensors kept for backward, and bytes allocated by concatenations and copies"""
+        saved = {}
+
+        def _pack(tensor):
+            saved[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+            return tensor
+
+        with torch.autograd.graph.saved_tensors_hooks(_pack, lambda tensor: tensor), \
+                torch.profiler.profile(profile_memory=True) as profile:
+            function(block, x, c)
+        copied = sum(event.cpu_memory_usage for event in profile.key_averages()
+                     if event.key in ('aten::cat', 'aten::clone'))
+        return sum(saved.values()), copied
+
+    saved, copied = _measure(lambda block, x, c: block._dense_convs(x, c))
+    reference_saved, reference_copied = _measure(_dense_block_reference)
+    # only the weights are concatenated, and each feature map is kept once
+    assert copied < 0.1 * reference_copied
+    assert saved < 0.75 * reference_saved
+
+
+def test_stacked_models():
+    x, c, labels = torch.randn(2, 3, 12, 12), torch.rand(2, 1), torch.tensor([0, 2])
+    for model_class, use_class in ((SimpleCNN, False), (GatedCNN, True), (DenseGatedCNN, True)):
+        args = SimpleNamespace(cnn_in_channels=3, cnn_hidden_channels=8, cnn_hidden_layers=2, residual=True,
+                               iso=True, use_class=use_class, learn_beta=True, num_classes=3 if use_class else 0,
+                               fused_gates=False, self_attention=False, attention_window=0,
+                               dense_growth_channels=None)
+        models = [model_class(args).eval() for _ in range(3)]
+        stacked = StackedModels(models, chunk_size=2)
+        with torch.no_grad():
+            expected = torch.stack([model(x, c, labels) for model in models])
+            torch.testing.assert_close(stacked(x, c, labels), expected, atol=1e-5, rtol=0)
+            torch.testing.assert_close(stacked.ensemble(x, c, labels), expected.mean(0), atol=1e-5, rtol=0)
@@ -0,0 +1,47 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from benchmarks import loader
+from benchmarks.synthetic import make_huawei_dataset
+from tests.common import make_transformed_dataset
+from utils.loader import CsvLoader, loader_options
+
+
+def test_synthetic_datasets(tmp_path):
+    make_transformed_dataset(tmp_path / 'transformed', num_originals=2, num_patches=3, size=16)
+    make_huawei_dataset(tmp_path / 'original', num_images=4, size=(24, 32))
+    datasets = loader._datasets(tmp_path / 'transformed', tmp_path / 'original')
+    assert {name: len(dataset) for name, dataset in datasets.items()} == \
+        {'TransformedHuaweiDataset': 6, 'CsvLoader': 6, 'HuaweiDataset': 4}
+    assert datasets['HuaweiDataset'][3]['noisy'].shape == (3, 24, 32)
+
+    sample = CsvLoader(tmp_path / 'transformed' / 'dataset.csv')[4]
+    torch.testing.assert_close(sample['clean'], (datasets['TransformedHuaweiDataset'][4]['clean'] + 1) / 2)
+    assert sample['class'].tolist() == [1]
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_time_loader(tmp_path, num_workers):
+    dataset = loader._datasets(make_transformed_dataset(tmp_path, num_patches=4, size=16), None)['CsvLoader']
+    result = loader.time_loader(dataset, batch_size=4, num_workers=num_workers, batches=4)
+    assert result['samples_per_second'] > 0
+    # 3 timed batches of 4 patches of 2 images of 3 x 16 x 16 floats, and their ISO and class
+    assert result['bytes_per_second'] / result['samples_per_second'] == pytest.approx(2 * 3 * 16 * 16 * 4 + 4 + 8)
+    assert len(result['cpu_utilization']) == max(num_workers, 1)
+
+
+def test_recommendation(tmp_path):
+    results = [{'dataset': 'TransformedHuaweiDataset', 'storage': '/tmp', 'batch_size': 16, 'num_workers': workers,
+                'pin_memory': False, 'prefetch_factor': prefetch, 'samples_per_second': samples}
+               for workers, prefetch, samples in ((0, None, 50), (2, 2, 97), (2, 4, 96), (4, 2, 100))]
+    profile = loader.recommend(results + [{**results[0], 'dataset': 'CsvLoader', 'samples_per_second': 500}])
+    assert (profile['num_workers'], profile['prefetch_factor']) == (2, 2)
+
+    args = SimpleNamespace(workers=4, cuda=False, loader_profile=None)
+    assert loader_options(args) == {'num_workers': 4, 'pin_memory': False}
+    args.loader_profile = tmp_path / 'profile.json'
+    args.loader_profile.write_text(json.dumps({**profile, 'pin_memory': True}))
+    assert loader_options(args) == {'num_workers': 2, 'pin_memory': False, 'prefetch_factor': 2}
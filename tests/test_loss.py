@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn.functional as F
+from torchvision.models import vgg
+
+from optimisation.loss import VGGLoss, SobelMagnitude, EdgeAwareLoss
+
+
+def _vgg_loss(tmp_path):
+    """VGGLoss with random weights, loaded from a file in the layout of torchvision's vgg19"""
+    features = vgg.make_layers(vgg.cfgs['E'])
+    weights = tmp_path / 'vgg19.pth'
+    torch.save({'features.' + key: value for key, value in features.state_dict().items()}, weights)
+    loss = VGGLoss(SimpleNamespace(vgg_feature_layer=22, vgg_weights=weights))
+    for key, value in loss.vgg.state_dict().items():
+        torch.testing.assert_close(value, features.state_dict()[key])
+    return loss
+
+
+def test_vgg_loss_cache(tmp_path):
+    loss = _vgg_loss(tmp_path)
+    denoised, clean = torch.rand(2, 4, 3, 16, 16)
+    index = torch.tensor([3, 1, 0, 5])
+    expected = loss(denoised, clean)
+
+    for cache_file in (None, tmp_path / 'features.bin'):
+        loss.cache_clean_features(6, cache_file)
+        calls = []
+        loss.vgg.register_forward_hook(lambda module, inputs, output: calls.append(len(inputs[0])))
+        torch.testing.assert_close(loss(denoised, clean, index), expected, atol=1e-3, rtol=1e-3)
+        # cached clean features are reused, and only missing ones computed
+        loss(denoised[1:], clean[1:], index[1:])
+        loss(denoised[:2], clean[:2], torch.tensor([2, 3]))
+        assert calls == [4, 4, 3, 2, 1]
+        loss.vgg._forward_hooks.clear()
+
+
+def test_evaluation_vgg_loss(tmp_path):
+    pytest.importorskip('torchnet')
+    from optimisation.training import evaluation_vgg_loss
+
+    criterion = _vgg_loss(tmp_path)
+    args = SimpleNamespace(vgg_feature_layer=22, vgg_weights=tmp_path / 'vgg19.pth', args_to_loss=True)
+    assert evaluation_vgg_loss(args, criterion) is criterion
+    # without `args_to_loss`, the training loss has the default settings rather than those of `args`
+    args.args_to_loss = False
+    assert isinstance(evaluation_vgg_loss(args, criterion), VGGLoss)
+    assert evaluation_vgg_loss(args, criterion) is not criterion
+
+
+def test_edge_aware_loss():
+    images = torch.rand(4, 3, 20, 17)
+    kernel_x = torch.tensor([[1., 0, -1], [2, 0, -2], [1, 0, -1]])[None, None]
+    for out_channels in (3, 6):
+        # each input channel gives out_channels / in_channels output channels
+        repeated = images.repeat_interleave(out_channels // 3, 1)
+        gradients_x = F.conv2d(repeated, kernel_x.expand(out_channels, 1, 3, 3), padding=1, groups=out_channels)
+        gradients_y = F.conv2d(repeated, kernel_x.transpose(2, 3).expand(out_channels, 1, 3, 3), padding=1,
+                               groups=out_channels)
+        expected = (gradients_x ** 2 + gradients_y ** 2 + 1e-5).sqrt()
+        torch.testing.assert_close(SobelMagnitude(3, out_channels)(images), expected)
+
+    loss = EdgeAwareLoss()
+    denoised, clean = images.chunk(2)
+    expected = loss(denoised, clean)
+    loss.cache_clean_edges(5)
+    index = torch.tensor([4, 1])
+    torch.testing.assert_close(loss(denoised, clean, index), expected, atol=1e-3, rtol=1e-3)
+    # the cached edge maps are used, rather than recomputed from the clean images
+    edge_loss = loss.weight * F.mse_loss(loss.sobel(denoised), loss.sobel(clean))
+    torch.testing.assert_close(loss(denoised, denoised, index), edge_loss, atol=1e-3, rtol=1e-3)
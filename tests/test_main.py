@@ -0,0 +1,74 @@
+from dataclasses import replace
+
+import pytest
+import torch
+from torchvision.models import vgg
+
+from tests.common import ROOT_DIR, make_transformed_dataset
+from utils import parse_arguments
+
+pytest.importorskip('torchnet')
+
+
+def _args(tmp_path, **settings):
+    """Settings of a short training run of a small model on a synthetic dataset"""
+    weights = tmp_path / 'vgg19.pth'
+    if not weights.exists():
+        torch.save({'features.' + key: value for key, value in vgg.make_layers(vgg.cfgs['E']).state_dict().items()},
+                   weights)
+        make_transformed_dataset(tmp_path / 'data', num_originals=2, num_patches=4, size=32)
+    args = parse_arguments(ROOT_DIR / 'run_configs' / 'default.yaml')
+    return replace(args, **{'data_dir': tmp_path / 'data', 'test_split': 0.5, 'vgg_weights': weights, 'cuda': False,
+                            'workers': 0, 'train_batch_size': 4, 'test_batch_size': 4, 'num_samples_to_log': 4,
+                            'background_logging': False, 'model': 'GatedCNN', 'cnn_hidden_channels': 4,
+                            'cnn_hidden_layers': 1, 'epochs': 1, **settings})
+
+
+def test_prune_resume(tmp_path):
+    from main import main
+
+    with pytest.raises(ValueError, match="resume"):
+        main(_args(tmp_path, save_dir=tmp_path / 'untrained', prune_ratio=0.5))
+
+    main(_args(tmp_path, save_dir=tmp_path / 'trained'))
+    main(_args(tmp_path, save_dir=tmp_path / 'pruned', resume=tmp_path / 'trained' / 'checkpoint_000.pth.tar',
+               prune_ratio=0.5, epochs=2))
+    pruned_args = torch.load(tmp_path / 'pruned' / 'denoising.config', weights_only=False)
+    assert (pruned_args.cnn_hidden_channels, pruned_args.prune_ratio) == (2, 0)
+
+    # Resuming the fine-tuning, with the same settings, continues it rather than pruning again
+    main(_args(tmp_path, save_dir=tmp_path / 'resumed', resume=tmp_path / 'pruned' / 'checkpoint_000.pth.tar',
+               prune_ratio=0.5, epochs=2))
+    assert sorted(path.name for path in (tmp_path / 'resumed').glob('checkpoint_*')) == ['checkpoint_001.pth.tar']
+    checkpoint = torch.load(tmp_path / 'resumed' / 'checkpoint_001.pth.tar')
+    assert checkpoint['pruned_settings']['cnn_hidden_channels'] == 2
+
+
+def test_distillation_resume(tmp_path, monkeypatch):
+    from main import main
+    import models
+    import optimisation.distillation
+    import optimisation.training
+
+    teacher_args = _args(tmp_path, cnn_hidden_channels=8)
+    monkeypatch.setattr(optimisation.distillation, 'load_model', lambda path, cuda: models.GatedCNN(teacher_args))
+    settings = dict(teacher=tmp_path / 'teacher', distill_feature_weight=1.)
+
+    main(_args(tmp_path, save_dir=tmp_path / 'student', **settings))
+    saved = torch.load(tmp_path / 'student' / 'checkpoint_000.pth.tar')
+    adapter = {key: value for key, value in saved['distiller'].items() if key.startswith('adapter.')}
+    assert adapter and len(saved['optimizer']['param_groups']) == 2
+
+    # The adapter and its optimizer state continue from the checkpoint, rather than from random
+    trained = {}
+
+    def train(args, loader, model, criterion, optimizer, epoch, writer, distiller):
+        trained.update(adapter=distiller.adapter.state_dict(), optimizer=optimizer.state_dict())
+
+    monkeypatch.setattr(optimisation.training, 'train', train)
+    main(_args(tmp_path, save_dir=tmp_path / 'resumed', resume=tmp_path / 'student' / 'checkpoint_000.pth.tar',
+               epochs=2, **settings))
+    for key, value in trained['adapter'].items():
+        torch.testing.assert_close(value, adapter['adapter.' + key])
+    adapter_params = trained['optimizer']['param_groups'][1]['params']
+    assert all(param in trained['optimizer']['state'] for param in adapter_params)
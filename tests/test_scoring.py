@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from tests.common import make_transformed_dataset
+
+pytest.importorskip('torchnet')
+
+
+def test_score_checkpoints(tmp_path):
+    from models import GatedCNN
+    from optimisation.scoring import score_checkpoints, validation_set
+    from torchvision.models import vgg
+
+    weights = tmp_path / 'vgg19.pth'
+    torch.save({'features.' + key: value for key, value in vgg.make_layers(vgg.cfgs['E']).state_dict().items()},
+               weights)
+    args = SimpleNamespace(model='GatedCNN', cnn_in_channels=3, cnn_hidden_channels=4, cnn_hidden_layers=1,
+                           residual=True, iso=True, use_class=False, learn_beta=False, num_classes=0,
+                           fused_gates=False, self_attention=False, attention_window=0,
+                           data_dir=make_transformed_dataset(tmp_path / 'data'), test_split=0.5, data_subset=1.0,
+                           seed=42, test_batch_size=4, workers=0, cuda=False, vgg_feature_layer=22,
+                           vgg_weights=weights, evaluation_cache=None)
+    run_dir = tmp_path / 'run'
+    run_dir.mkdir()
+    for epoch in range(3):
+        torch.save({'epoch': epoch, 'model': GatedCNN(args).state_dict()}, run_dir / f'checkpoint_{epoch:03d}.pth.tar')
+
+    table = score_checkpoints(run_dir, num_processes=2, args=args)
+    assert list(table.index) == [0, 1, 2]
+    assert (run_dir / 'checkpoint_scores.csv').is_file()
+    assert len(validation_set(args)) == 6
+    assert table[['psnr', 'ssim', 'vgg_loss', 'msssim']].notna().all().all()
+
+    stacked_table = score_checkpoints(run_dir, args=args, stacked=True, chunk_size=2)
+    for column in ('psnr', 'ssim', 'vgg_loss', 'msssim'):
+        assert stacked_table[column].values == pytest.approx(table[column].values, rel=1e-4)
@@ -0,0 +1,17 @@
+import pytest
+
+import models
+from benchmarks.startup import time_import
+
+
+def test_lazy_model_registry():
+    assert models.GatedCNN is models.simple_cnn.GatedCNN
+    with pytest.raises(AttributeError):
+        getattr(models, 'UnknownCNN')
+
+
+@pytest.mark.parametrize('module', ['models', 'optimisation.testing', 'main'])
+def test_inference_imports(module):
+    """Inference entry points do not import training, quantization or export dependencies"""
+    _, heavy_modules = time_import(module)
+    assert heavy_modules == []
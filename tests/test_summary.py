@@ -0,0 +1,57 @@
+import threading
+
+import torch
+import torchvision.utils as vutils
+
+from optimisation.summary import BackgroundSummaryWriter
+
+
+class _RecordingWriter:
+    """Records the summaries, optionally waiting for `release` before writing each"""
+    def __init__(self, release=None):
+        self.release = release
+        self.scalars, self.images = [], []
+        self.closed = False
+
+    def add_scalar(self, tag, value, step):
+        if self.release is not None:
+            self.release.wait()
+        self.scalars.append((tag, value, step))
+
+    def add_image(self, tag, image, step):
+        self.images.append((tag, image, step))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_background_summary_writer():
+    images = torch.rand(4, 3, 8, 8, requires_grad=True)
+    with BackgroundSummaryWriter(_RecordingWriter()) as writer:
+        for step in range(3):
+            writer.add_scalar('Train/Loss', torch.tensor(0.5 * step, requires_grad=True), step)
+        writer.add_image_grid('Train/images', images, 7)
+        writer.flush()
+        assert writer.writer.scalars == [('Train/Loss', 0.0, 0), ('Train/Loss', 0.5, 1), ('Train/Loss', 1.0, 2)]
+        (tag, grid, step), = writer.writer.images
+        assert (tag, step) == ('Train/images', 7)
+        torch.testing.assert_close(grid, vutils.make_grid(images.detach(), normalize=True, scale_each=True))
+    assert writer.writer.closed
+
+
+def test_background_summary_writer_drops_oldest():
+    release = threading.Event()
+    writer = BackgroundSummaryWriter(_RecordingWriter(release), max_scalars=3)
+    # the first scalar is taken by the background thread, which waits on it: the others queue
+    writer.add_scalar('Train/Loss', 0, 0)
+    while writer.scalars:
+        pass
+    for step in range(1, 6):
+        writer.add_scalar('Train/Loss', step, step)
+    release.set()
+    writer.close()
+    assert [step for *_, step in writer.writer.scalars] == [0, 3, 4, 5]
+    assert writer.dropped == 2
@@ -0,0 +1,31 @@
+import pytest
+
+from tests.common import ROOT_DIR, make_transformed_dataset
+from utils import TransformedHuaweiDataset, parse_arguments
+
+pytest.importorskip('torchnet')
+
+
+def test_synthetic_dataset(tmp_path):
+    dataset = TransformedHuaweiDataset(make_transformed_dataset(tmp_path, num_originals=3, num_patches=2,
+                                                                size=(16, 24)))
+    assert len(dataset) == 6
+    assert dataset[5]['clean'].size == dataset[5]['noisy'].size == (24, 16)
+    assert dataset[5]['class'] == 'text'
+
+
+@pytest.mark.parametrize('gan', [False, True])
+def test_training_benchmark(tmp_path, gan):
+    from benchmarks.training import benchmark
+
+    args = parse_arguments(ROOT_DIR / 'run_configs' / 'default.yaml')
+    args.data_dir = make_transformed_dataset(tmp_path, num_originals=2, num_patches=3, size=32)
+    args.cuda, args.workers, args.train_batch_size = False, 0, 2
+    args.cnn_hidden_channels, args.cnn_hidden_layers = 4, 1
+    args.discriminator = 'SimpleCNN'   # the repository has no discriminator models
+    args.beta1 = 0.0   # read as an int from the config, which Adam rejects
+    results = benchmark(args, steps=4, warmup=1, gan=gan)
+    assert results['steps'] == 4
+    assert results['samples_per_second'] > 0
+    assert results['step_ms_p50'] <= results['step_ms_p90'] <= results['step_ms_p99']
+    assert 0 < results['data_wait_fraction'] < 1
@@ -1,2 +1,25 @@
-from .loader import *
-from .config import parse_arguments
+import importlib
+
+# The datasets need pandas and torchvision, so are imported on first access,
+# and importing `utils.config` or `utils.metrics` does not load them
+_LAZY = {
+    'TransformedHuaweiDataset': 'loader',
+    'HuaweiDataset': 'loader',
+    'TestDataset': 'loader',
+    'CsvLoader': 'loader',
+    'CLASS_CODES': 'loader',
+    'ISO_MEAN': 'loader',
+    'ISO_STD': 'loader',
+    'normalize_iso': 'loader',
+    'transform_sample': 'loader',
+    'loader_options': 'loader',
+    'parse_arguments': 'config',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        value = getattr(importlib.import_module(f'{__name__}.{_LAZY[name]}'), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
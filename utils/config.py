@@ -2,7 +2,7 @@
 from dataclasses import asdict, dataclass
 import random
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 import yaml
 import dacite
@@ -74,6 +74,61 @@ class Settings:
     num_classes: int = -1
     seed: int = -1
 
+    # compute features and gate of gated convolutions with a single convolution
+    fused_gates: bool = False
+
+    # quantize the model loaded from `resume` to int8, calibrating on this many training batches
+    quantize: bool = False
+    quantization_batches: int = 32
+    # quantized engine to target: x86 or qnnpack (ARM)
+    quantization_backend: str = 'x86'
+
+    # remove this fraction of the channels of the model loaded from `resume`, then fine-tune it
+    prune_ratio: float = 0.
+    # channel ranking: `scale` (normalization scales and weights) or `activation` (statistics on
+    # prune_batches training batches)
+    prune_criterion: str = 'scale'
+    prune_batches: int = 32
+    # widths of the four growth convolutions of each residual dense block (default: 32 each)
+    dense_growth_channels: Optional[List[List[int]]] = None
+
+    # distill the model loaded from this checkpoint into the model being trained
+    teacher: Optional[Path] = None
+    # weight of the loss against the teacher outputs, the loss against the clean images has 1 - weight
+    distill_weight: float = 0.5
+    # weight of matching the features the output layers of student and teacher receive
+    distill_feature_weight: float = 0.
+    # compute the teacher outputs for each training patch once, rather than every epoch
+    cache_teacher_outputs: bool = True
+
+    # add a self attention layer halfway through the hidden layers of GatedCNN and DenseGatedCNN,
+    # attending within windows of attention_window x attention_window pixels (0: the whole image)
+    self_attention: bool = False
+    attention_window: int = 0
+
+    # run the test model with `torch`, or export it to ONNX and run it with `onnxruntime` on CPU
+    inference_backend: str = 'torch'
+
+    # VGG19 weights for VGGLoss, a state dict of torchvision's vgg19 (default: download them)
+    vgg_weights: Optional[Path] = None
+    # with `loss: VGGLoss`, compute the VGG features of each clean training patch once, rather
+    # than every epoch, and keep them in memory or, if given, in vgg_feature_cache_file
+    cache_vgg_features: bool = False
+    vgg_feature_cache_file: Optional[Path] = None
+    # with `loss: EdgeAwareLoss`, compute the edge maps of each clean training patch once
+    cache_clean_edges: bool = False
+
+    # data loader settings recommended by `python -m benchmarks.loader`, rather than `workers`
+    loader_profile: Optional[Path] = None
+
+    # write the TensorBoard summaries from a background thread, dropping the oldest ones if it
+    # falls behind, rather than on the training thread
+    background_logging: bool = True
+
+    # directory to store the per-sample results of `evaluate` in, reused when the same weights are
+    # evaluated on the same samples again (default: not stored)
+    evaluation_cache: Optional[Path] = None
+
     def asdict(self) -> dict:
         return asdict(self)
 
@@ -1,4 +1,5 @@
 """Utilities for loading the dataset"""
+import json
 from pathlib import Path
 import pandas as pd
 from PIL import Image
@@ -9,6 +10,9 @@ import numpy as np
 
 
 CLASS_CODES = {'building': 0, 'foliage': 1, 'text': 2}
+# Statistics of the ISO values of the training set
+ISO_MEAN = 1215.32
+ISO_STD = 958.13
 
 
 class TransformedHuaweiDataset(Dataset):
@@ -53,6 +57,8 @@ class TransformedHuaweiDataset(Dataset):
 
         if self.transform is not None:
             sample = self.transform(sample)
+        # identifies the patch, e.g. for caching per-sample results
+        sample['index'] = idx
 
         return sample
 
@@ -191,7 +197,7 @@ class CsvLoader(Dataset):
             'clean': transforms.functional.to_tensor(clean_image),
             'noisy': transforms.functional.to_tensor(noisy_image),
             'iso': torch.tensor(self.info_df.iloc[idx]['iso'], dtype=torch.float32),
-            'class': torch.LongTensor(self.info_df.iloc[idx]['class'].replace(CLASS_CODES))
+            'class': torch.LongTensor([CLASS_CODES[self.info_df.iloc[idx]['class']]])
         }
 
     def random_split(self, test_ratio=0.5, seed=None):
@@ -204,6 +210,27 @@ class CsvLoader(Dataset):
         return Subset(self, train_idx), Subset(self, test_idx)
 
 
+def normalize_iso(iso):
+    """Standardize raw ISO values into the conditioning data the models receive"""
+    return (iso - ISO_MEAN) / ISO_STD
+
+
+def loader_options(args):
+    """
+    Keyword arguments of the training and validation DataLoaders: `args.workers` processes and,
+    with CUDA, pinned memory, or the settings of the `args.loader_profile` that
+    `python -m benchmarks.loader` recommends
+    """
+    options = {'num_workers': args.workers, 'pin_memory': args.cuda}
+    if args.loader_profile:
+        profile = json.loads(Path(args.loader_profile).read_text())
+        options['num_workers'] = profile['num_workers']
+        options['pin_memory'] = profile['pin_memory'] and args.cuda
+        if profile['num_workers'] > 0:
+            options['prefetch_factor'] = profile['prefetch_factor']
+    return options
+
+
 def transform_sample(sample):
     """Transformation for sample dict, should be used for test data as well as train"""
     # Define transforms:
@@ -218,7 +245,7 @@ def transform_sample(sample):
     transformed_sample = {
         'clean': clean_transforms(sample['clean']) if 'clean' in sample else None,
         'noisy': noisy_transforms(sample['noisy']),
-        'iso': torch.FloatTensor([(sample['iso'] - 1215.32) / 958.13]),   # (x - mean) / std,
+        'iso': torch.FloatTensor([normalize_iso(sample['iso'])]),
         'class': torch.LongTensor([CLASS_CODES[sample['class']]])
     }
 
@@ -1,2 +1,4 @@
 from .psnr import *
-from .ssim import *
\ No newline at end of file
+from .ssim import *
+from .msssim import *
+from .streaming import *
@@ -0,0 +1,69 @@
+"""
+Multi-scale Structural Similarity (MS-SSIM)
+
+Wang, Simoncelli and Bovik, "Multiscale structural similarity for image quality assessment", 2003
+"""
+import torch
+import torch.nn.functional as F
+
+from utils.metrics.ssim import _ssim_maps
+
+# Exponents of the scales, from the finest to the coarsest
+MSSSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+
+def _pyramid(img1, img2, levels):
+    """
+    Pyramids of both images, each level downsampled by 2x2 average pooling from the one before,
+    computed once for both images. Odd sizes are padded.
+    """
+    images = torch.cat((img1, img2), 0)
+    pyramid = [images.chunk(2)]
+    for _ in range(levels - 1):
+        images = F.avg_pool2d(images, kernel_size=2, padding=[size % 2 for size in images.shape[2:]])
+        pyramid.append(images.chunk(2))
+    return pyramid
+
+
+def ms_ssim(img1, img2, data_range, window_size=11, weights=MSSSIM_WEIGHTS):
+    """
+    Compute Multi-scale Structural Similarity, per image: the product over scales of the
+    contrast sensitivities, and of the SSIM at the coarsest scale, each raised to its weight,
+    computed per channel and averaged over the channels.
+    The window is truncated at scales smaller than it: images should be at least
+    (window_size - 1) * 2 ** (len(weights) - 1) + 1 pixels, 161 by default, in size.
+    """
+    values = []
+    for level, (level1, level2) in enumerate(_pyramid(img1, img2, len(weights))):
+        # Every image, channel and statistic of a scale is filtered at once
+        ssim_map, cs_map = _ssim_maps(level1, level2, data_range, min(window_size, *level1.shape[2:]))
+        values.append((ssim_map if level == len(weights) - 1 else cs_map).mean(dim=(2, 3)))
+
+    values = torch.stack(values, -1).relu()    # [B, C, scales]
+    weights = torch.tensor(weights, device=values.device, dtype=values.dtype)
+    return (values ** weights).prod(-1).mean(1)
+
+
+class MSSSIM(torch.nn.Module):
+    """Multi-scale Structural Similarity index
+
+    1 is the best value
+    """
+    def __init__(self, data_range, channels, window_size=11, weights=MSSSIM_WEIGHTS):
+        """
+        Attention: assumes the structure NCHW ("channels first") for the images; not NHWC
+
+        Args:
+            data_range: the range of the expected values in the images. usually 255 (for uint8).
+                        for output of sigmoid it would be 1.0; for output of tanh it would be 2.0
+            channels: number of color channels in the images
+            weights: exponents of the scales, from the finest to the coarsest
+        """
+        super().__init__()
+        self.window_size = window_size
+        self.data_range = data_range
+        self.channels = channels
+        self.weights = tuple(weights)
+
+    def forward(self, img1, img2):
+        return ms_ssim(img1, img2, self.data_range, window_size=self.window_size, weights=self.weights)
@@ -0,0 +1,85 @@
+"""
+PSNR and SSIM of images fed in row bands, e.g. as they are produced by a tiled inference,
+computed from running sums, without holding the whole images or SSIM maps in memory
+"""
+import torch
+
+from utils.metrics.ssim import _ssim_maps, ssim
+
+
+class StreamingPSNR:
+    """
+    Peak signal to noise ratio of images fed in parts, equal to `PSNR` of the whole images.
+    The parts may be any partition of the images, e.g. row bands or tiles.
+    """
+    def __init__(self, data_range):
+        """
+        Args:
+            data_range: possible range of values. 255 for uint8; 1 for output of sigmoid
+        """
+        self.scale = 1.0 / data_range**2
+        self.reset()
+
+    def reset(self):
+        self.squared_error = None
+        self.count = 0
+
+    def update(self, im_test, im_true):
+        """Add parts of the images, [B, C, h, w]"""
+        err = ((im_true - im_test).double()**2).sum(dim=(1, 2, 3))
+        self.squared_error = err if self.squared_error is None else self.squared_error + err
+        self.count += im_test[0].numel()
+
+    def compute(self):
+        """PSNR of each image, [B]"""
+        if self.squared_error is None:
+            raise ValueError("No image parts were added")
+        return (-10 * torch.log10(self.scale * self.squared_error / self.count)).float()
+
+
+class StreamingSSIM:
+    """
+    Structural Similarity of images fed in row bands, top to bottom, equal to `ssim` of the whole
+    images. The last `window_size - 1` rows of each band are kept, so that the Gaussian window
+    covers the band boundaries, and only the sum of the SSIM map rows computed so far is held.
+    Tiles can be fed as the bands they form, one row of tiles at a time.
+    """
+    def __init__(self, data_range, window_size=11):
+        """
+        Args:
+            data_range: the range of the expected values in the images. usually 255 (for uint8).
+                        for output of sigmoid it would be 1.0; for output of tanh it would be 2.0
+        """
+        self.data_range = data_range
+        self.window_size = window_size
+        self.reset()
+
+    def reset(self):
+        self.halo1 = self.halo2 = None
+        self.ssim_sum = None
+        self.count = 0
+
+    def update(self, img1, img2):
+        """Add the next row bands of the images, [B, C, h, W], of any height h"""
+        if self.halo1 is not None:
+            img1 = torch.cat((self.halo1, img1), 2)
+            img2 = torch.cat((self.halo2, img2), 2)
+        # like `ssim`, the window is truncated to the image size
+        window_size = min(self.window_size, img1.size(3))
+        if img1.size(2) >= window_size:
+            ssim_map, _ = _ssim_maps(img1, img2, self.data_range, window_size)
+            band_sum = ssim_map.double().sum(dim=(1, 2, 3))
+            self.ssim_sum = band_sum if self.ssim_sum is None else self.ssim_sum + band_sum
+            self.count += ssim_map[0].numel()
+            # the rows that windows of the next band still reach
+            img1, img2 = img1[:, :, img1.size(2) - window_size + 1:], img2[:, :, img2.size(2) - window_size + 1:]
+        self.halo1, self.halo2 = img1, img2
+
+    def compute(self):
+        """SSIM of each image, [B]"""
+        if self.halo1 is None:
+            raise ValueError("No image bands were added")
+        if self.ssim_sum is None:
+            # the images are lower than the window, which `ssim` truncates to their height
+            return ssim(self.halo1, self.halo2, self.data_range, self.window_size)
+        return (self.ssim_sum / self.count).float()